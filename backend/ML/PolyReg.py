@@ -1,79 +1,83 @@
+from collections import namedtuple
 from datetime import datetime as dt
 
 import numpy as np
-from sklearn.linear_model import LinearRegression
-from sklearn.preprocessing import PolynomialFeatures
 
-from backend.ML.utils import change_date, DATE_FORMAT
+from backend.metrics import stage
 
-BOOL_COND_ARRAY = []
+DEGREE = 4
 
+# samples after April 2020, when the COVID-19 became global
+TREND_START = dt(2020, 4, 1).toordinal()
 
-def get_trend_pred(united_samples, look_back):
+# label:        str, 'upward', 'downward' or 'not_changed'
+# coefficients: numpy.ndarray, highest power first, as numpy.polyfit returns
+# center:       float, day ordinal the dates are centered on
+# scale:        float, number of days the centered dates are divided by
+Trend = namedtuple('Trend', ['label', 'coefficients', 'center', 'scale'])
+
+
+def fit_trend(history, look_back):
     """
-        Takes all samples appended with all prediction numbers
+        Takes the series of new cases appended with all prediction numbers
             and prediction dates.
 
-            Dates are moved a day behind to match selected new cases values
-            since initially dates were corresponding to features, not
-            predictions.
-
             Samples are filtered to start in 2020-04, when COVID-19 became the
-            global issue. A boolean array is used.
+            global issue.
 
-            When dates match COVID-19 cases, polynomial regression is applied.
+            A polynomial of DEGREE is fitted by least squares to the dates
+            centered and scaled to -1..1, which keeps the fit well conditioned
+            for large day ordinals.
 
             After a trend is defined, the last value on the trend line is
             compared with the value at the look_back days behind.
 
+            The trend line at a date is
+                numpy.polyval(coefficients, (date - center) / scale).
 
-            :param      united_samples:         numpy.ndarray
-                        united_samples.shape:   (N, 4)
+
+            :param      history:                Series
 
                         look_back:              int
-            :return:                            str
+            :return:                            Trend
     """
 
-    features = united_samples[:, :1].astype(str)
-    labels = united_samples[:, -1:]
+    selected = history.dates >= TREND_START
+    dates = history.dates[selected].astype(np.float64)
+    labels = history.values[selected].astype(np.float64)
 
-    # move all dates a day behind
-    delta = -1
-    generator = (change_date(date[0], delta_days=delta) for date in features)
-    new_dates = np.fromiter(generator, features.dtype)
+    if len(dates) < look_back + 1:
+        return Trend('not_changed', np.zeros(DEGREE + 1), 0.0, 1.0)
 
-    # selecting samples after April 2020 when the COVID-19 became global
-    BOOL_COND_ARRAY = [(int(date[0:4]) >= 2020 and int(date[5:7]) >= 4)
-                       for date in new_dates]
-    new_dates = new_dates[BOOL_COND_ARRAY]
-    new_dates = new_dates.reshape(-1, 1)
+    center = (dates[0] + dates[-1]) / 2
+    scale = max((dates[-1] - dates[0]) / 2, 1.0)
 
-    labels = labels[BOOL_COND_ARRAY]
+    coefficients = np.polyfit((dates - center) / scale, labels, DEGREE)
 
-    # converting date to numerical source:
-    generator = (dt.toordinal(dt.strptime(date[0], DATE_FORMAT)) for date in
-                 new_dates)
-    numerical_dates = np.fromiter(generator, features.dtype)
-    numerical_dates = numerical_dates.reshape(-1, 1).astype(float)
+    # only both ends of the window are needed from the trend line
+    ahead, behind = np.polyval(coefficients,
+                               (dates[[-1, -look_back - 1]] - center) / scale)
 
-    # change degree of polynomial features
-    poly_features = PolynomialFeatures(degree=4)
-    features_transformed = poly_features.fit_transform(numerical_dates)
+    if ahead > behind:
+        label = 'upward'
+    elif ahead < behind:
+        label = 'downward'
+    else:
+        label = 'not_changed'
 
-    # model
-    linreg_model = LinearRegression()
-    linreg_model.fit(features_transformed, labels)
+    return Trend(label, coefficients, center, scale)
 
-    # trend
-    trend_labels = linreg_model.predict(
-        poly_features.fit_transform(numerical_dates))
 
-    ahead = trend_labels[-1:, 0]
-    behind = trend_labels[-look_back-1: -look_back, 0]
+def get_trend_pred(history, look_back):
+    """
+        Direction of the trend line within the prediction window,
+            see fit_trend().
 
-    if ahead > behind:
-        return 'upward'
-    elif ahead < behind:
-        return 'downward'
-    else:
-        return 'not_changed'
+            :param      history:                Series
+
+                        look_back:              int
+            :return:                            str
+    """
+
+    with stage('trend'):
+        return fit_trend(history, look_back).label
@@ -1,15 +1,54 @@
 import os
+
 import numpy as np
-from tensorflow import keras
+from numpy.lib.stride_tricks import sliding_window_view
 from werkzeug.exceptions import abort
 
-from backend.ML.utils import load_data, preprocess, filter_by_country, \
-    separate, normalize, apply_lookback, reshape, unite_dates_samples, \
-    denormalize, append_sample, change_date, get_sample
+from backend.metrics import stage
+from backend.ML.registry import MODELS
+from backend.ML.rollout import Forecast, rollout
+from backend.ML.store import get_case_store
+from backend.ML.utils import Series, normalize, denormalize, to_ordinals, \
+    from_ordinals
+
+# simulated paths of the residual bootstrap of prediction intervals
+INTERVAL_SAMPLES = int(os.environ.get('INTERVAL_SAMPLES', 200))
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+# days of residuals before the starting date, errors scale with the counts
+RESIDUAL_WINDOW = 28
+# intervals of the same request are the same
+INTERVAL_SEED = 7
+
+
+def locate_start(store, country_code, requested_day, look_back):
+    """
+        Position of the starting date in the series of a country.
+
+            Samples exist only for dates having look_back previous values,
+            any other date, or a date that cannot be parsed, starts from
+            the last available date.
+
+        :param      store:          CaseStore
+        :param      country_code:   str
+        :param      requested_day:  str
+        :param      look_back:      int
+        :return:                    int
+    """
+
+    try:
+        start = store.locate(country_code, int(to_ordinals(requested_day)))
+    except ValueError:
+        start = -1
+
+    if start < look_back:
+        dates, _ = store.series(country_code)
+        start = len(dates) - 1
+
+    return start
 
 
 class RNN:
-    def __init__(self, country_code, look_forward=3):
+    def __init__(self, country_code, look_forward=3, registry=None):
         """
         """
         if not country_code:
@@ -18,9 +57,8 @@ class RNN:
         self.look_back = look_forward
         self.look_forward = look_forward + 1
         self.country_code = country_code
-        self.models_src = f'{os.path.dirname(__file__)}/models'
-        self.model = keras.models.load_model(
-            f'{self.models_src}/{self.country_code}-RNN.h5')
+        with stage('model_load'):
+            self.model = (registry or MODELS).get(self.country_code)
 
     def predict(self, requested_day):
         """
@@ -33,66 +71,190 @@ class RNN:
                 If the requested date is ahead of the last available date,
                 the last available date will be taken as the starting date.
 
+                Returns the normalized series of new cases,
+                where the predicted values replace or extend the real ones,
+                for the trend line.
+
+            :param      requested_day:  str
+            :return     prediction_info:    dict
+                        history:            Series
+        """
+
+        return self.predict_batch([requested_day])[0]
+
+    def predict_batch(self, requested_days):
+        """
+            Make predictions for several starting dates at once.
+
+                All rollouts share each step, the model predicts
+                a (B, 1, look_back) batch once per step.
+
+            :param      requested_days: list of str
+            :return:                    list of (prediction_info, history)
+        """
+
+        store, dates, Y, scaler = self.load_series()
+
+        starts = np.array([locate_start(store, self.country_code,
+                                        requested_day, self.look_back)
+                           for requested_day in requested_days])
+
+        windows = Y[starts[:, None] + np.arange(-self.look_back, 0)]
+        with stage('rollout'):
+            predicted = rollout(self.model, windows, self.look_forward)
+
+        results = []
+        for start, normalized in zip(starts, predicted):
+            forecast_dates = dates[start] + np.arange(self.look_forward,
+                                                      dtype=np.int32)
+
+            history = self.history(dates, Y, start, normalized)
+
+            # convert to a real number of COVID-19 cases
+            new_cases = denormalize(normalized, scaler)
+
+            # date of the prediction
+            last_day = forecast_dates[-1]
+
+            # chosen starting date
+            start_avail_day = last_day - self.look_back
+
+            prediction_info = {
+                'prediction_date': str(from_ordinals(last_day)),
+                'starting_date': str(from_ordinals(start_avail_day)),
+                'prediction_new_cases': int(new_cases[-1]),
+                'forecast': Forecast(forecast_dates, new_cases)
+            }
+
+            results.append((prediction_info, history))
+
+        return results
+
+    def predict_intervals(self, requested_day, samples=INTERVAL_SAMPLES,
+                          quantiles=QUANTILES, seed=INTERVAL_SEED):
+        """
+            Prediction intervals of the forecast of predict(), by a residual
+                bootstrap.
+
+                One step ahead residuals of the model over the days just
+                before the starting date are drawn with replacement and
+                added to the predictions of each step of the rollout,
+                samples perturbed paths run together as a
+                (samples, 1, look_back) batch. Quantiles of the paths,
+                clipped at 0, bound the new cases of each day.
+
+                Only values known at the starting date are used, and the
+                residuals are local, so the bands of early dates with few
+                cases stay as narrow as their errors.
+
             :param      requested_day:  str
-            :return     predicted:      int
-                        message:        str
+            :param      samples:        int
+            :param      quantiles:      tuple of float, in 0..1
+            :param      seed:           int
+            :return:                    list of dict, one per forecast day
+        """
+
+        store, dates, Y, scaler = self.load_series()
+        start = locate_start(store, self.country_code, requested_day,
+                             self.look_back)
+
+        with stage('intervals'):
+            residuals = self.residuals(Y, start)
+
+            rng = np.random.default_rng(seed)
+            noise = rng.choice(residuals, size=(samples, self.look_forward))
+
+            windows = np.repeat(Y[None, start - self.look_back:start],
+                                samples, axis=0)
+            paths = denormalize(rollout(self.model, windows,
+                                        self.look_forward, noise), scaler)
+
+            # (quantiles, look_forward), new cases are never negative
+            bounds = np.maximum(np.quantile(paths, quantiles, axis=0), 0)
+
+        forecast_dates = from_ordinals(dates[start] + np.arange(
+            self.look_forward, dtype=np.int32))
+
+        return [{
+            'date': str(forecast_date),
+            'quantiles': {str(quantile): int(bound)
+                          for quantile, bound in zip(quantiles, day_bounds)},
+        } for forecast_date, day_bounds in zip(forecast_dates, bounds.T)]
+
+    def load_series(self):
         """
+            Raises ValueError if the country has too few samples.
 
-        df = load_data()
+            :return:    store:      CaseStore
+                        dates:      numpy.ndarray, (N, ) int32
+                        Y:          numpy.ndarray, (N, ) float32, normalized
+                        scaler:     Scaler
+        """
 
-        # preprocess
-        df = preprocess(df)
-        df = filter_by_country(df, self.country_code)
+        with stage('case_store'):
+            store = get_case_store()
+            dates, Y = store.series(self.country_code)
+            scaler = store.scaler(self.country_code)
 
-        # separate cases from data
-        dates, Y = separate(df)
+        if len(Y) <= self.look_back:
+            raise ValueError(f'not enough data for {self.country_code}')
 
         # normalize Y
-        Y = normalize(Y)
+        Y = normalize(Y, scaler)
 
-        # apply look_back and generate needed samples
-        X, _ = apply_lookback(Y, look_back=self.look_back)
+        return store, dates, Y, scaler
 
-        # reshape to fit the model
-        X = reshape(X)
-        dates = reshape(dates)
-        dates = dates[self.look_back:]
+    def residuals(self, Y, end, window=RESIDUAL_WINDOW):
+        """
+            Centered one step ahead residuals of the model for the values
+                of a series at positions end-window..end-1, all windows are
+                predicted as one batch.
 
-        # unite samples (X) with dates
-        # a date of a sample corresponds to the future prediction value (Y)
-        united_samples = unite_dates_samples(dates.reshape(-1, 1),
-                                             X.reshape(-1, self.look_back))
+                Values from end on are not used, a single 0 is returned if
+                no value has look_back previous values.
 
-        last_day = requested_day
-        predicted = 0
+            :param      Y:      numpy.ndarray, (N, ) float32, normalized
+            :param      end:    int, position of the first value left out
+            :param      window: int
+            :return:            numpy.ndarray, (<= window, ) float32
+        """
 
-        for step in range(self.look_forward):
-            sample, last_day = get_sample(united_samples, last_day)
-            sample = sample.reshape(1, 1, self.look_back)
+        first = max(end - window, self.look_back)
+        if first >= end:
+            return np.zeros(1, dtype=np.float32)
 
-            predicted = self.model.predict(sample.astype(np.float32))
+        windows = sliding_window_view(Y[first - self.look_back:end - 1],
+                                      self.look_back)
+        predicted = self.model.predict(windows[:, None, :])
 
-            united_samples, last_day = append_sample(united_samples, predicted,
-                                                     self.look_back,
-                                                     last_day)
+        residuals = Y[first:end] - np.reshape(predicted, (len(windows),))
 
-        # date of the prediction
-        last_day = change_date(last_day, delta_days=-1)
+        # the spread of the errors, around the predictions of the model
+        return residuals - residuals.mean()
 
-        # chosen starting date
-        start_avail_day = change_date(last_day,
-                                      delta_days=-self.look_back)
+    def history(self, dates, Y, start, predicted):
+        """
+            Builds the series used for the trend line.
 
-        # convert to a real number of COVID-19 cases
-        predicted = denormalize(predicted)[0, 0]
-        predicted = int(predicted)
+                Each sample stores x(t) for the date of x(t+1), so the first
+                look_back-1 values and the last real value have no sample;
+                the last real value only appears when a prediction replaces
+                it. Predicted values replace real ones from the starting
+                date on and extend the series past the last available date.
 
-        prediction_info = {
-            'prediction_date': last_day,
-            'starting_date': start_avail_day,
-            'prediction_new_cases': predicted
-        }
+            :param      dates:      numpy.ndarray, (N, ) int32
+            :param      Y:          numpy.ndarray, (N, ) float32, normalized
+            :param      start:      int, position of the starting date
+            :param      predicted:  numpy.ndarray, (look_forward, ) float32
+            :return:                Series
+        """
 
-        return prediction_info, united_samples
+        first = self.look_back - 1
+        end = max(len(Y) - 1, start + len(predicted))
 
+        values = np.empty(end - first, dtype=np.float32)
+        values[:len(Y) - 1 - first] = Y[first:-1]
+        values[start - first:start - first + len(predicted)] = predicted
 
+        return Series(dates[first] + np.arange(len(values), dtype=np.int32),
+                      values)
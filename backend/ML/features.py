@@ -0,0 +1,207 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+from backend.ML.store import get_case_store, row_keys
+from backend.ML.utils import DATASET_DIR, to_ordinals
+from backend.scripts.mobility import CATEGORIES, get_mobility_store
+
+CACHE_DIR = f'{DATASET_DIR}/.cache/features'
+ARRAYS = ('codes', 'offsets', 'dates', 'values')
+SOURCE_FILE = 'source.json'
+
+# columns of the matrices
+FEATURES = ('new_cases',) + CATEGORIES
+
+
+class FeatureStore:
+    def __init__(self, codes, offsets, dates, values, source=None):
+        """
+            New cases and mobility of each country, aligned by date,
+                as one float32 matrix per country.
+
+            Rows of a country are contiguous and sorted by date,
+                the partition of codes[i] is offsets[i]:offsets[i + 1].
+                A country has a row for every date of its new cases,
+                categories missing from the mobility report are NaN.
+
+            Shapes: C is the number of countries, N the number of rows,
+                F the number of FEATURES.
+                codes       (C, )       str
+                offsets     (C + 1, )   int64
+                dates       (N, )       int32, day ordinals
+                values      (N, F)      float32
+
+            :param      source:     str, versions of the case store and
+                                    of the mobility report
+        """
+        self.codes = codes
+        self.offsets = offsets
+        self.dates = dates
+        self.values = values
+        self.source = source
+
+        self._index = {str(code): (int(offsets[i]), int(offsets[i + 1]))
+                       for i, code in enumerate(codes)}
+
+    def __contains__(self, country_code):
+        return country_code in self._index
+
+    def __len__(self):
+        return len(self.dates)
+
+    def countries(self):
+        return list(self._index)
+
+    def matrix(self, country_code):
+        """
+            Dates and features of a country, as read-only views.
+
+            Raises KeyError for a country missing from either dataset.
+
+            :param      country_code:   str
+            :return:    dates:          numpy.ndarray, (T, ) int32
+                        values:         numpy.ndarray, (T, F) float32,
+                                        columns in the order of FEATURES
+        """
+        start, end = self._index[country_code]
+
+        return self.dates[start:end], self.values[start:end]
+
+    @classmethod
+    def join(cls, cases, mobility):
+        """
+            Joins new cases and the mobility report by country and date.
+
+            Countries missing from either dataset are left out.
+
+            :param      cases:      CaseStore
+            :param      mobility:   backend.scripts.mobility.MobilityStore
+            :return:                FeatureStore
+        """
+        case_codes = cases.rows()
+        mobility_codes = np.repeat(mobility.codes.astype(str),
+                                   np.diff(mobility.offsets))
+        mobility_dates = to_ordinals(mobility.dates)
+
+        # rows of countries in both datasets, still grouped and sorted
+        kept = np.isin(case_codes, mobility_codes)
+        codes = case_codes[kept]
+        dates = np.asarray(cases.dates)[kept]
+
+        all_codes = np.union1d(codes, mobility_codes)
+        keys = row_keys(codes, dates, all_codes)
+        mobility_keys, first = np.unique(
+            row_keys(mobility_codes, mobility_dates, all_codes),
+            return_index=True)
+
+        positions = np.minimum(np.searchsorted(mobility_keys, keys),
+                               len(mobility_keys) - 1)
+        found = mobility_keys[positions] == keys
+
+        values = np.full((len(codes), len(FEATURES)), np.nan,
+                         dtype=np.float32)
+        values[:, 0] = np.asarray(cases.new_cases)[kept]
+        values[found, 1:] = mobility.values[:, first[positions[found]]].T
+
+        unique_codes, starts = np.unique(codes, return_index=True)
+        offsets = np.append(starts, len(codes)).astype(np.int64)
+
+        return cls(unique_codes, offsets, dates, values,
+                   source=f'{cases.source}:{mobility.source}')
+
+    def save(self, directory=CACHE_DIR):
+        """
+            Writes the arrays as .npy files, so they can be memory-mapped.
+
+            The source file is written last and marks the cache as complete.
+
+            :param      directory:  str
+        """
+        os.makedirs(directory, exist_ok=True)
+
+        for name in ARRAYS:
+            tmp_path = f'{directory}/{name}.tmp.npy'
+            np.save(tmp_path, getattr(self, name))
+            os.replace(tmp_path, f'{directory}/{name}.npy')
+
+        tmp_path = f'{directory}/{SOURCE_FILE}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'source': self.source}, file)
+        os.replace(tmp_path, f'{directory}/{SOURCE_FILE}')
+
+    @classmethod
+    def load(cls, directory=CACHE_DIR, mmap_mode='r'):
+        """
+            Loads a store written by save().
+
+            Raises OSError if the cache does not exist.
+
+            :param      directory:  str
+            :param      mmap_mode:  str or None
+            :return:                FeatureStore
+        """
+        with open(f'{directory}/{SOURCE_FILE}') as file:
+            source = json.load(file)['source']
+
+        arrays = [np.load(f'{directory}/{name}.npy', mmap_mode=mmap_mode)
+                  for name in ARRAYS]
+
+        return cls(*arrays, source=source)
+
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+
+def get_feature_store(cases=None, mobility=None, cache_dir=CACHE_DIR):
+    """
+        Returns the process-wide feature store.
+
+        The join runs once per version of the case store and of the
+            mobility report, its result is memory-mapped from a binary
+            cache shared by the processes.
+
+        :param      cases:      CaseStore or None, the process-wide one
+                                by default
+        :param      mobility:   MobilityStore or None, the process-wide one
+                                by default
+        :param      cache_dir:  str
+        :return:                FeatureStore
+    """
+    global _STORE
+
+    if cases is None:
+        cases = get_case_store()
+    if mobility is None:
+        mobility = get_mobility_store()
+
+    source = f'{cases.source}:{mobility.source}'
+    store = _STORE
+    if store is not None and store.source == source:
+        return store
+
+    with _STORE_LOCK:
+        if _STORE is not None and _STORE.source == source:
+            return _STORE
+
+        try:
+            store = FeatureStore.load(cache_dir)
+        except (OSError, ValueError, KeyError):
+            store = None
+
+        if store is None or store.source != source:
+            FeatureStore.join(cases, mobility).save(cache_dir)
+            store = FeatureStore.load(cache_dir)
+
+        _STORE = store
+
+        return store
+
+
+if __name__ == '__main__':
+    store = get_feature_store()
+    print(f'{len(store.codes)} countries, {len(store)} rows of '
+          f'{", ".join(FEATURES)}')
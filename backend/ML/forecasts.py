@@ -0,0 +1,263 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+from backend.metrics import FORECAST_LOOKUPS, stage
+from backend.ML.PolyReg import get_trend_pred
+from backend.ML.RNN import RNN, locate_start
+from backend.ML.registry import MODELS, available_models
+from backend.ML.store import CACHE_DIR, get_case_store
+from backend.ML.utils import from_ordinals
+
+FORECASTS_PATH = os.environ.get(
+    'FORECASTS_PATH', f'{os.path.dirname(CACHE_DIR)}/forecasts.sqlite')
+HORIZON_LIMIT = 14
+
+# changed whenever forecasts are computed differently,
+# so that stored forecasts are recomputed
+VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS countries (
+    country_region_code TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS forecasts (
+    country_region_code TEXT NOT NULL,
+    look_forward_days INTEGER NOT NULL,
+    starting_date TEXT NOT NULL,
+    prediction_date TEXT NOT NULL,
+    prediction_new_cases INTEGER NOT NULL,
+    trend TEXT NOT NULL,
+    PRIMARY KEY (country_region_code, look_forward_days)
+);
+"""
+
+
+class ForecastTable:
+    def __init__(self, path=FORECASTS_PATH, registry=MODELS):
+        """
+            On-disk table of forecasts starting at the last available date,
+                for every country with a model and every number of days
+                to look forward up to a limit.
+
+            Forecasts of a country are valid as long as the content hash
+                of its rows and its model does not change.
+
+            :param      path:       str, SQLite database
+            :param      registry:   ModelRegistry
+        """
+        self.path = path
+        self.registry = registry
+
+        self._local = threading.local()
+        # country code -> (version of its rows and model, hash)
+        self._hashes = {}
+        self._exists = False
+
+    def connect(self):
+        """
+            Connection of the current thread, opened on first use.
+
+            :return:    sqlite3.Connection
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            # readers are not blocked while forecasts are refreshed
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+            self._exists = True
+
+        return connection
+
+    def content_hash(self, store, country_code):
+        """
+            Hash of the rows of a country and of its model's file.
+
+            Only the hash of the current version of the store and of the model
+                is kept for each country.
+
+            Raises OSError if the country has no model.
+
+            :param      store:          CaseStore
+            :param      country_code:   str
+            :return:                    str
+        """
+        model_path, stat = self.registry.locate(country_code)
+        key = (store.source, model_path, stat.st_ino, stat.st_size,
+               stat.st_mtime_ns)
+
+        cached = self._hashes.get(country_code)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        dates, new_cases = store.series(country_code)
+
+        digest = hashlib.sha1(f'{VERSION}'.encode())
+        digest.update(dates.tobytes())
+        digest.update(new_cases.tobytes())
+        digest.update(self.registry.digest(model_path, stat).encode())
+
+        content_hash = digest.hexdigest()
+        self._hashes[country_code] = (key, content_hash)
+
+        return content_hash
+
+    def lookup(self, country_code, look_forward_days, requested_day):
+        """
+            Returns a precomputed forecast if the requested date starts
+                from the last available date and the forecast is up to date.
+
+            :param      country_code:       str
+            :param      look_forward_days:  int
+            :param      requested_day:      str
+            :return:                        dict or None
+        """
+        with stage('forecast_lookup'):
+            forecast = self._lookup(country_code, look_forward_days,
+                                    requested_day)
+
+        FORECAST_LOOKUPS.inc('miss' if forecast is None else 'hit')
+
+        return forecast
+
+    def _lookup(self, country_code, look_forward_days, requested_day):
+        # the table is not created by a lookup, once it exists it stays
+        if not self._exists:
+            if not os.path.exists(self.path):
+                return None
+            self._exists = True
+
+        store = get_case_store()
+
+        try:
+            start = locate_start(store, country_code, requested_day,
+                                 look_forward_days)
+            content_hash = self.content_hash(store, country_code)
+        except (KeyError, OSError):
+            return None
+
+        dates, _ = store.series(country_code)
+        if start != len(dates) - 1:
+            return None
+
+        row = self.connect().execute(
+            'SELECT f.starting_date, f.prediction_date, '
+            'f.prediction_new_cases, f.trend '
+            'FROM forecasts f JOIN countries c '
+            'ON f.country_region_code = c.country_region_code '
+            'WHERE f.country_region_code = ? AND f.look_forward_days = ? '
+            'AND c.content_hash = ?',
+            (country_code, look_forward_days, content_hash)).fetchone()
+
+        if row is None:
+            return None
+
+        return dict(zip(('starting_date', 'prediction_date',
+                         'prediction_new_cases', 'trend'), row))
+
+    def refresh(self, horizon_limit=HORIZON_LIMIT, country_codes=None,
+                force=False):
+        """
+            Recomputes forecasts of countries whose rows or model changed.
+
+            Only the numbers of days to look forward that match the look_back
+                of a country's model are computed.
+
+            :param      horizon_limit:  int
+            :param      country_codes:  list or None, all countries with
+                                        a model and data by default
+            :param      force:          bool, recompute unchanged countries
+            :return:                    list of recomputed country codes
+        """
+        store = get_case_store()
+
+        if country_codes is None:
+            country_codes = [country_code for country_code
+                             in available_models(self.registry.models_dir)
+                             if country_code in store]
+
+        connection = self.connect()
+        stored = dict(connection.execute(
+            'SELECT country_region_code, content_hash FROM countries'))
+
+        refreshed = []
+        for country_code in country_codes:
+            content_hash = self.content_hash(store, country_code)
+            if not force and stored.get(country_code) == content_hash:
+                continue
+
+            rows = self.compute(store, country_code, horizon_limit)
+
+            with connection:
+                connection.execute(
+                    'DELETE FROM forecasts WHERE country_region_code = ?',
+                    (country_code,))
+                connection.executemany(
+                    'INSERT INTO forecasts VALUES (?, ?, ?, ?, ?, ?)', rows)
+                connection.execute(
+                    'INSERT OR REPLACE INTO countries VALUES (?, ?)',
+                    (country_code, content_hash))
+
+            refreshed.append(country_code)
+
+        return refreshed
+
+    def compute(self, store, country_code, horizon_limit):
+        """
+            Forecasts of a country from its last available date.
+
+            :param      store:          CaseStore
+            :param      country_code:   str
+            :param      horizon_limit:  int
+            :return:                    list of rows of the forecasts table
+        """
+        dates, _ = store.series(country_code)
+        last_day = str(from_ordinals(dates[-1]))
+
+        look_back = self.registry.get(country_code).input_shape[-1]
+
+        rows = []
+        for look_forward_days in range(1, horizon_limit + 1):
+            # a model only takes samples of the look_back it was trained on
+            if look_forward_days != look_back:
+                continue
+
+            rnn = RNN(country_code=country_code,
+                      look_forward=look_forward_days,
+                      registry=self.registry)
+            prediction_info, history = rnn.predict(last_day)
+            trend = get_trend_pred(history, look_forward_days)
+
+            rows.append((country_code, look_forward_days,
+                         prediction_info['starting_date'],
+                         prediction_info['prediction_date'],
+                         prediction_info['prediction_new_cases'],
+                         trend))
+
+        return rows
+
+
+FORECASTS = ForecastTable()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Precompute forecasts from the last available date, '
+                    'for countries whose data or model changed.')
+    parser.add_argument('country_codes', nargs='*',
+                        help='all countries with a model if omitted')
+    parser.add_argument('--horizon-limit', type=int, default=HORIZON_LIMIT)
+    parser.add_argument('--force', action='store_true',
+                        help='recompute unchanged countries too')
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(FORECASTS.path), exist_ok=True)
+    refreshed = FORECASTS.refresh(args.horizon_limit,
+                                  args.country_codes or None, args.force)
+    print(f'refreshed {len(refreshed)} countries: {", ".join(refreshed)}')
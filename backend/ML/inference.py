@@ -0,0 +1,270 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'tanh': np.tanh,
+    'relu': lambda x: np.maximum(x, 0),
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+    'hard_sigmoid': lambda x: np.clip(0.2 * x + 0.5, 0, 1),
+}
+
+
+def file_digest(path):
+    """
+        SHA-1 of the content of a file.
+
+        :param      path:   str
+        :return:            str
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def read_model_config(file):
+    """
+        :param      file:   h5py.File of a Keras model
+        :return:            dict
+    """
+    model_config = file.attrs['model_config']
+    if isinstance(model_config, bytes):
+        model_config = model_config.decode('utf-8')
+
+    return json.loads(model_config)
+
+
+def read_input_shape(h5_path):
+    """
+        Input shape of a Keras model, without loading it.
+
+        :param      h5_path:    str
+        :return:                list, without the batch dimension
+    """
+    import h5py
+
+    with h5py.File(h5_path, 'r') as file:
+        layers = read_model_config(file)['config']
+    if isinstance(layers, dict):
+        layers = layers['layers']
+
+    for layer in layers:
+        if 'batch_input_shape' in layer['config']:
+            return list(layer['config']['batch_input_shape'][1:])
+
+    raise ValueError(f'{h5_path} has no input shape')
+
+
+def read_config(npz_path):
+    """
+        Config of exported weights, the weights themselves are not read.
+
+        :param      npz_path:   str
+        :return:                dict, see export_weights()
+    """
+    with np.load(npz_path, allow_pickle=False) as file:
+        return json.loads(str(file['config']))
+
+
+def export_weights(h5_path, npz_path):
+    """
+        Exports the weights of a Keras Sequential model, made of LSTM layers
+            followed by Dense layers, from an .h5 file to an .npz file.
+
+            Only h5py is needed, TensorFlow is not imported. The config
+            records the digest of the .h5 file, which tells whether the
+            weights are still those of the model.
+
+            Raises ValueError for layers that the NumPy engine cannot run.
+
+        :param      h5_path:    str
+        :param      npz_path:   str
+        :return:                dict, config of the exported layers
+    """
+    import h5py
+
+    with h5py.File(h5_path, 'r') as file:
+        model_config = read_model_config(file)
+
+        if model_config['class_name'] != 'Sequential':
+            raise ValueError(f'{model_config["class_name"]} is not supported')
+
+        layers = model_config['config']
+        if isinstance(layers, dict):
+            layers = layers['layers']
+
+        config = {'input_shape': None, 'layers': [],
+                  'source_sha1': file_digest(h5_path)}
+        arrays = {}
+
+        for layer in layers:
+            class_name, layer_config = layer['class_name'], layer['config']
+
+            if class_name == 'InputLayer':
+                config['input_shape'] = layer_config['batch_input_shape'][1:]
+                continue
+
+            if class_name == 'LSTM':
+                exported = {
+                    'class_name': class_name,
+                    'activation': layer_config['activation'],
+                    'recurrent_activation':
+                        layer_config['recurrent_activation'],
+                    'return_sequences': layer_config['return_sequences'],
+                }
+                names = ('kernel', 'recurrent_kernel', 'bias')
+            elif class_name == 'Dense':
+                exported = {
+                    'class_name': class_name,
+                    'activation': layer_config['activation'],
+                }
+                names = ('kernel', 'bias')
+            else:
+                raise ValueError(f'{class_name} layers are not supported')
+
+            if exported['activation'] not in ACTIVATIONS or \
+                    exported.get('recurrent_activation',
+                                 'linear') not in ACTIVATIONS:
+                raise ValueError(f'activations of {layer_config["name"]} '
+                                 f'are not supported')
+
+            if 'batch_input_shape' in layer_config:
+                config['input_shape'] = layer_config['batch_input_shape'][1:]
+
+            # weights are stored in the order of the layer's weight names
+            group = file['model_weights'][layer_config['name']]
+            weight_names = [name.decode('utf-8') if isinstance(name, bytes)
+                            else name
+                            for name in group.attrs['weight_names']]
+            if len(weight_names) != len(names):
+                raise ValueError(f'unexpected weights of '
+                                 f'{layer_config["name"]}')
+
+            index = len(config['layers'])
+            for name, weight_name in zip(names, weight_names):
+                arrays[f'{index}_{name}'] = np.asarray(group[weight_name],
+                                                       dtype=np.float32)
+
+            config['layers'].append(exported)
+
+    np.savez(npz_path, config=np.array(json.dumps(config)), **arrays)
+
+    return config
+
+
+def load_numpy_model(path):
+    """
+        Loads weights exported by export_weights().
+
+        :param      path:   str
+        :return:            NumpyRNN
+    """
+    with np.load(path, allow_pickle=False) as file:
+        config = json.loads(str(file['config']))
+        weights = [{name: file[f'{i}_{name}']
+                    for name in ('kernel', 'recurrent_kernel', 'bias')
+                    if f'{i}_{name}' in file}
+                   for i in range(len(config['layers']))]
+
+    return NumpyRNN(config, weights)
+
+
+class NumpyRNN:
+    def __init__(self, config, weights):
+        """
+            Forward pass of an exported recurrent model in NumPy,
+                a drop-in replacement of keras.Model.predict().
+
+            :param      config:     dict, see export_weights()
+            :param      weights:    list of dicts of numpy.ndarray
+        """
+        self.config = config
+        self.weights = weights
+        self.input_shape = (None,) + tuple(config['input_shape'])
+
+    def predict(self, x):
+        """
+            Shapes:     x:          (B, T, features)
+                        predicted:  (B, units of the last layer)
+
+            :param      x:  numpy.ndarray
+            :return:        numpy.ndarray of numpy.float32
+        """
+        x = np.asarray(x, dtype=np.float32)
+
+        for layer, weights in zip(self.config['layers'], self.weights):
+            if layer['class_name'] == 'LSTM':
+                x = self.lstm(x, layer, **weights)
+            else:
+                activation = ACTIVATIONS[layer['activation']]
+                x = activation(x @ weights['kernel'] + weights['bias'])
+
+        return x.astype(np.float32)
+
+    @staticmethod
+    def lstm(x, layer, kernel, recurrent_kernel, bias):
+        """
+            LSTM with the gates ordered as in Keras: input, forget,
+                cell and output.
+
+            :param      x:  numpy.ndarray, (B, T, features)
+            :return:        numpy.ndarray, (B, units) or (B, T, units)
+        """
+        activation = ACTIVATIONS[layer['activation']]
+        recurrent_activation = ACTIVATIONS[layer['recurrent_activation']]
+
+        batch, steps, _ = x.shape
+        units = recurrent_kernel.shape[0]
+
+        # input projections of all time steps at once
+        projected = x @ kernel + bias
+
+        h = np.zeros((batch, units), dtype=np.float32)
+        c = np.zeros((batch, units), dtype=np.float32)
+        outputs = []
+
+        for step in range(steps):
+            z = projected[:, step] + h @ recurrent_kernel
+
+            i = recurrent_activation(z[:, :units])
+            f = recurrent_activation(z[:, units:2 * units])
+            c = f * c + i * activation(z[:, 2 * units:3 * units])
+            o = recurrent_activation(z[:, 3 * units:])
+            h = o * activation(c)
+
+            outputs.append(h)
+
+        if layer['return_sequences']:
+            return np.stack(outputs, axis=1)
+
+        return h
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from backend.ML.registry import MODELS_DIR, available_models, \
+        model_path, weights_path
+
+    parser = argparse.ArgumentParser(
+        description='Export weights of {country}-RNN.h5 models for the '
+                    'NumPy inference engine.')
+    parser.add_argument('country_codes', nargs='*',
+                        help='all models in the models directory if omitted')
+    parser.add_argument('--models-dir', default=MODELS_DIR)
+    args = parser.parse_args()
+
+    for country_code in args.country_codes or available_models(
+            args.models_dir):
+        path = weights_path(country_code, args.models_dir)
+        # renamed into place, which readers of the directory see at once
+        export_weights(model_path(country_code, args.models_dir),
+                       f'{path}.tmp.npz')
+        os.replace(f'{path}.tmp.npz', path)
+        print(f'exported {path}')
@@ -0,0 +1,276 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+from backend.ML.store import STORE_DIR, VERSIONS_DIR, CURRENT_FILE, \
+    CaseStore, current_version, version_dir, row_keys
+from backend.ML.utils import to_ordinals, from_ordinals
+
+# the only columns read, the names and translations are not
+COLUMNS = ['ISO_2_CODE', 'date_epicrv', 'NewCase']
+WATERMARKS_FILE = 'watermarks.json'
+
+# versions kept besides the published one, for readers still mapping them
+KEEP_VERSIONS = 3
+
+
+def read_export(path):
+    """
+        Reads a WHO export, or a delta file with the same columns,
+            as strings, to be validated.
+
+        :param      path:   str
+        :return:            pandas.core.frame.DataFrame
+    """
+    import pandas as pd
+
+    # 'NA' is Namibia, only empty fields are missing
+    return pd.read_csv(path, usecols=COLUMNS, dtype=str,
+                       keep_default_na=False)
+
+
+def validate(dataframe):
+    """
+        Checks every row at once, and converts the rows to the columns
+            of the store.
+
+        Rows without a country code, e.g. cases on international
+            conveyances, are not ingested. Repeated rows are ingested once.
+
+        Raises ValueError describing every kind of invalid row: country
+            codes that are not two capital letters, dates that cannot be
+            parsed, new cases that are not finite numbers, and a country
+            and date repeated with different new cases.
+
+        :param      dataframe:  pandas.core.frame.DataFrame, see read_export()
+        :return:    codes:      numpy.ndarray, (N, ) str
+                    dates:      numpy.ndarray, (N, ) int32, day ordinals
+                    new_cases:  numpy.ndarray, (N, ) float32
+    """
+    import pandas as pd
+
+    codes = dataframe['ISO_2_CODE']
+    days = pd.to_datetime(dataframe['date_epicrv'].str.slice(0, 10),
+                          format='%Y-%m-%d', errors='coerce')
+    new_cases = pd.to_numeric(dataframe['NewCase'], errors='coerce')
+    ingested = (codes != '').values
+
+    rows = pd.DataFrame({'code': codes, 'day': days, 'new_cases': new_cases})
+    repeated = rows.duplicated(['code', 'day'], keep=False) & \
+        ~rows.duplicated(keep=False)
+
+    invalid = {
+        'invalid country codes': ~codes.str.fullmatch('[A-Z]{2}'),
+        'invalid dates': days.isna(),
+        'invalid new cases': ~np.isfinite(new_cases),
+        'conflicting rows of a country and date': repeated,
+    }
+
+    errors = []
+    for name, mask in invalid.items():
+        mask = mask & ingested
+        if mask.any():
+            # rows are numbered as lines of the file, after its header
+            lines = (np.flatnonzero(mask.values)[:5] + 2).tolist()
+            errors.append(f'{int(mask.sum())} rows with {name}, '
+                          f'at lines {lines}')
+    if errors:
+        raise ValueError('; '.join(errors))
+
+    rows = rows[ingested].drop_duplicates()
+
+    return (rows['code'].values.astype(str),
+            to_ordinals(rows['day'].values.astype('datetime64[D]')),
+            rows['new_cases'].values.astype(np.float32))
+
+
+def gaps(store):
+    """
+        First missing date of every country whose dates are not
+            consecutive, since predictions take the previous rows of a
+            country as the previous days.
+
+        :param      store:  CaseStore
+        :return:            dict, country code -> str, first missing date
+    """
+    steps = np.diff(store.dates)
+    # the first row of a country follows the last row of another one
+    steps[store.offsets[1:-1] - 1] = 1
+    rows = np.flatnonzero(steps != 1)
+
+    codes, first = np.unique(store.rows()[rows], return_index=True)
+    days = from_ordinals(store.dates[rows[first]] + 1)
+
+    return {str(code): str(day) for code, day in zip(codes, days)}
+
+
+def watermarks(store):
+    """
+        Number of rows and last date of each country.
+
+        :param      store:  CaseStore
+        :return:            dict, country code -> dict
+    """
+    counts = np.diff(store.offsets)
+    last_dates = from_ordinals(store.dates[store.offsets[1:] - 1]) \
+        if len(store) else []
+
+    return {str(code): {'rows': int(count), 'last_date': str(last_date)}
+            for code, count, last_date in zip(store.codes, counts,
+                                              last_dates)}
+
+
+def read_watermarks(version, store_dir=STORE_DIR):
+    if version is None:
+        return {}
+
+    with open(f'{version_dir(version, store_dir)}/{WATERMARKS_FILE}') as file:
+        return json.load(file)
+
+
+def publish(store, store_dir=STORE_DIR):
+    """
+        Writes a new version of the store and makes it the current one.
+
+        The version is written to a temporary directory renamed at once,
+            then CURRENT is replaced at once, so readers see either the
+            previous version or the complete new one.
+
+        Raises OSError if another ingestion published the same version
+            first.
+
+        :param      store:      CaseStore, its source is the version name
+        :param      store_dir:  str
+    """
+    directory = version_dir(store.source, store_dir)
+    tmp_dir = f'{directory}.tmp-{os.getpid()}'
+
+    try:
+        store.save(tmp_dir)
+        with open(f'{tmp_dir}/{WATERMARKS_FILE}', 'w') as file:
+            json.dump(watermarks(store), file, indent=2, sort_keys=True)
+        # fails if the directory exists, versions are never overwritten
+        os.rename(tmp_dir, directory)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    tmp_path = f'{store_dir}/{CURRENT_FILE}.tmp-{os.getpid()}'
+    with open(tmp_path, 'w') as file:
+        file.write(store.source)
+    os.replace(tmp_path, f'{store_dir}/{CURRENT_FILE}')
+
+
+def prune(store_dir=STORE_DIR, keep=KEEP_VERSIONS):
+    """
+        Removes the oldest versions, the current one is always kept.
+
+        Workers that still map a removed version keep reading it,
+            until they pick up the current one.
+
+        :param      store_dir:  str
+        :param      keep:       int, previous versions to keep
+    """
+    current = current_version(store_dir)
+    versions = sorted(name for name in os.listdir(f'{store_dir}/'
+                                                  f'{VERSIONS_DIR}')
+                      if name.isdigit() and name != current)
+
+    for name in versions[:max(len(versions) - keep, 0)]:
+        shutil.rmtree(version_dir(name, store_dir), ignore_errors=True)
+
+
+def ingest(path, store_dir=STORE_DIR):
+    """
+        Appends the rows of a WHO export or of a delta file that are not
+            in the current version, and publishes them as a new version.
+
+        The store is append-only: a country and date already stored keeps
+            its new cases, rows that revise them are counted, not applied.
+
+        No version is published if the file is invalid, has no new rows,
+            or has rows of a country that do not follow its last date.
+
+        Raises ValueError for an invalid file, or for the first missing
+            date of every country whose dates would not be consecutive.
+
+        :param      path:       str
+        :param      store_dir:  str
+        :return:                dict, report of the ingestion
+    """
+    codes, dates, new_cases = validate(read_export(path))
+
+    version = current_version(store_dir)
+    if version is None:
+        previous = CaseStore(np.array([], dtype=str),
+                             np.zeros(1, dtype=np.int64),
+                             np.array([], dtype=np.int32),
+                             np.array([], dtype=np.float32))
+    else:
+        previous = CaseStore.load(version_dir(version, store_dir))
+    marks = read_watermarks(version, store_dir)
+
+    previous_codes = previous.rows()
+    all_codes = np.union1d(previous.codes, codes)
+
+    # stored keys are sorted, as rows are by country and date
+    stored = row_keys(previous_codes, previous.dates, all_codes)
+    keys = row_keys(codes, dates, all_codes)
+    positions = np.minimum(np.searchsorted(stored, keys),
+                           max(len(stored) - 1, 0))
+    seen = stored[positions] == keys if len(stored) else \
+        np.zeros(len(keys), dtype=bool)
+    revised = seen & (previous.new_cases[positions] != new_cases) \
+        if len(stored) else seen
+
+    report = {
+        'version': version,
+        'rows': int(len(keys)),
+        'appended': int((~seen).sum()),
+        'seen': int(seen.sum()),
+        'revised': int(revised.sum()),
+        'new_countries': sorted(set(codes[~seen].tolist()) - set(marks)),
+    }
+    if not report['appended']:
+        return report
+
+    number = int(version) + 1 if version is not None else 1
+    store = CaseStore.from_rows(
+        np.concatenate([previous_codes, codes[~seen]]),
+        np.concatenate([previous.dates, dates[~seen]]),
+        np.concatenate([previous.new_cases, new_cases[~seen]]),
+        source=f'{number:06d}')
+
+    missing = gaps(store)
+    if missing:
+        raise ValueError(f'{len(missing)} countries with missing dates, '
+                         f'from {dict(list(missing.items())[:5])}')
+
+    os.makedirs(f'{store_dir}/{VERSIONS_DIR}', exist_ok=True)
+    publish(store, store_dir)
+    prune(store_dir)
+
+    report['version'] = store.source
+
+    return report
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Append the new rows of WHO exports or delta files '
+                    'to the case store, and publish them as a new version.')
+    parser.add_argument('paths', nargs='+',
+                        help='CSV files, ingested in order')
+    parser.add_argument('--store-dir', default=STORE_DIR)
+    args = parser.parse_args()
+
+    for path in args.paths:
+        report = ingest(path, args.store_dir)
+        print(f'{path}: {report["appended"]} rows appended, '
+              f'{report["seen"]} already stored, {report["revised"]} '
+              f'revisions ignored, version {report["version"]}')
+        if report['new_countries']:
+            print(f'new countries: {", ".join(report["new_countries"])}')
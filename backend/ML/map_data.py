@@ -0,0 +1,130 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+from backend.cache import VersionedCache
+from backend.metrics import count_error
+from backend.ML.forecasts import FORECASTS
+from backend.ML.registry import MODELS, available_models
+from backend.ML.service import INFERENCE, QueueFull, predict_survey
+from backend.ML.store import get_case_store
+from backend.ML.utils import from_ordinals
+
+# seconds, longest wait for a turn in a full inference queue
+RETRY_LIMIT = 1
+# turns waited before a country is left without a forecast
+RETRY_ATTEMPTS = 3
+# forecasts of the map queued at once, so that /survey requests are
+# not kept waiting behind all of them
+MAP_CONCURRENCY = 2
+
+
+def data_version(registry=MODELS):
+    """
+        Changes when ingestion publishes a version of the dataset, or a
+            model is trained or exported, which rename their files into
+            the models directory.
+
+        :param      registry:   ModelRegistry
+        :return:                tuple
+    """
+    try:
+        models = os.stat(registry.models_dir).st_mtime_ns
+    except FileNotFoundError:
+        models = None
+
+    return get_case_store().source, models
+
+
+def forecast(country_code, registry, forecasts, last_day):
+    """
+        Forecast of a country from its last available date, read from the
+            forecast table when it is up to date, otherwise submitted to
+            the inference service under the key of the same /survey
+            request, so that both share one prediction.
+
+        Raises QueueFull if the inference queue stays full for
+            RETRY_ATTEMPTS turns.
+
+        :param      country_code:   str
+        :param      registry:       ModelRegistry
+        :param      forecasts:      ForecastTable
+        :param      last_day:       str
+        :return:                    (prediction_info, trend) or
+                                    concurrent.futures.Future of it
+    """
+    # a model only takes samples of the look_back it was trained on
+    look_forward_days = registry.look_back(country_code)
+
+    prediction_info = forecasts.lookup(country_code, look_forward_days,
+                                       last_day)
+    if prediction_info is not None:
+        return prediction_info, prediction_info['trend']
+
+    key = (country_code, look_forward_days, last_day, False)
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return INFERENCE.submit(key, predict_survey, *key)
+        except QueueFull as e:
+            if attempt == RETRY_ATTEMPTS - 1:
+                raise
+            # the map waits its turn rather than fill the queue
+            time.sleep(min(e.retry_after, RETRY_LIMIT))
+
+
+def build_map_data(registry=MODELS, forecasts=FORECASTS):
+    """
+        Latest new cases of every country, and the forecast and the trend
+            of every country with a model, from its last available date.
+
+        Forecasts missing from the forecast table run in the inference
+            service, at most MAP_CONCURRENCY at once. A country whose
+            forecast fails, or does not get a turn in the queue, is left
+            without one, the failure is counted in errors_total.
+
+        :param      registry:   ModelRegistry
+        :param      forecasts:  ForecastTable
+        :return:                dict, JSON serializable
+    """
+    store = get_case_store()
+    models = set(available_models(registry.models_dir))
+
+    countries, pending = {}, {}
+    for country_code in store.countries():
+        dates, new_cases = store.series(country_code)
+        last_day = str(from_ordinals(dates[-1]))
+
+        countries[country_code] = {
+            'date': last_day,
+            'new_cases': int(new_cases[-1]),
+        }
+
+        if country_code in models:
+            running = [result for result in pending.values()
+                       if isinstance(result, Future) and not result.done()]
+            if len(running) >= MAP_CONCURRENCY:
+                wait(running, return_when=FIRST_COMPLETED)
+
+            try:
+                pending[country_code] = forecast(country_code, registry,
+                                                 forecasts, last_day)
+            except Exception as e:
+                count_error('/map-data', e)
+
+    for country_code, result in pending.items():
+        try:
+            prediction_info, trend = result.result() \
+                if isinstance(result, Future) else result
+        except Exception as e:
+            count_error('/map-data', e)
+            continue
+
+        countries[country_code].update(
+            forecast_date=str(prediction_info['prediction_date']),
+            forecast_new_cases=int(prediction_info['prediction_new_cases']),
+            trend=trend)
+
+    return {'countries': countries}
+
+
+MAP_DATA = VersionedCache(data_version, build_map_data)
@@ -0,0 +1,337 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+from backend.ML.inference import file_digest, load_numpy_model, \
+    read_config, read_input_shape
+
+MODELS_DIR = f'{os.path.dirname(__file__)}/models'
+MODEL_SUFFIX = '-RNN.h5'
+WEIGHTS_SUFFIX = '-RNN.npz'
+CAPACITY = int(os.environ.get('MODEL_REGISTRY_CAPACITY', 32))
+
+# 'numpy' runs exported weights and falls back to 'keras'
+# for models that have not been exported
+ENGINE = os.environ.get('INFERENCE_ENGINE', 'numpy')
+
+
+def model_path(country_code, models_dir=MODELS_DIR):
+    """
+        Builds a path to a serialized model of a country.
+
+        :param      country_code:   str
+        :param      models_dir:     str
+        :return:                    str
+    """
+    return f'{models_dir}/{country_code}{MODEL_SUFFIX}'
+
+
+def weights_path(country_code, models_dir=MODELS_DIR):
+    """
+        Builds a path to exported weights of a country's model.
+
+        :param      country_code:   str
+        :param      models_dir:     str
+        :return:                    str
+    """
+    return f'{models_dir}/{country_code}{WEIGHTS_SUFFIX}'
+
+
+def available_models(models_dir=MODELS_DIR):
+    """
+        Lists country codes that have a serialized model.
+
+        :param      models_dir:     str
+        :return:                    list
+    """
+    if not os.path.isdir(models_dir):
+        return []
+
+    return sorted({name[:-len(suffix)]
+                   for name in os.listdir(models_dir)
+                   for suffix in (MODEL_SUFFIX, WEIGHTS_SUFFIX)
+                   if name.endswith(suffix)})
+
+
+def load_keras_model(path):
+    """
+        Deserializes a Keras model from an .h5 file.
+
+        :param      path:   str
+        :return:            tensorflow.keras.Model
+    """
+    from tensorflow import keras
+
+    return keras.models.load_model(path)
+
+
+def load_model(path):
+    """
+        Loads exported weights with the NumPy engine,
+            any other file with Keras.
+
+        :param      path:   str
+        :return:            model
+    """
+    if path.endswith(WEIGHTS_SUFFIX):
+        return load_numpy_model(path)
+
+    return load_keras_model(path)
+
+
+class ModelRegistry:
+    def __init__(self, loader=load_model, capacity=CAPACITY,
+                 models_dir=MODELS_DIR, engine=ENGINE):
+        """
+            Process-wide cache of deserialized models, one per country.
+
+            Models are kept in least recently used order and the oldest one
+                is dropped when the capacity is exceeded. A model is loaded
+                again when the modification time of its file changes.
+
+            Models are loaded outside the lock, so a load does not hold up
+                requests for other countries; requests for a model being
+                loaded wait for that load instead of starting another.
+
+            :param      loader:         callable, path -> model
+            :param      capacity:       int
+            :param      models_dir:     str
+            :param      engine:         str, 'numpy' or 'keras'
+        """
+        self.loader = loader
+        self.capacity = capacity
+        self.models_dir = models_dir
+        self.engine = engine
+
+        self._models = OrderedDict()
+        # country code -> (version, Future) of a load in progress
+        self._loading = {}
+        # path -> (version, value) of small reads, see read()
+        self._files = {}
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.waits = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+
+    def path(self, country_code):
+        """
+            File of a country's model for the engine of the registry.
+
+            :param      country_code:   str
+            :return:                    str
+        """
+        try:
+            return self.locate(country_code)[0]
+        except FileNotFoundError:
+            return model_path(country_code, self.models_dir)
+
+    def locate(self, country_code):
+        """
+            File of a country's model for the engine of the registry,
+                and its stat.
+
+            The NumPy engine runs exported weights only while they were
+                exported from the current Keras model, by the digest of the
+                .h5 file recorded in them, so that copies that reorder
+                modification times do not matter. A retrained model is run
+                by Keras until it is exported again.
+
+            Raises OSError if the country has no serialized model.
+
+            :param      country_code:   str
+            :return:                    (str, os.stat_result)
+        """
+        path = model_path(country_code, self.models_dir)
+
+        if self.engine == 'numpy':
+            npz_path = weights_path(country_code, self.models_dir)
+            try:
+                exported = os.stat(npz_path)
+            except FileNotFoundError:
+                return path, os.stat(path)
+
+            try:
+                trained = os.stat(path)
+            except FileNotFoundError:
+                return npz_path, exported
+
+            config = self.read(npz_path, exported, read_config)
+            if config.get('source_sha1') == self.digest(path, trained):
+                return npz_path, exported
+
+            return path, trained
+
+        return path, os.stat(path)
+
+    def read(self, path, stat, reader):
+        """
+            Reads a file once per version, the version being its inode,
+                size and modification time.
+
+            :param      path:   str
+            :param      stat:   os.stat_result of the file
+            :param      reader: callable, path -> value
+            :return:            value
+        """
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+        cached = self._files.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        value = reader(path)
+        with self._lock:
+            self._files[path] = (key, value)
+
+        return value
+
+    def digest(self, path, stat):
+        """
+            SHA-1 digest of a model's file, computed once per version.
+
+            :param      path:   str
+            :param      stat:   os.stat_result of the file
+            :return:            str
+        """
+        return self.read(f'{path}#sha1', stat,
+                         lambda _: file_digest(path))
+
+    def look_back(self, country_code):
+        """
+            Look back of a country's model, read from its exported config
+                or from the config of its .h5 file, the model is not loaded.
+
+            Raises OSError if the country has no serialized model.
+
+            :param      country_code:   str
+            :return:                    int
+        """
+        path, stat = self.locate(country_code)
+
+        if path.endswith(WEIGHTS_SUFFIX):
+            input_shape = self.read(path, stat, read_config)['input_shape']
+        else:
+            input_shape = self.read(f'{path}#input_shape', stat,
+                                    lambda _: read_input_shape(path))
+
+        return int(input_shape[-1])
+
+    def get(self, country_code):
+        """
+            Returns a shared model of a country, loading it if needed.
+
+            Raises OSError if the country has no serialized model.
+
+            :param      country_code:   str
+            :return:                    model
+        """
+        path, stat = self.locate(country_code)
+        version = (path, stat.st_mtime_ns)
+
+        with self._lock:
+            cached = self._models.get(country_code)
+            if cached is not None and cached[0] == version:
+                self._models.move_to_end(country_code)
+                self.hits += 1
+                return cached[1]
+
+            loading = self._loading.get(country_code)
+            if loading is not None and loading[0] == version:
+                self.waits += 1
+                future = loading[1]
+            else:
+                if cached is None:
+                    self.misses += 1
+                else:
+                    self.reloads += 1
+                future = None
+                loading = self._loading[country_code] = (version, Future())
+
+        if future is not None:
+            return future.result()
+
+        started = time.perf_counter()
+        try:
+            model = self.loader(path)
+        except BaseException as e:
+            with self._lock:
+                if self._loading.get(country_code) is loading:
+                    del self._loading[country_code]
+            loading[1].set_exception(e)
+            raise
+
+        with self._lock:
+            self.load_seconds += time.perf_counter() - started
+
+            self._models[country_code] = (version, model)
+            self._models.move_to_end(country_code)
+
+            while len(self._models) > self.capacity:
+                self._models.popitem(last=False)
+                self.evictions += 1
+
+            if self._loading.get(country_code) is loading:
+                del self._loading[country_code]
+
+        loading[1].set_result(model)
+
+        return model
+
+    def preload(self, country_codes=None):
+        """
+            Loads and warms up models ahead of the first request.
+
+            By default all serialized models found in models_dir are loaded,
+                up to the capacity of the registry.
+
+            :param      country_codes:  list or None
+            :return:                    list of loaded country codes
+        """
+        if country_codes is None:
+            country_codes = available_models(self.models_dir)
+
+        loaded = []
+        for country_code in country_codes[:self.capacity]:
+            model = self.get(country_code)
+
+            # the first prediction builds the graph of a model
+            sample = np.zeros((1,) + tuple(model.input_shape[1:]),
+                              dtype=np.float32)
+            model.predict(sample)
+            loaded.append(country_code)
+
+        return loaded
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+    def stats(self):
+        """
+            Counters of the registry.
+
+            :return:    dict
+        """
+        with self._lock:
+            return {
+                'size': len(self._models),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'reloads': self.reloads,
+                'waits': self.waits,
+                'evictions': self.evictions,
+                'load_seconds': round(self.load_seconds, 6),
+                'engine': self.engine,
+            }
+
+
+MODELS = ModelRegistry()
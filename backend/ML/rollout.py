@@ -0,0 +1,58 @@
+from collections import namedtuple
+
+import numpy as np
+
+# dates:    (steps, ) int32 day ordinals of the predictions
+# values:   (steps, ) float32 predicted values
+Forecast = namedtuple('Forecast', ['dates', 'values'])
+
+
+def rollout(model, windows, steps, noise=None):
+    """
+        Autoregressive forecast of a batch of series.
+
+            Each step predicts x(t+1) from | x(t-k) | ... | x(t) |,
+            where k is look_back-1, and the prediction becomes x(t) of the
+            next step.
+
+            With noise, noise[:, step] is added to the predictions of each
+            step before they are fed back, which simulates paths of the
+            series for a residual bootstrap.
+
+            The last look_back values of each series are kept in a ring
+            buffer, so every step does the same amount of work no matter
+            how long the history or the horizon is.
+
+        Shapes:     windows:    (B, look_back)
+                    noise:      (B, steps)
+                    predicted:  (B, steps)
+
+        :param      model:      object with predict((B, 1, look_back))
+        :param      windows:    numpy.ndarray
+        :param      steps:      int
+        :param      noise:      numpy.ndarray or None
+        :return:                numpy.ndarray
+    """
+
+    batch, look_back = windows.shape
+
+    ring = np.array(windows, dtype=np.float32)
+    predicted = np.empty((batch, steps), dtype=np.float32)
+
+    # positions in the ring from the oldest to the newest value
+    order = np.arange(look_back)
+    head = 0
+
+    for step in range(steps):
+        sample = ring[:, (head + order) % look_back]
+        sample = sample.reshape(batch, 1, look_back)
+
+        predicted[:, step] = np.reshape(model.predict(sample), (batch,))
+        if noise is not None:
+            predicted[:, step] += noise[:, step]
+
+        # the oldest value is replaced by the prediction
+        ring[:, head] = predicted[:, step]
+        head = (head + 1) % look_back
+
+    return predicted
@@ -0,0 +1,160 @@
+import contextvars
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backend.metrics import record
+from backend.ML.PolyReg import get_trend_pred
+from backend.ML.RNN import RNN
+
+WORKERS = int(os.environ.get('INFERENCE_WORKERS', min(os.cpu_count() or 1, 4)))
+QUEUE_LIMIT = int(os.environ.get('INFERENCE_QUEUE_LIMIT', 64))
+
+
+def predict_survey(country_code, look_forward_days, requested_day,
+                   intervals=False):
+    """
+        Live prediction of /survey.
+
+        :param      country_code:       str
+        :param      look_forward_days:  int
+        :param      requested_day:      str
+        :param      intervals:          bool, adds prediction intervals
+        :return:    prediction_info:    dict
+                    trend:              str
+    """
+    rnn = RNN(country_code=country_code, look_forward=look_forward_days)
+
+    prediction_info, samples = rnn.predict(requested_day)
+    trend = get_trend_pred(samples, look_forward_days)
+
+    if intervals:
+        prediction_info['intervals'] = rnn.predict_intervals(requested_day)
+
+    return prediction_info, trend
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after):
+        """
+            :param      retry_after:    int, seconds
+        """
+        super().__init__(f'inference queue is full, '
+                         f'retry after {retry_after} seconds')
+        self.retry_after = retry_after
+
+
+class InferenceService:
+    def __init__(self, workers=WORKERS, queue_limit=QUEUE_LIMIT):
+        """
+            Runs predictions in a bounded pool of worker threads.
+
+            Requests with the same key that arrive while a computation of
+                that key is queued or running share its result.
+
+            Raises QueueFull instead of queueing more than queue_limit
+                computations that have not started yet.
+
+            :param      workers:        int
+            :param      queue_limit:    int
+        """
+        self.workers = workers
+        self.queue_limit = queue_limit
+
+        self._executor = ThreadPoolExecutor(workers,
+                                            thread_name_prefix='inference')
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+        self._queued = 0
+        self._running = 0
+        self._submitted = 0
+        self._coalesced = 0
+        self._rejected = 0
+        self._completed = 0
+        self._wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+        self._service_seconds = 0.0
+
+    def submit(self, key, function, *args):
+        """
+            :param      key:        hashable, identifies duplicate requests
+            :param      function:   callable
+            :return:                concurrent.futures.Future
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self._coalesced += 1
+                return future
+
+            if self._queued >= self.queue_limit:
+                self._rejected += 1
+                raise QueueFull(self._retry_after())
+
+            self._queued += 1
+            self._submitted += 1
+            # registered before the lock is released, so the computation
+            # cannot finish and unregister before it is registered;
+            # it runs in the context of the request, which collects
+            # the timings of its stages
+            future = self._executor.submit(contextvars.copy_context().run,
+                                           self._run, key, time.monotonic(),
+                                           function, args)
+            self._in_flight[key] = future
+
+        return future
+
+    def _run(self, key, submitted, function, args):
+        started = time.monotonic()
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            wait = started - submitted
+            self._wait_seconds += wait
+            self._max_wait_seconds = max(self._max_wait_seconds, wait)
+        record('queue_wait', wait)
+
+        try:
+            return function(*args)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+                self._service_seconds += time.monotonic() - started
+                del self._in_flight[key]
+
+    def _retry_after(self):
+        # time for the workers to go through the queue, at the mean
+        # service time so far
+        mean = self._service_seconds / self._completed \
+            if self._completed else 1
+        return max(1, math.ceil((self._queued / self.workers + 1) * mean))
+
+    def stats(self):
+        """
+            :return:    dict
+        """
+        with self._lock:
+            started = self._submitted - self._queued
+            return {
+                'workers': self.workers,
+                'queue_limit': self.queue_limit,
+                'queue_depth': self._queued,
+                'running': self._running,
+                'submitted': self._submitted,
+                'coalesced': self._coalesced,
+                'rejected': self._rejected,
+                'completed': self._completed,
+                'mean_wait_seconds':
+                    self._wait_seconds / started if started else 0.0,
+                'max_wait_seconds': self._max_wait_seconds,
+                'mean_service_seconds':
+                    self._service_seconds / self._completed
+                    if self._completed else 0.0,
+            }
+
+
+INFERENCE = InferenceService()
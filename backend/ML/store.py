@@ -0,0 +1,328 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+from backend.ML.utils import DATASET_DIR, FILENAME, load_data, to_ordinals, \
+    fit_scaler
+
+CACHE_DIR = f'{DATASET_DIR}/.cache/{os.path.splitext(FILENAME)[0]}'
+ARRAYS = ('codes', 'offsets', 'dates', 'new_cases')
+SOURCE_FILE = 'source.json'
+
+# changed whenever stores are built differently from the CSV file,
+# so that binary caches are rebuilt
+FORMAT = 2
+
+# versions of the store published by backend.ML.ingest, used instead of
+# the CSV file once CURRENT names one of them
+STORE_DIR = os.environ.get('CASE_STORE_DIR', f'{DATASET_DIR}/store')
+VERSIONS_DIR = 'versions'
+CURRENT_FILE = 'CURRENT'
+
+
+def fingerprint(path):
+    """
+        Identifies a version of a source file by its size and
+            modification time.
+
+        :param      path:   str
+        :return:            str
+    """
+    stat = os.stat(path)
+
+    return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+
+def csv_source(path):
+    """
+        Source of a store built from a CSV file.
+
+        :param      path:   str
+        :return:            str
+    """
+    return f'{fingerprint(path)}-{FORMAT}'
+
+
+def row_keys(codes, dates, all_codes):
+    """
+        One sortable integer per country and date.
+
+        :param      codes:      numpy.ndarray, (N, ) str
+        :param      dates:      numpy.ndarray, (N, ) int32
+        :param      all_codes:  numpy.ndarray, sorted codes of every row
+        :return:                numpy.ndarray, (N, ) int64
+    """
+    index = np.searchsorted(all_codes, codes).astype(np.int64)
+
+    return (index << 32) | dates.astype(np.int64)
+
+
+class CaseStore:
+    def __init__(self, codes, offsets, dates, new_cases, source=None):
+        """
+            Columnar store of new COVID-19 cases partitioned by
+                country_region_code.
+
+            Rows of a country are contiguous and sorted by date,
+                the partition of codes[i] is offsets[i]:offsets[i + 1].
+
+            Shapes: C is the number of countries, N the number of rows.
+                codes       (C, )       str
+                offsets     (C + 1, )   int64
+                dates       (N, )       int32, day ordinals
+                new_cases   (N, )       float32
+
+            :param      source:     str, fingerprint of the source file
+        """
+        self.codes = codes
+        self.offsets = offsets
+        self.dates = dates
+        self.new_cases = new_cases
+        self.source = source
+
+        self._index = {str(code): (int(offsets[i]), int(offsets[i + 1]))
+                       for i, code in enumerate(codes)}
+        self._positions = {}
+        self._scalers = {}
+
+    def __contains__(self, country_code):
+        return country_code in self._index
+
+    def __len__(self):
+        return len(self.dates)
+
+    def countries(self):
+        return list(self._index)
+
+    def series(self, country_code):
+        """
+            Dates and new cases of a country, as read-only views.
+
+            Raises KeyError for an unknown country.
+
+            :param      country_code:   str
+            :return:    dates:          numpy.ndarray, (N, ) int32
+                        new_cases:      numpy.ndarray, (N, ) float32
+        """
+        start, end = self._index[country_code]
+
+        return self.dates[start:end], self.new_cases[start:end]
+
+    def scaler(self, country_code):
+        """
+            Scaling of new cases of a country, fitted on first use.
+
+            :param      country_code:   str
+            :return:                    Scaler
+        """
+        scaler = self._scalers.get(country_code)
+        if scaler is None:
+            _, new_cases = self.series(country_code)
+            scaler = fit_scaler(new_cases)
+            self._scalers[country_code] = scaler
+
+        return scaler
+
+    def locate(self, country_code, date):
+        """
+            Position of a date within the series of a country.
+
+            The date to position map of a country is built on first use.
+
+            :param      country_code:   str
+            :param      date:           int, day ordinal
+            :return:                    int, -1 if the date is not found
+        """
+        positions = self._positions.get(country_code)
+        if positions is None:
+            dates, _ = self.series(country_code)
+            positions = dict(zip(dates.tolist(), range(len(dates))))
+            self._positions[country_code] = positions
+
+        return positions.get(date, -1)
+
+    @classmethod
+    def from_dataframe(cls, dataframe, source=None):
+        """
+            Builds a store from the raw WHO columns (see utils.COLNAMES).
+
+            :param      dataframe:  pandas.core.frame.DataFrame
+            :param      source:     str
+            :return:                CaseStore
+        """
+        dataframe = dataframe.dropna(subset=['ISO_2_CODE'])
+
+        codes = dataframe['ISO_2_CODE'].values.astype(str)
+        days = dataframe['date_epicrv'].values.astype(str)
+        dates = to_ordinals(np.char.partition(days, 'T')[:, 0])
+        new_cases = dataframe['NewCase'].values.astype(np.float32)
+
+        return cls.from_rows(codes, dates, new_cases, source=source)
+
+    @classmethod
+    def from_rows(cls, codes, dates, new_cases, source=None):
+        """
+            Builds a store from rows in any order.
+
+            :param      codes:      numpy.ndarray, (N, ) str
+            :param      dates:      numpy.ndarray, (N, ) int32, day ordinals
+            :param      new_cases:  numpy.ndarray, (N, ) float32
+            :param      source:     str
+            :return:                CaseStore
+        """
+        # group countries together, keeping dates in order
+        order = np.lexsort((dates, codes))
+        codes, dates, new_cases = codes[order], dates[order], new_cases[order]
+
+        unique_codes, starts = np.unique(codes, return_index=True)
+        offsets = np.append(starts, len(codes)).astype(np.int64)
+
+        return cls(unique_codes, offsets, dates, new_cases, source=source)
+
+    def rows(self):
+        """
+            Country code of every row.
+
+            :return:    numpy.ndarray, (N, ) str
+        """
+        return np.repeat(self.codes, np.diff(self.offsets))
+
+    @classmethod
+    def from_csv(cls, path=f'{DATASET_DIR}/{FILENAME}'):
+        return cls.from_dataframe(load_data(path), source=csv_source(path))
+
+    def save(self, directory=CACHE_DIR):
+        """
+            Writes the arrays as .npy files, so they can be memory-mapped.
+
+            The source file is written last and marks the cache as complete.
+
+            :param      directory:  str
+        """
+        os.makedirs(directory, exist_ok=True)
+
+        for name in ARRAYS:
+            tmp_path = f'{directory}/{name}.tmp.npy'
+            np.save(tmp_path, getattr(self, name))
+            os.replace(tmp_path, f'{directory}/{name}.npy')
+
+        tmp_path = f'{directory}/{SOURCE_FILE}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump({'source': self.source}, file)
+        os.replace(tmp_path, f'{directory}/{SOURCE_FILE}')
+
+    @classmethod
+    def load(cls, directory=CACHE_DIR, mmap_mode='r'):
+        """
+            Loads a store written by save().
+
+            Raises OSError if the cache does not exist.
+
+            :param      directory:  str
+            :param      mmap_mode:  str or None
+            :return:                CaseStore
+        """
+        with open(f'{directory}/{SOURCE_FILE}') as file:
+            source = json.load(file)['source']
+
+        arrays = [np.load(f'{directory}/{name}.npy', mmap_mode=mmap_mode)
+                  for name in ARRAYS]
+
+        return cls(*arrays, source=source)
+
+
+def version_dir(version, store_dir=STORE_DIR):
+    return f'{store_dir}/{VERSIONS_DIR}/{version}'
+
+
+# store directory -> (stat of CURRENT, version)
+_CURRENT = {}
+
+
+def current_version(store_dir=STORE_DIR):
+    """
+        Name of the published version of the store.
+
+        CURRENT is replaced, never rewritten, on publishing, so it is
+            read again only when its inode or modification time changes,
+            other calls cost a stat.
+
+        :param      store_dir:  str
+        :return:                str or None if no version was published
+    """
+    path = f'{store_dir}/{CURRENT_FILE}'
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    cached = _CURRENT.get(store_dir)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    try:
+        with open(path) as file:
+            version = file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+    _CURRENT[store_dir] = (key, version)
+
+    return version
+
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+
+def get_case_store(path=f'{DATASET_DIR}/{FILENAME}', cache_dir=CACHE_DIR,
+                   store_dir=STORE_DIR):
+    """
+        Returns the process-wide case store.
+
+        The published version of the ingested store is memory-mapped,
+            and replaced as soon as a new version is published, without
+            a restart.
+
+        Without ingested versions, the store is read from the binary cache,
+            which is rebuilt from the CSV file only when the CSV file
+            changes.
+
+        :param      path:       str
+        :param      cache_dir:  str
+        :param      store_dir:  str
+        :return:                CaseStore
+    """
+    global _STORE
+
+    version = current_version(store_dir)
+    source = version if version is not None else csv_source(path)
+    store = _STORE
+    if store is not None and store.source == source:
+        return store
+
+    with _STORE_LOCK:
+        if _STORE is not None and _STORE.source == source:
+            return _STORE
+
+        if version is not None:
+            # versions are immutable, and complete once published
+            _STORE = CaseStore.load(version_dir(version, store_dir))
+            return _STORE
+
+        try:
+            store = CaseStore.load(cache_dir)
+        except (OSError, ValueError, KeyError):
+            store = None
+
+        if store is None or store.source != source:
+            store = CaseStore.from_csv(path)
+            store.save(cache_dir)
+
+        _STORE = store
+
+        return store
@@ -0,0 +1,322 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime as dt
+
+import numpy as np
+
+from backend.ML.inference import export_weights
+from backend.ML.registry import MODELS_DIR, model_path, weights_path
+from backend.ML.utils import DATASET_DIR, FILENAME, load_data, preprocess, \
+    filter_by_country, separate, fit_scaler, normalize, denormalize, \
+    apply_lookback, reshape
+
+MANIFEST_FILE = 'manifest.json'
+
+HYPERPARAMETERS = {
+    'look_back': 3,
+    'units': 4,
+    'epochs': 100,
+    'batch_size': 1,
+    # share of the samples, the last ones, used for validation
+    'validation_split': 0.33,
+    # after validation, the saved model is fit again on every sample,
+    # forecasts start from the last available date
+    'refit': True,
+    'seed': 7,
+}
+
+# countries with fewer training samples are skipped
+MIN_SAMPLES = 10
+
+
+def use_cpu_only():
+    """
+        Hides GPUs from TensorFlow, must run before TensorFlow is
+            initialized to take effect.
+    """
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+    import tensorflow as tf
+    try:
+        tf.config.set_visible_devices([], 'GPU')
+    except (RuntimeError, ValueError):
+        pass  # devices were initialized already, or there are none
+
+
+def init_worker():
+    use_cpu_only()
+
+    import tensorflow as tf
+
+    # one thread per process, processes run in parallel
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def load_series(path=f'{DATASET_DIR}/{FILENAME}', country_codes=None):
+    """
+        Dates and new cases of every country in the dataset.
+
+        :param      path:           str
+        :param      country_codes:  list or None, all countries by default
+        :return:                    dict, country code -> (dates, values)
+    """
+    dataframe = preprocess(load_data(path))
+
+    if country_codes is None:
+        country_codes = sorted(dataframe['country_region_code']
+                               .dropna().unique())
+
+    series = {}
+    for country_code in country_codes:
+        filtered_df = filter_by_country(dataframe, country_code).copy()
+        if len(filtered_df):
+            series[country_code] = separate(filtered_df)
+
+    return series
+
+
+def content_hash(dates, values, hyperparameters):
+    """
+        Hash of the data and the hyperparameters a model is trained with.
+
+        :param      dates:              numpy.ndarray, (N, 1) str
+        :param      values:             numpy.ndarray, (N, 1) float32
+        :param      hyperparameters:    dict
+        :return:                        str
+    """
+    digest = hashlib.sha1(json.dumps(hyperparameters,
+                                     sort_keys=True).encode())
+    digest.update('\n'.join(dates[:, 0].astype(str)).encode())
+    digest.update(np.ascontiguousarray(values, dtype=np.float32).tobytes())
+
+    return digest.hexdigest()
+
+
+def fit_model(X, Y, hyperparameters):
+    """
+        Fits a new model, the same samples and hyperparameters give the
+            same model.
+
+        :param      X:                  numpy.ndarray, (N, look_back)
+        :param      Y:                  numpy.ndarray, (N, )
+        :param      hyperparameters:    dict
+        :return:                        tensorflow.keras.Model
+    """
+    from tensorflow import keras
+    import tensorflow as tf
+
+    np.random.seed(hyperparameters['seed'])
+    tf.random.set_seed(hyperparameters['seed'])
+
+    model = keras.Sequential([
+        keras.layers.LSTM(hyperparameters['units'],
+                          input_shape=(1, hyperparameters['look_back'])),
+        keras.layers.Dense(1),
+    ])
+    model.compile(loss='mean_squared_error', optimizer='adam')
+
+    model.fit(reshape(X), Y, epochs=hyperparameters['epochs'],
+              batch_size=hyperparameters['batch_size'], verbose=0)
+
+    return model
+
+
+def train_country(country_code, dates, values, hyperparameters,
+                  models_dir=MODELS_DIR):
+    """
+        Trains the model of a country and saves it, with its weights
+            exported for the NumPy inference engine.
+
+        The model is validated on the last samples, then, with refit,
+            the saved model is fit again on every sample.
+
+        Raises ValueError if the country has too few samples.
+
+        :param      country_code:       str
+        :param      dates:              numpy.ndarray, (N, 1) str
+        :param      values:             numpy.ndarray, (N, 1) float32
+        :param      hyperparameters:    dict
+        :param      models_dir:         str
+        :return:                        dict, entry of the manifest
+    """
+    look_back = hyperparameters['look_back']
+
+    scaler = fit_scaler(values[:, 0])
+    dataset = normalize(values, scaler)
+
+    X, Y = apply_lookback(dataset, look_back)
+
+    validation_size = int(len(X) * hyperparameters['validation_split'])
+    train_size = len(X) - validation_size
+    if train_size < MIN_SAMPLES or validation_size == 0:
+        raise ValueError(f'not enough data for {country_code}')
+
+    started = time.perf_counter()
+    model = fit_model(X[:train_size], Y[:train_size], hyperparameters)
+
+    # error in numbers of new cases
+    predicted = model.predict(reshape(X[train_size:]), verbose=0)[:, 0]
+    error = denormalize(predicted, scaler) - denormalize(Y[train_size:],
+                                                         scaler)
+    validation_rmse = float(np.sqrt(np.mean(np.square(error))))
+
+    if hyperparameters['refit']:
+        model = fit_model(X, Y, hyperparameters)
+    training_seconds = time.perf_counter() - started
+
+    # replaced at once, so a running app never reads a partial model
+    os.makedirs(models_dir, exist_ok=True)
+    path = model_path(country_code, models_dir)
+    tmp_path = f'{path}.tmp.h5'
+    try:
+        model.save(tmp_path)
+        export_weights(tmp_path, f'{tmp_path}.npz')
+        os.replace(f'{tmp_path}.npz', weights_path(country_code, models_dir))
+        os.replace(tmp_path, path)
+    finally:
+        for leftover in (tmp_path, f'{tmp_path}.npz'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    return {
+        'trained_at': dt.utcnow().isoformat(timespec='seconds'),
+        'training_seconds': round(training_seconds, 3),
+        'validation_rmse': validation_rmse,
+        # samples the validated model was fit on
+        'validation_train_samples': train_size,
+        'validation_samples': validation_size,
+        # samples the saved model was fit on
+        'train_samples': len(X) if hyperparameters['refit'] else train_size,
+        'last_date': str(dates[-1, 0]),
+    }
+
+
+def read_manifest(models_dir=MODELS_DIR):
+    try:
+        with open(f'{models_dir}/{MANIFEST_FILE}') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_manifest(manifest, models_dir=MODELS_DIR):
+    path = f'{models_dir}/{MANIFEST_FILE}'
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(f'{path}.tmp', path)
+
+
+def train_models(country_codes=None, hyperparameters=None,
+                 models_dir=MODELS_DIR, path=f'{DATASET_DIR}/{FILENAME}',
+                 workers=None, force=False):
+    """
+        Trains the models of many countries in parallel processes,
+            on CPU only.
+
+        A country is skipped if its model was trained on the same data
+            with the same hyperparameters, according to the manifest.
+            The manifest is updated as each model is saved.
+
+        A country that fails, e.g. for too few samples or a model that
+            cannot be written, is reported and the others are trained.
+
+        :param      country_codes:      list or None, all countries by default
+        :param      hyperparameters:    dict or None, see HYPERPARAMETERS
+        :param      models_dir:         str
+        :param      path:               str, WHO dataset
+        :param      workers:            int or None, number of CPUs by
+                                        default, 1 trains in this process
+        :param      force:              bool, retrain unchanged countries
+        :return:    trained:            list of country codes
+                    failed:             dict, country code -> error
+                                        message
+    """
+    hyperparameters = dict(HYPERPARAMETERS, **(hyperparameters or {}))
+    workers = workers or os.cpu_count() or 1
+
+    series = load_series(path, country_codes)
+    manifest = read_manifest(models_dir)
+
+    jobs = {}
+    for country_code, (dates, values) in series.items():
+        data_hash = content_hash(dates, values, hyperparameters)
+        entry = manifest.get(country_code, {})
+        if not force and entry.get('content_hash') == data_hash and \
+                os.path.exists(model_path(country_code, models_dir)):
+            continue
+        jobs[country_code] = data_hash
+
+    trained, failed = [], {}
+
+    def record(country_code, entry):
+        entry.update(content_hash=jobs[country_code],
+                     hyperparameters=hyperparameters)
+        manifest[country_code] = entry
+        write_manifest(manifest, models_dir)
+        trained.append(country_code)
+
+    if workers == 1:
+        use_cpu_only()
+        for country_code in jobs:
+            try:
+                record(country_code, train_country(
+                    country_code, *series[country_code], hyperparameters,
+                    models_dir))
+            except Exception as e:
+                failed[country_code] = f'{type(e).__name__}: {e}'
+        return trained, failed
+
+    # TensorFlow is not fork safe, workers start fresh interpreters
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers, mp_context=context,
+                             initializer=init_worker) as executor:
+        futures = {executor.submit(train_country, country_code,
+                                   *series[country_code], hyperparameters,
+                                   models_dir): country_code
+                   for country_code in jobs}
+
+        for future in as_completed(futures):
+            country_code = futures[future]
+            try:
+                record(country_code, future.result())
+            except Exception as e:
+                failed[country_code] = f'{type(e).__name__}: {e}'
+
+    return trained, failed
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Train {country}-RNN.h5 models in parallel on CPU, '
+                    'for countries whose data or hyperparameters changed.')
+    parser.add_argument('country_codes', nargs='*',
+                        help='all countries in the dataset if omitted')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes, all CPUs by default')
+    parser.add_argument('--models-dir', default=MODELS_DIR)
+    parser.add_argument('--force', action='store_true',
+                        help='retrain unchanged countries too')
+    for name, default in HYPERPARAMETERS.items():
+        if isinstance(default, bool):
+            parser.add_argument(f'--no-{name.replace("_", "-")}',
+                                dest=name, action='store_false')
+            continue
+        parser.add_argument(f'--{name.replace("_", "-")}',
+                            type=type(default), default=default)
+    args = parser.parse_args()
+
+    trained, failed = train_models(
+        args.country_codes or None,
+        {name: getattr(args, name) for name in HYPERPARAMETERS},
+        args.models_dir, workers=args.workers, force=args.force)
+
+    print(f'trained {len(trained)} models: {", ".join(trained)}')
+    for country_code, error in failed.items():
+        print(f'failed {country_code}: {error}')
@@ -1,9 +1,12 @@
 import os
-from datetime import datetime as dt, timedelta
+from collections import namedtuple
+from datetime import datetime as dt
 
 import numpy as np
-import pandas as pd
-from sklearn.preprocessing import MinMaxScaler
+from numpy.lib.stride_tricks import sliding_window_view
+
+# pandas is imported by the functions that read the CSV file only, since
+# predictions run on the case store and do not need it
 
 COLNAMES = ['ISO_2_CODE', 'ADM0_NAME', 'date_epicrv',
             'NewCase', 'CumCase', 'NewDeath',
@@ -13,20 +16,35 @@ NEW_COLUMN_NAMES = ['country_region_code', 'country_region', 'date',
 DATASET_DIR = f'{os.path.dirname(__file__)}/../datasets'
 FILENAME = 'who_cases_deaths.csv'
 DATE_FORMAT = '%Y-%m-%d'
+EPOCH_ORDINAL = dt(1970, 1, 1).toordinal()
 
 np.random.seed(7)
-SCALER = MinMaxScaler(feature_range=(0, 1))
 
+# dates:    (N, ) int32 day ordinals
+# values:   (N, ) float32 values of the same days
+Series = namedtuple('Series', ['dates', 'values'])
+
+# min-max scaling to the range 0..1 as y * scale + offset,
+# immutable, so it can be shared between requests
+Scaler = namedtuple('Scaler', ['scale', 'offset'])
 
-def load_data():
+
+def load_data(path=f'{DATASET_DIR}/{FILENAME}'):
     """
         Load a dataframe from a CSV file.
         Loaded with selected columns.
         TODO (second priority): switch database or cloud
 
-        :return:    dataframe: pandas.core.frame.DataFrame
+        Only empty fields are missing, the code 'NA' is Namibia's, as in
+            the exports ingested by backend.ML.ingest.
+
+        :param      path:       str
+        :return:    dataframe:  pandas.core.frame.DataFrame
     """
-    return pd.read_csv(f'{DATASET_DIR}/{FILENAME}', usecols=COLNAMES)
+    import pandas as pd
+
+    return pd.read_csv(path, usecols=COLNAMES, keep_default_na=False,
+                       na_values=[''])
 
 
 def preprocess(dataframe):
@@ -41,6 +59,7 @@ def preprocess(dataframe):
         :param      dataframe: pandas.core.frame.DataFrame
         :return:    dataframe: pandas.core.frame.DataFrame
     """
+    import pandas as pd
 
     # rename column names
     mapped_columns = dict(zip(COLNAMES, NEW_COLUMN_NAMES))
@@ -94,30 +113,56 @@ def separate(dataframe):
     return dates, values
 
 
-def normalize(y):
+def fit_scaler(y):
+    """
+        Computes the scaling of values to be in range 0..1,
+            the same scaling as MinMaxScaler(feature_range=(0, 1)) fits.
+
+        :param      y:  numpy.ndarray
+        :return:        Scaler
+    """
+
+    y = np.asarray(y)
+    one = y.dtype.type(1)
+
+    data_min = np.min(y)
+    data_range = np.max(y) - data_min
+
+    # constant values are only shifted
+    if data_range == 0:
+        data_range = one
+
+    scale = one / data_range
+
+    return Scaler(scale, -data_min * scale)
+
+
+def normalize(y, scaler):
     """
         Normalize the values to be in range 0..1
 
         Shapes should remain identical: (N, 1)
 
-        :param      y:  numpy.ndarray
-        :return:        numpy.ndarray
+        :param      y:      numpy.ndarray
+        :param      scaler: Scaler
+        :return:            numpy.ndarray
     """
 
-    return SCALER.fit_transform(y)
+    return y * scaler.scale + scaler.offset
 
 
-def denormalize(sample):
+def denormalize(sample, scaler):
     """
         Denormalize the values to be actual number of COVID-19 cases.
 
         Shapes should remain identical: (1, 1)
 
         :param      sample: numpy.ndarray
+        :param      scaler: Scaler
         :return:            numpy.ndarray
     """
 
-    return SCALER.inverse_transform(sample)
+    return (sample - scaler.offset) / scaler.scale
 
 
 def apply_lookback(dataset, look_back=1):
@@ -135,11 +180,13 @@ def apply_lookback(dataset, look_back=1):
             Y:  |x(t+1)|
             Y contains real values at t+1.
 
+            Both are strided views of the dataset, no values are copied.
+
         Shapes: N is the length.
             N in dataset has lookback more number of samples more than X and Y.
 
             dataset.shape   is (N, 1)
-            X.shape         is (N-look_back, 1)
+            X.shape         is (N-look_back, look_back)
             Y.shape         is (N-look_back, )
 
         :param      dataset:    numpy.ndarray
@@ -147,13 +194,15 @@ def apply_lookback(dataset, look_back=1):
         :return:                numpy.ndarray, numpy.ndarray
     """
 
-    data_x, data_y = [], []
-    for i in range(len(dataset) - look_back):
-        a = dataset[i:(i + look_back), 0]
-        data_x.append(a)
-        data_y.append(dataset[i + look_back, 0])
+    values = dataset[:, 0]
+
+    if len(values) <= look_back:
+        return np.empty((0, look_back), values.dtype), values[:0]
+
+    data_x = sliding_window_view(values, look_back)[:-1]
+    data_y = values[look_back:]
 
-    return np.array(data_x), np.array(data_y)
+    return data_x, data_y
 
 
 def reshape(x):
@@ -171,108 +220,27 @@ def reshape(x):
     return reshaped
 
 
-def unite_dates_samples(dates, samples):
+def to_ordinals(dates):
     """
-        Horizontally unites dates for x(t+1)
-            and samples for | x(t-k) | ... | x(t) |,
-            where k is look_back-1.
+        Converts dates to proleptic Gregorian ordinals,
+            the same numbers as datetime.toordinal() gives.
 
-        Shapes:     dates:      (N, 1)
-                    samples:    (N, look_back)
-                    hstacked:   (N, 1 + look_back)
-
-        :param      dates:      numpy.ndarray
-        :param      samples:    numpy.ndarray
-        :return    hstacked:   numpy.ndarray
+        :param      dates:  numpy.ndarray of str or numpy.datetime64
+        :return:            numpy.ndarray of numpy.int32
     """
+    days = np.asarray(dates, dtype='datetime64[D]').astype(np.int64)
 
-    hstacked = np.hstack((dates, samples))
-
-    return hstacked
+    return (days + EPOCH_ORDINAL).astype(np.int32)
 
 
-def change_date(date, delta_days=0):
+def from_ordinals(ordinals):
     """
-        Gets a date in delta_days number of days.
-            delta_days can be positive or negative.
+        Converts proleptic Gregorian ordinals to dates formatted
+            with DATE_FORMAT.
 
-        :param      date:           datetime.datetim
-        :param      delta_days:     int
-        :return     next_date:      str
+        :param      ordinals:   numpy.ndarray of int
+        :return:                numpy.ndarray of str
     """
+    days = np.asarray(ordinals, dtype=np.int64) - EPOCH_ORDINAL
 
-    detla = timedelta(days=delta_days)
-
-    date = dt.strptime(date, DATE_FORMAT)
-
-    next_date = date + detla
-    next_date = dt.strftime(next_date, DATE_FORMAT)
-
-    return next_date
-
-
-def append_sample(array, predicted, look_back, requested_day):
-    """
-        Appends a predicted number of COVID-19 cases to the end of all samples;
-            Creates the next date for t+1.
-
-            Generate a new sample as  | x(t-k) | ... | x(t) |
-            where   k is look_back-1
-            and     x(t) is the predicted value.
-
-
-        :param      array:              numpy.ndarray
-                    array.shape:        (N, 4)
-        :param      predicted:          numpy.ndarray
-                    predicted.shape:    (1, 1)
-
-        :param      look_back:          int
-        :param      requested_day:      str
-
-        :return:    numpy.ndarray,      str
-    """
-
-    # next date
-    next_date_formatted = change_date(requested_day, delta_days=1)
-    next_date_formatted = np.array([next_date_formatted])
-
-    # generate next sample
-    selected = array[array[:, 0] == requested_day, 2:].reshape(look_back - 1, )
-    selected = np.append(selected, predicted.reshape(1, ))
-    next_sample = np.append(next_date_formatted, selected)
-
-    # append next sample
-    if len(array[array[:, 0] == next_date_formatted, :]) == 0:
-        array = np.vstack((array, next_sample))
-    else:
-        array[array[:, 0] == next_date_formatted] = next_sample
-
-    return array, next_date_formatted[0]
-
-
-def get_sample(united_samples, requested_date):
-    """
-        Extracts a sample for a prediction for a given date.
-            If no such date is found, extract the last available sample.
-
-            If it is available, extract the sample for this date
-
-    :param      united_samples:         numpy.ndarray
-                united_samples.shape:   (N, 1 + look_back)
-    :param      requested_date:         str
-
-    :return     sample:                 numpy.ndarray
-                sample.shape:           (look_back, )
-                day_taken:              str
-    """
-    search_res = np.where(united_samples[:, 0] == requested_date)[0]
-    if len(search_res) == 0:
-        sample = united_samples[-1:, :]
-        day_taken = sample[0, 0]
-    else:
-        sample = united_samples[united_samples[:, 0] == requested_date]
-        day_taken = requested_date
-
-    sample = sample[0, 1:]  # eliminate date in the first column
-
-    return sample, day_taken
+    return np.datetime_as_string(days.astype('datetime64[D]'), unit='D')
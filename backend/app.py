@@ -1,29 +1,220 @@
+import csv
 import os
-import pandas as pd
+import sys
 
 from flask import Flask, request, abort, json, jsonify, render_template
-from werkzeug.exceptions import HTTPException
+from werkzeug.exceptions import HTTPException, ServiceUnavailable, \
+    default_exceptions
 
-from backend.ML.PolyReg import get_trend_pred
-from backend.ML.RNN import RNN
+from backend import bokeh_server, cache, metrics
+from backend.capacity import CAPACITY
+from backend.cache import FileCache, make_cached_response
 
-from bokeh.client import pull_session
-from bokeh.embed import server_session
+# backend.ML, with NumPy, and pandas when the case store is rebuilt,
+# is imported by the routes that predict, on their first request,
+# or by preload()
 
 template_dir = os.path.abspath('frontend/templates')
 static_dir = os.path.abspath('frontend/static')
 
-
-def create_app():
+CODES_PATH = f'{os.path.dirname(__file__)}/datasets/countryCodesNames.txt'
+BATCH_LIMIT = 1000
+
+
+def load_codes(path):
+    """
+        Reads country codes and names of their maps.
+
+        :param      path:   str
+        :return:            dict
+    """
+    with open(path, newline='') as file:
+        return {
+            'results': list(csv.DictReader(file))
+        }
+
+
+CODES = FileCache(CODES_PATH, load_codes)
+
+
+def read_stat(module_name, name, key):
+    """
+        Reads a statistic of an object of a module, without importing
+            the module if it was not imported yet.
+
+        :param      module_name:    str
+        :param      name:           str, object with a stats() method
+        :param      key:            str
+        :return:                    number, 0 if the module is not imported
+    """
+    module = sys.modules.get(module_name)
+    if module is None:
+        return 0
+
+    return getattr(module, name).stats()[key]
+
+
+metrics.REGISTRY.collect(
+    'model_registry_hits_total', 'Models served from the registry.',
+    'counter', lambda: read_stat('backend.ML.registry', 'MODELS', 'hits'))
+metrics.REGISTRY.collect(
+    'model_registry_misses_total', 'Models loaded into the registry.',
+    'counter', lambda: read_stat('backend.ML.registry', 'MODELS', 'misses'))
+metrics.REGISTRY.collect(
+    'model_registry_size', 'Models held by the registry.',
+    'gauge', lambda: read_stat('backend.ML.registry', 'MODELS', 'size'))
+metrics.REGISTRY.collect(
+    'inference_queue_depth', 'Predictions waiting for a worker.',
+    'gauge', lambda: read_stat('backend.ML.service', 'INFERENCE',
+                               'queue_depth'))
+metrics.REGISTRY.collect(
+    'inference_coalesced_total', 'Requests that shared a prediction.',
+    'counter', lambda: read_stat('backend.ML.service', 'INFERENCE',
+                                 'coalesced'))
+metrics.REGISTRY.collect(
+    'inference_rejected_total', 'Requests rejected with a full queue.',
+    'counter', lambda: read_stat('backend.ML.service', 'INFERENCE',
+                                 'rejected'))
+
+
+def load_config(environ=os.environ):
+    """
+        Reads the configuration of the app, other than the Bokeh server's,
+            from the environment.
+
+        :param      environ:    dict
+        :return:                dict
+    """
+    preload_models = environ.get('PRELOAD_MODELS')
+    if preload_models is not None:
+        preload_models = [code for code in preload_models.split(',') if code]
+
+    return {
+        'PRELOAD': environ.get('PRELOAD', '0') == '1',
+        # all available models if not set
+        'PRELOAD_MODELS': preload_models,
+    }
+
+
+def preload(app):
+    """
+        Warm-up hook, imports the prediction stack, opens the case store
+            and the forecast table, loads and warms up models, and builds
+            the payload of /map-data, so that the first request does not
+            pay for it.
+
+        Called by create_app() when PRELOAD=1, and can be called on an app
+            created without it, e.g. from gunicorn's post_worker_init.
+
+        :param      app:    flask.Flask
+        :return:            list of loaded country codes
+    """
+    from backend.ML.forecasts import FORECASTS
+    from backend.ML.map_data import MAP_DATA
+    from backend.ML.registry import MODELS
+    from backend.ML.store import get_case_store
+
+    get_case_store()
+    if os.path.exists(FORECASTS.path):
+        FORECASTS.connect()
+
+    app.config['PRELOADED_MODELS'] = MODELS.preload(
+        app.config['PRELOAD_MODELS'])
+
+    MAP_DATA.get()
+
+    return app.config['PRELOADED_MODELS']
+
+
+def make_survey_response(country_code, prediction_info, trend):
+    """
+        Formats a prediction as returned by /survey.
+
+        :param      country_code:       str
+        :param      prediction_info:    dict
+        :param      trend:              str
+        :return:                        dict
+    """
+    response = {
+        'prediction_new_cases': str(prediction_info['prediction_new_cases']),
+        'prediction_date': str(prediction_info['prediction_date']),
+        'starting_date': str(prediction_info['starting_date']),
+        'country_region_code': country_code,
+        'trend': trend,
+        'success': True
+    }
+
+    if 'intervals' in prediction_info:
+        response['intervals'] = prediction_info['intervals']
+
+    return response
+
+
+def make_error_response(code):
+    """
+        Formats an HTTP error the same way as the error handler does,
+            for a single item of a batch.
+
+        :param      code:   int
+        :return:            dict
+    """
+    error = default_exceptions[code]()
+
+    return {
+        'error': {
+            'code': error.code,
+            'name': error.name,
+            'description': error.description,
+        },
+        'success': False
+    }
+
+
+def create_app(config=None):
+    """
+        :param      config:     dict or None, overrides the configuration
+                                read from the environment
+        :return:                flask.Flask
+    """
     app = Flask(__name__,
                 template_folder=template_dir,
                 static_folder=static_dir)
 
+    app.config.update(bokeh_server.load_config())
+    app.config.update(load_config())
+    app.config.update(config or {})
+
+    # Bokeh server of the dashboard, its session pool starts with the
+    # first page
+    embed = bokeh_server.get_embed(app.config)
+
+    # request and stage timings, and /metrics, unless METRICS_ENABLED=0
+    metrics.init_app(app)
+
+    if cache.brotli is None:
+        app.logger.warning('brotli is not installed, responses are only '
+                           'gzip compressed')
+
+    # index of the capacity projections, built before the first request;
+    # without the file, /capacity answers 404
+    try:
+        CAPACITY.index()
+    except OSError as e:
+        app.logger.warning('capacity projections are not available: %s', e)
+
+    # models and data load on the first prediction, unless PRELOAD=1
+    app.config['PRELOADED_MODELS'] = []
+    if app.config['PRELOAD']:
+        preload(app)
+
     @app.route('/codes')
     def get_country_names_codes():
         """
             Loads a file to be served in JS in the frontend.
 
+            The response is built once per version of the file,
+                with an ETag and compressed variants.
+
             Contains Access-Control-Allow-Origin, because otherwise
                 requests are blocked by the frontend.
 
@@ -31,22 +222,70 @@ def create_app():
         """
 
         try:
-            df = pd.read_csv('backend/datasets/countryCodesNames.txt')
-        except Exception as e:
+            payload = CODES.get()
+        except OSError as e:
+            metrics.count_error('/codes', e)
             abort(404)  # not found
+        except Exception as e:
+            metrics.count_error('/codes', e)
+            abort(422)  # unprocessable entity
+
+        return make_cached_response(payload, {
+            'Access-Control-Allow-Origin': '*'
+        })
+
+    @app.route('/capacity')
+    def get_capacity():
+        """
+            Hospital capacity projections and policy dates of locations,
+                by exact name (location), start of the name (prefix), and
+                ranges of any other column ({column}_min, {column}_max),
+                dates as YYYY-MM-DD.
+
+            Responses are built once per distinct query and version of
+                the file, with an ETag and compressed variants.
+
+            :return: application/json
+        """
 
         try:
-            records = json.loads(df.to_json(orient='records'))
-            response = {
-                'results': records
-            }
+            payload = CAPACITY.get(request.args.to_dict())
+        except ValueError as e:
+            metrics.count_error('/capacity', e)
+            abort(400)  # bad request
+        except OSError as e:
+            metrics.count_error('/capacity', e)
+            abort(404)  # not found
+
+        return make_cached_response(payload, {
+            'Access-Control-Allow-Origin': '*'
+        })
 
-            response = jsonify(response)
-            response.headers.add('Access-Control-Allow-Origin', '*')
+    @app.route('/map-data')
+    def get_map_data():
+        """
+            Latest new cases of every country, and the forecast and the
+                trend of every country with a model, for the world map.
+
+            The response is built once per version of the dataset and of
+                the models, with an ETag and compressed variants. While
+                a new version fails to build, the last one is served.
+
+            :return: application/json
+        """
+        from backend.ML.map_data import MAP_DATA
+
+        try:
+            payload = MAP_DATA.get()
         except Exception as e:
-            abort(422)  # unprocessable entity
+            metrics.count_error('/map-data', e)
+            payload = MAP_DATA.payload
+            if payload is None:
+                abort(404 if isinstance(e, OSError) else 503)
 
-        return response
+        return make_cached_response(payload, {
+            'Access-Control-Allow-Origin': '*'
+        })
 
     @app.route('/survey', methods=['POST'])
     def post_survey():
@@ -58,48 +297,154 @@ def create_app():
             Returns a predicted number of new COVID-19 cases into the future,
                 and its trend direction.
 
+            With intervals=true, adds quantiles of the new cases of each
+                forecast day, by a residual bootstrap of the model.
+
+            Live predictions run in the inference worker pool, identical
+                concurrent requests share one prediction. Returns 503 with
+                Retry-After when the pool's queue is full.
+
             :return: application/json
         """
-
-        response_data = {}
+        from backend.ML.forecasts import FORECASTS
+        from backend.ML.service import INFERENCE, QueueFull, predict_survey
 
         if len(request.form) == 0:
             abort(400)  # bad request
 
         data = request.form.to_dict()
         data['look_forward_days'] = int(data['look_forward_days'])
+        intervals = data.get('intervals', '').lower() in ('true', '1')
 
         try:
-            rnn = RNN(country_code=data['country_region_code'],
-                      look_forward=data['look_forward_days'])
-
             requested_day = data['requested_date']
-            prediction_info, samples = rnn.predict(requested_day)
-            trend = get_trend_pred(samples, data['look_forward_days'])
-
-            response_data['prediction_new_cases'] = \
-                str(prediction_info['prediction_new_cases'])
-            response_data['prediction_date'] = \
-                str(prediction_info['prediction_date'])
-            response_data['starting_date'] = \
-                str(prediction_info['starting_date'])
-
-            response_data['country_region_code'] = data['country_region_code']
-            response_data['trend'] = trend
-            response_data['success'] = True
 
+            # forecasts from the last available date are precomputed,
+            # without intervals
+            prediction_info = None if intervals else FORECASTS.lookup(
+                data['country_region_code'], data['look_forward_days'],
+                requested_day)
+
+            if prediction_info is not None:
+                trend = prediction_info['trend']
+            else:
+                key = (data['country_region_code'],
+                       data['look_forward_days'], requested_day, intervals)
+                prediction_info, trend = INFERENCE.submit(
+                    key, predict_survey, *key).result()
+
+            response_data = make_survey_response(data['country_region_code'],
+                                                 prediction_info, trend)
+
+        except QueueFull as e:
+            metrics.count_error('/survey', e)
+            raise ServiceUnavailable(retry_after=e.retry_after)
         except Exception as e:
+            metrics.count_error('/survey', e)
             abort(422)  # unprocessable entity
 
         return jsonify(response_data)
 
+    @app.route('/survey/stats')
+    def get_survey_stats():
+        """
+            Queue depth, wait times and counters of the inference
+                worker pool.
+
+            :return: application/json
+        """
+        from backend.ML.service import INFERENCE
+
+        return jsonify(INFERENCE.stats())
+
+    @app.route('/survey/batch', methods=['POST'])
+    def post_survey_batch():
+        """
+            Captures a list of requests for predictions, each one
+                with the same fields as /survey, as JSON.
+
+            Requests for the same country and the same number of days
+                to look forward share a model and are predicted together,
+                with one batched model call per day.
+
+            Returns the responses of /survey in the order of the requests,
+                an item that cannot be predicted contains its error.
+
+            :return: application/json
+        """
+        from backend.ML.PolyReg import get_trend_pred
+        from backend.ML.RNN import RNN
+        from backend.ML.forecasts import FORECASTS
+
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            body = body.get('requests')
+
+        if not isinstance(body, list) or len(body) == 0:
+            abort(400)  # bad request
+
+        if len(body) > BATCH_LIMIT:
+            abort(413)  # payload too large
+
+        results = [None] * len(body)
+        groups = {}
+
+        for i, item in enumerate(body):
+            try:
+                key = (str(item['country_region_code']),
+                       int(item['look_forward_days']))
+                requested_day = str(item['requested_date'])
+            except (TypeError, KeyError, ValueError) as e:
+                metrics.count_error('/survey/batch', e)
+                results[i] = make_error_response(400)
+                continue
+
+            prediction_info = FORECASTS.lookup(*key, requested_day)
+            if prediction_info is not None:
+                results[i] = make_survey_response(key[0], prediction_info,
+                                                  prediction_info['trend'])
+                continue
+
+            groups.setdefault(key, []).append((i, requested_day))
+
+        for (country_code, look_forward_days), group in groups.items():
+            indices, requested_days = zip(*group)
+
+            try:
+                rnn = RNN(country_code=country_code,
+                          look_forward=look_forward_days)
+                predictions = rnn.predict_batch(requested_days)
+            except Exception as e:
+                metrics.count_error('/survey/batch', e)
+                for i in indices:
+                    results[i] = make_error_response(422)
+                continue
+
+            for i, (prediction_info, samples) in zip(indices, predictions):
+                try:
+                    trend = get_trend_pred(samples, look_forward_days)
+                    results[i] = make_survey_response(country_code,
+                                                      prediction_info, trend)
+                except Exception as e:
+                    metrics.count_error('/survey/batch', e)
+                    results[i] = make_error_response(422)
+
+        return jsonify({
+            'results': results,
+            'success': True
+        })
+
     @app.route('/')
     # def present():
     #     return render_template("world.html")
     def dkapp_page():
-        session = pull_session(url="https://coprevent-bokeh.herokuapp.com/main")
-        script = server_session(None, session.id,
-                                url='https://coprevent-bokeh.herokuapp.com/main')
+        """
+            Renders the page right away, the dashboard's session is
+                pre-warmed or created by the browser, never by this request.
+
+            :return: HTML
+        """
+        script = embed.script() if embed is not None else ''
         return render_template("world.html", script=script, template="Flask")
 
     @app.errorhandler(HTTPException)
@@ -121,4 +466,4 @@ def create_app():
 app = create_app()
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080, debug=True, threaded=False)
+    app.run(host='0.0.0.0', port=8080, debug=True, threaded=True)
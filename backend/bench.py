@@ -0,0 +1,336 @@
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+from backend.ML.PolyReg import get_trend_pred
+from backend.ML.RNN import RNN
+from backend.ML.registry import MODELS, ModelRegistry
+from backend.ML.rollout import rollout
+from backend.ML.store import get_case_store
+from backend.ML.utils import DATASET_DIR, FILENAME, load_data, preprocess, \
+    apply_lookback, normalize
+
+REPEAT = 5
+# seconds, each repetition runs the benchmark at least this long
+MIN_RUN_TIME = 0.05
+# relative slowdown of the median above which a benchmark regressed
+THRESHOLD = 0.2
+
+SIZES = (1, 4)
+HORIZONS = (1, 3, 7, 14)
+COUNTRY_CODE = 'US'
+REQUESTED_DAY = '2020-05-01'
+
+
+def make_dataset(path, size, seed=7):
+    """
+        Scales the WHO dataset by adding synthetic countries: size - 1
+            copies of all its rows, with new codes and new cases scaled
+            by a random factor.
+
+        Rows are copied as they are read, rows without a country and
+            Namibia's 'NA' code included.
+
+        :param      path:   str, CSV file to write
+        :param      size:   int, times the number of rows
+        :param      seed:   int
+        :return:            str, path
+    """
+    original = pd.read_csv(f'{DATASET_DIR}/{FILENAME}',
+                           keep_default_na=False)
+    rng = np.random.default_rng(seed)
+
+    dataframe = pd.DataFrame({column: np.tile(original[column].to_numpy(),
+                                              size)
+                              for column in original.columns})
+
+    copies = np.repeat(np.arange(size), len(original))
+    suffixes = copies.astype(str)
+    synthetic = copies > 0
+    # rows without a country stay without one
+    coded = synthetic & (dataframe['ISO_2_CODE'] != '').to_numpy()
+
+    dataframe.loc[coded, 'ISO_2_CODE'] += suffixes[coded]
+    dataframe.loc[synthetic, 'ADM0_NAME'] += np.char.add(
+        ' ', suffixes[synthetic])
+
+    factors = np.where(synthetic, rng.uniform(0.5, 2, len(dataframe)), 1)
+    dataframe['NewCase'] = np.round(
+        dataframe['NewCase'] * factors).astype(np.int64)
+
+    dataframe.to_csv(path, index=False)
+
+    return path
+
+
+def make_models(horizons, directory):
+    """
+        Models of COUNTRY_CODE for every horizon, since a model only
+            predicts the horizon of its look_back. They are trained for
+            one epoch, timings do not depend on the weights.
+
+        :param      horizons:   list of int
+        :param      directory:  str
+        :return:                dict, horizon -> models directory
+    """
+    from backend.ML.train import train_models
+
+    look_back = MODELS.look_back(COUNTRY_CODE)
+
+    models_dirs = {}
+    for horizon in horizons:
+        if horizon == look_back:
+            models_dirs[horizon] = MODELS.models_dir
+            continue
+
+        models_dir = f'{directory}/models_{horizon}'
+        _, failed = train_models([COUNTRY_CODE],
+                                 {'look_back': horizon, 'epochs': 1},
+                                 models_dir=models_dir, workers=1)
+        if failed:
+            raise RuntimeError(failed[COUNTRY_CODE])
+        models_dirs[horizon] = models_dir
+
+    return models_dirs
+
+
+def post_survey(client, models_dir, survey):
+    """
+        POST /survey with the models of a directory.
+
+        The process-wide registry is pointed at the directory before the
+            request, a model is reloaded only when its directory changes.
+
+        :param      client:     flask.testing.FlaskClient
+        :param      models_dir: str
+        :param      survey:     dict, form
+        :return:                flask.Response
+    """
+    MODELS.models_dir = models_dir
+    return client.post('/survey', data=survey)
+
+
+def measure(function, repeat=REPEAT, min_run_time=MIN_RUN_TIME):
+    """
+        Times a function as timeit does, the number of calls of each
+            repetition is chosen so a repetition lasts at least
+            min_run_time.
+
+        :param      function:       callable without arguments
+        :param      repeat:         int
+        :param      min_run_time:   float, seconds
+        :return:                    dict, seconds per call
+    """
+    # warm up, and calibrate the number of calls
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_run_time:
+            break
+        number *= 2 if elapsed == 0 else \
+            max(2, int(min_run_time / elapsed) + 1)
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append((time.perf_counter() - started) / number)
+
+    return {
+        'median': statistics.median(timings),
+        'min': min(timings),
+        'max': max(timings),
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def benchmarks(sizes=SIZES, horizons=HORIZONS, directory=None):
+    """
+        Builds the benchmarks, by name.
+
+        :param      sizes:      list of int, see make_dataset()
+        :param      horizons:   list of int, days to look forward
+        :param      directory:  str, for the scaled datasets
+        :return:                dict, name -> callable without arguments
+    """
+    from backend.app import create_app
+
+    cases = {}
+
+    for size in sizes:
+        path = make_dataset(f'{directory}/who_{size}.csv', size)
+        dataframe = load_data(path)
+
+        cases[f'load_data[size={size}]'] = \
+            lambda path=path: load_data(path)
+        cases[f'preprocess[size={size}]'] = \
+            lambda dataframe=dataframe: preprocess(dataframe)
+
+    store = get_case_store()
+    values = np.asarray(store.series(COUNTRY_CODE)[1])[:, None]
+    look_back = MODELS.look_back(COUNTRY_CODE)
+
+    _, Y = store.series(COUNTRY_CODE)
+    Y = normalize(Y, store.scaler(COUNTRY_CODE))
+
+    _, history = RNN(COUNTRY_CODE, look_back).predict(REQUESTED_DAY)
+
+    app = create_app({'BOKEH_MODE': 'off'})
+    client = app.test_client()
+
+    cases['RNN.__init__'] = lambda: RNN(COUNTRY_CODE, look_back)
+    cases['RNN.__init__[cold]'] = lambda: RNN(
+        COUNTRY_CODE, look_back, registry=ModelRegistry())
+    cases['/codes'] = lambda: client.get('/codes')
+    cases['/capacity[prefix,range]'] = lambda: client.get(
+        '/capacity?prefix=Al&icu_bed_capacity_min=100')
+    cases['/map-data'] = lambda: client.get('/map-data')
+
+    models_dirs = make_models(horizons, directory)
+
+    for horizon in horizons:
+        registry = ModelRegistry(models_dir=models_dirs[horizon])
+        model = registry.get(COUNTRY_CODE)
+        windows = Y[None, -horizon:]
+
+        cases[f'apply_lookback[horizon={horizon}]'] = \
+            lambda horizon=horizon: apply_lookback(values, horizon)
+        cases[f'rollout[horizon={horizon}]'] = \
+            lambda model=model, windows=windows, horizon=horizon: \
+            rollout(model, windows, horizon + 1)
+        cases[f'get_trend_pred[horizon={horizon}]'] = \
+            lambda horizon=horizon: get_trend_pred(history, horizon)
+
+        survey = {'country_region_code': COUNTRY_CODE,
+                  'look_forward_days': horizon,
+                  'requested_date': REQUESTED_DAY}
+        models_dir = models_dirs[horizon]
+        cases[f'/survey[horizon={horizon}]'] = \
+            lambda models_dir=models_dir, survey=survey: \
+            post_survey(client, models_dir, survey)
+        cases[f'/survey[horizon={horizon},intervals]'] = \
+            lambda models_dir=models_dir, survey=survey: \
+            post_survey(client, models_dir, dict(survey, intervals='true'))
+        cases[f'RNN.predict_intervals[horizon={horizon}]'] = \
+            lambda registry=registry, horizon=horizon: RNN(
+                COUNTRY_CODE, horizon,
+                registry=registry).predict_intervals(REQUESTED_DAY)
+
+    return cases
+
+
+def run(sizes=SIZES, horizons=HORIZONS, repeat=REPEAT, select=None):
+    """
+        Runs the benchmarks.
+
+        :param      sizes:      list of int
+        :param      horizons:   list of int
+        :param      repeat:     int
+        :param      select:     str or None, runs only benchmarks whose
+                                name contains it
+        :return:                dict, JSON serializable
+    """
+    directory = tempfile.mkdtemp()
+    models_dir = MODELS.models_dir
+    try:
+        cases = benchmarks(sizes, horizons, directory)
+        results = {name: measure(function, repeat)
+                   for name, function in cases.items()
+                   if select is None or select in name}
+    finally:
+        # see post_survey()
+        MODELS.models_dir = models_dir
+        shutil.rmtree(directory)
+
+    return {
+        'meta': {
+            'created_at': dt.utcnow().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'sizes': list(sizes),
+            'horizons': list(horizons),
+        },
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold=THRESHOLD):
+    """
+        Benchmarks whose median time grew by more than the threshold.
+
+        :param      baseline:   dict, as returned by run()
+        :param      current:    dict, as returned by run()
+        :param      threshold:  float, relative slowdown
+        :return:                dict, name -> ratio of the medians
+    """
+    regressions = {}
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name)
+        if before is None or before['median'] == 0:
+            continue
+        ratio = result['median'] / before['median']
+        if ratio > 1 + threshold:
+            regressions[name] = ratio
+
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+
+    def integers(text):
+        return [int(value) for value in text.split(',')]
+
+    parser = argparse.ArgumentParser(
+        description='Time the forecasting pipeline and the endpoints.')
+    parser.add_argument('--output', default='benchmarks.json',
+                        help='JSON file the results are written to')
+    parser.add_argument('--baseline',
+                        help='results of an earlier run to compare with, '
+                             'exits with 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    parser.add_argument('--sizes', type=integers, default=SIZES,
+                        help='comma separated multiples of the countries')
+    parser.add_argument('--horizons', type=integers, default=HORIZONS,
+                        help='comma separated days to look forward')
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--select', help='only benchmarks containing this')
+    args = parser.parse_args()
+
+    current = run(args.sizes, args.horizons, args.repeat, args.select)
+    with open(args.output, 'w') as file:
+        json.dump(current, file, indent=2, sort_keys=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    for name, result in current['results'].items():
+        line = f'{name:<32} {result["median"] * 1e3:10.3f} ms'
+        if baseline is not None and name in baseline['results']:
+            before = baseline['results'][name]['median']
+            line += f'  {before * 1e3:10.3f} ms before'
+        print(line)
+
+    if baseline is not None:
+        regressions = compare(baseline, current, args.threshold)
+        for name, ratio in regressions.items():
+            print(f'regression: {name} is {ratio:.2f}x slower')
+        sys.exit(1 if regressions else 0)
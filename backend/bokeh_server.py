@@ -0,0 +1,407 @@
+import atexit
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+# bokeh is imported when the first session is pulled or embedded,
+# not when the app is imported
+
+MAIN_PATH = f'{os.path.dirname(os.path.abspath(__file__))}/main.py'
+REMOTE_URL = 'https://coprevent-bokeh.herokuapp.com/main'
+
+# remote:       sessions of an already running Bokeh server at BOKEH_URL
+# inprocess:    a Bokeh server running main.py in a thread of this process
+# local:        a Bokeh server running main.py, launched as a subprocess
+# off:          the page is rendered without the dashboard
+MODES = ('remote', 'inprocess', 'local', 'off')
+
+# seconds, first retry delay after a session could not be pulled
+RETRY_DELAY = 1
+RETRY_DELAY_LIMIT = 60
+
+logger = logging.getLogger(__name__)
+
+
+def load_config(environ=os.environ):
+    """
+        Reads the configuration of the Bokeh server from the environment.
+
+        :param      environ:    dict
+        :return:                dict
+    """
+    return {
+        'BOKEH_MODE': environ.get('BOKEH_MODE', 'remote'),
+        'BOKEH_URL': environ.get('BOKEH_URL'),
+        'BOKEH_APP_PATH': environ.get('BOKEH_APP_PATH', MAIN_PATH),
+        'BOKEH_PORT': int(environ.get('BOKEH_PORT', 5006)),
+        'BOKEH_ALLOW_WEBSOCKET_ORIGIN': environ.get(
+            'BOKEH_ALLOW_WEBSOCKET_ORIGIN',
+            'localhost:8080,127.0.0.1:8080').split(','),
+        # 0: no pool, browsers create their sessions
+        'BOKEH_POOL_SIZE': int(environ.get('BOKEH_POOL_SIZE', 0)),
+        'BOKEH_SESSION_MAX_AGE': float(
+            environ.get('BOKEH_SESSION_MAX_AGE', 10)),
+    }
+
+
+def pull_session_id(url):
+    """
+        Creates a session on a Bokeh server, whose document is built
+            by the server before any browser connects to it.
+
+        The client connection is closed right away, the server keeps
+            the session until its unused session lifetime expires.
+
+        :param      url:    str
+        :return:            str
+    """
+    from bokeh.client import pull_session
+
+    session = pull_session(url=url)
+    try:
+        return session.id
+    finally:
+        session.close()
+
+
+class SessionPool:
+    def __init__(self, url, size, max_age, pull=pull_session_id):
+        """
+            Sessions created ahead of page views by a background thread,
+                each one handed out once.
+
+            Sessions older than max_age are dropped before the server
+                discards them, so max_age must be lower than the server's
+                unused session lifetime.
+
+            :param      url:        str
+            :param      size:       int
+            :param      max_age:    float, seconds
+            :param      pull:       callable, url -> session id
+        """
+        self.url = url
+        self.size = size
+        self.max_age = max_age
+        self.pull = pull
+
+        self._sessions = deque()
+        self._lock = threading.Lock()
+        self._wanted = threading.Event()
+        self._closed = threading.Event()
+        self._thread = None
+
+        self.taken = 0
+        self.missed = 0
+        self.failures = 0
+
+    def start(self):
+        """
+            Starts the background thread, once.
+
+            :return:    SessionPool
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._fill,
+                                                name='bokeh-session-pool',
+                                                daemon=True)
+                self._thread.start()
+
+        return self
+
+    def close(self):
+        self._closed.set()
+        self._wanted.set()
+
+    def take(self):
+        """
+            Never waits for the server.
+
+            :return:    str or None, None if no fresh session is ready
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            while self._sessions and \
+                    now - self._sessions[0][1] >= self.max_age:
+                self._sessions.popleft()
+
+            session_id = self._sessions.popleft()[0] \
+                if self._sessions else None
+
+            if session_id is None:
+                self.missed += 1
+            else:
+                self.taken += 1
+
+        self._wanted.set()
+
+        return session_id
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': self._thread is not None,
+                'ready': len(self._sessions),
+                'size': self.size,
+                'taken': self.taken,
+                'missed': self.missed,
+                'failures': self.failures,
+            }
+
+    def _fill(self):
+        delay = RETRY_DELAY
+
+        while not self._closed.is_set():
+            with self._lock:
+                now = time.monotonic()
+                while self._sessions and \
+                        now - self._sessions[0][1] >= self.max_age:
+                    self._sessions.popleft()
+                missing = self.size - len(self._sessions)
+
+            if missing <= 0:
+                # woken up by take(), or in time to replace expired sessions
+                self._wanted.wait(self.max_age / 2)
+                self._wanted.clear()
+                continue
+
+            try:
+                session_id = self.pull(self.url)
+            except Exception as e:
+                with self._lock:
+                    self.failures += 1
+                logger.warning('could not pull a session from %s: %s',
+                               self.url, e)
+                self._closed.wait(delay)
+                delay = min(delay * 2, RETRY_DELAY_LIMIT)
+                continue
+
+            delay = RETRY_DELAY
+            with self._lock:
+                self._sessions.append((session_id, time.monotonic()))
+
+
+class BokehEmbed:
+    def __init__(self, url, pool, server=None):
+        """
+            Scripts embedding the Bokeh dashboard in a page.
+
+            :param      url:    str, URL of the Bokeh application
+            :param      pool:   SessionPool or None, started by the first
+                                script()
+            :param      server: object with a stop() method, or None
+        """
+        self.url = url
+        self.pool = pool
+        self.server = server
+
+    def script(self):
+        """
+            Script of a pre-warmed session if one is ready, otherwise
+                a script that lets the browser create its session.
+
+                Either way the script loads the session asynchronously,
+                the page does not wait for the Bokeh server.
+
+            :return:    str
+        """
+        from bokeh.embed import server_document, server_session
+
+        if self.pool is None:
+            return server_document(self.url)
+
+        session_id = self.pool.start().take()
+        if session_id is None:
+            return server_document(self.url)
+
+        return server_session(None, session_id, url=self.url)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+        if self.server is not None:
+            self.server.stop()
+
+
+class InProcessServer:
+    def __init__(self, app_path, port, allow_websocket_origin,
+                 session_lifetime):
+        """
+            Bokeh server running a script in its own IO loop thread.
+
+            :param      app_path:               str
+            :param      port:                   int, 0 for any free port
+            :param      allow_websocket_origin: list of str
+            :param      session_lifetime:       float, seconds that unused
+                                                sessions are kept
+        """
+        self.app_path = app_path
+        self.port = port
+        self.allow_websocket_origin = allow_websocket_origin
+        self.session_lifetime = session_lifetime
+
+        self._server = None
+        self._started = threading.Event()
+        self._error = None
+
+    @property
+    def url(self):
+        name = os.path.splitext(os.path.basename(self.app_path))[0]
+
+        return f'http://localhost:{self.port}/{name}'
+
+    def start(self):
+        """
+            Raises RuntimeError if the server cannot start.
+
+            :return:    InProcessServer
+        """
+        thread = threading.Thread(target=self._run, name='bokeh-server',
+                                  daemon=True)
+        thread.start()
+        self._started.wait()
+
+        if self._error is not None:
+            raise RuntimeError(f'Bokeh server did not start: {self._error}')
+
+        return self
+
+    def stop(self):
+        server = self._server
+        if server is not None:
+            server.io_loop.add_callback(server.io_loop.stop)
+
+    def _run(self):
+        import asyncio
+
+        from bokeh.application import Application
+        from bokeh.application.handlers import ScriptHandler
+        from bokeh.server.server import Server
+        from tornado.ioloop import IOLoop
+
+        try:
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            name = os.path.splitext(os.path.basename(self.app_path))[0]
+            application = Application(ScriptHandler(filename=self.app_path))
+            self._server = Server(
+                {f'/{name}': application},
+                io_loop=IOLoop.current(),
+                port=self.port,
+                allow_websocket_origin=self.allow_websocket_origin,
+                unused_session_lifetime_milliseconds=int(
+                    self.session_lifetime * 1000))
+            self._server.start()
+            self.port = self._server.port
+        except Exception as e:
+            self._error = e
+            self._started.set()
+            return
+
+        self._started.set()
+        self._server.io_loop.start()
+
+
+class LocalServer:
+    def __init__(self, app_path, port, allow_websocket_origin,
+                 session_lifetime):
+        """
+            `bokeh serve` of a script, launched as a subprocess of this
+                process and stopped with it.
+
+            :param      app_path:               str
+            :param      port:                   int
+            :param      allow_websocket_origin: list of str
+            :param      session_lifetime:       float, seconds that unused
+                                                sessions are kept
+        """
+        self.app_path = app_path
+        self.port = port
+        self.allow_websocket_origin = allow_websocket_origin
+        self.session_lifetime = session_lifetime
+
+        self._process = None
+
+    @property
+    def url(self):
+        name = os.path.splitext(os.path.basename(self.app_path))[0]
+
+        return f'http://localhost:{self.port}/{name}'
+
+    def start(self):
+        command = [sys.executable, '-m', 'bokeh', 'serve', self.app_path,
+                   '--port', str(self.port),
+                   '--unused-session-lifetime',
+                   str(int(self.session_lifetime * 1000))]
+        for origin in self.allow_websocket_origin:
+            command += ['--allow-websocket-origin', origin]
+
+        # main.py imports its tabs relative to its own directory
+        self._process = subprocess.Popen(
+            command, cwd=os.path.dirname(os.path.abspath(self.app_path)))
+        atexit.register(self.stop)
+
+        return self
+
+    def stop(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
+
+
+_EMBEDS = {}
+_EMBEDS_LOCK = threading.Lock()
+
+
+def get_embed(config):
+    """
+        Returns the embedding of the Bokeh dashboard for a configuration,
+            starting its server on first use. Its session pool starts with
+            the first page rendered.
+
+            Apps created with the same configuration share them.
+
+        Raises ValueError for an unknown mode.
+
+        :param      config:     dict, see load_config()
+        :return:                BokehEmbed or None if the mode is off
+    """
+    mode = config['BOKEH_MODE']
+    if mode not in MODES:
+        raise ValueError(f'BOKEH_MODE must be one of {", ".join(MODES)}')
+
+    if mode == 'off':
+        return None
+
+    key = tuple((name, str(config[name])) for name in sorted(config)
+                if name.startswith('BOKEH_'))
+
+    with _EMBEDS_LOCK:
+        embed = _EMBEDS.get(key)
+        if embed is not None:
+            return embed
+
+        max_age = config['BOKEH_SESSION_MAX_AGE']
+        server = None
+
+        if mode == 'remote':
+            url = config['BOKEH_URL'] or REMOTE_URL
+        else:
+            # pooled sessions are dropped well before the server does
+            server_class = InProcessServer if mode == 'inprocess' \
+                else LocalServer
+            server = server_class(config['BOKEH_APP_PATH'],
+                                  config['BOKEH_PORT'],
+                                  config['BOKEH_ALLOW_WEBSOCKET_ORIGIN'],
+                                  session_lifetime=2 * max_age).start()
+            url = config['BOKEH_URL'] or server.url
+
+        pool = SessionPool(url, config['BOKEH_POOL_SIZE'], max_age) \
+            if config['BOKEH_POOL_SIZE'] > 0 else None
+        embed = BokehEmbed(url, pool, server)
+        _EMBEDS[key] = embed
+
+        return embed
@@ -0,0 +1,144 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import namedtuple
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:  # optional, responses are only gzip compressed
+    brotli = None
+
+# body:     bytes, JSON
+# variants: dict, content coding -> (bytes, ETag)
+Payload = namedtuple('Payload', ['body', 'etag', 'variants'])
+
+
+def make_payload(data):
+    """
+        Serializes data once, with a strong ETag and compressed variants.
+
+        :param      data:   JSON serializable object
+        :return:            Payload
+    """
+    body = json.dumps(data, separators=(',', ':'), sort_keys=True).encode()
+    etag = hashlib.sha1(body).hexdigest()
+
+    variants = {'gzip': (gzip.compress(body, compresslevel=9),
+                         f'{etag}-gzip')}
+    if brotli is not None:
+        variants['br'] = (brotli.compress(body), f'{etag}-br')
+
+    return Payload(body, etag, variants)
+
+
+def make_cached_response(payload, headers=None):
+    """
+        Responds with a prebuilt payload.
+
+        Answers 304 Not Modified when If-None-Match matches the ETag of
+            the payload or of one of its variants, otherwise sends the best
+            compressed variant that the client accepts.
+
+        :param      payload:    Payload
+        :param      headers:    dict or None, extra headers
+        :return:                flask.Response
+    """
+    etags = [payload.etag] + [etag for _, etag in payload.variants.values()]
+    matched = next((etag for etag in etags
+                    if request.if_none_match.contains(etag)), None)
+
+    if matched is not None:
+        response = Response(status=304)
+        response.set_etag(matched)
+    else:
+        body, etag, coding = payload.body, payload.etag, None
+        for name in ('br', 'gzip'):
+            if name in payload.variants and request.accept_encodings[name]:
+                (body, etag), coding = payload.variants[name], name
+                break
+
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        if coding is not None:
+            response.headers['Content-Encoding'] = coding
+
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    for name, value in (headers or {}).items():
+        response.headers[name] = value
+
+    return response
+
+
+class VersionedCache:
+    def __init__(self, version, build):
+        """
+            Payload rebuilt when the version of its sources changes.
+
+            :param      version:    callable, returns a comparable version
+            :param      build:      callable, returns a JSON serializable
+                                    object
+        """
+        self.version = version
+        self.build = build
+
+        self._payload = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    @property
+    def payload(self):
+        """
+            Last payload built, None before the first build.
+
+            :return:    Payload or None
+        """
+        return self._payload
+
+    def get(self):
+        """
+            While a new version is built, other callers get the previous
+                payload instead of waiting, only the first build blocks.
+
+            A build that raises is tried again by the next call.
+
+            :return:    Payload
+        """
+        version = self.version()
+
+        if self._version != version:
+            # blocks only when there is no payload to serve yet
+            if not self._lock.acquire(blocking=self._payload is None):
+                return self._payload
+            try:
+                if self._version != version:
+                    self._payload = make_payload(self.build())
+                    self._version = version
+            finally:
+                self._lock.release()
+
+        return self._payload
+
+
+class FileCache(VersionedCache):
+    def __init__(self, path, build):
+        """
+            Payload built from a file, rebuilt when the file changes.
+
+            get() raises OSError if the file cannot be read.
+
+            :param      path:   str
+            :param      build:  callable, path -> JSON serializable object
+        """
+        self.path = path
+
+        super().__init__(self.file_version, lambda: build(path))
+
+    def file_version(self):
+        stat = os.stat(self.path)
+
+        return stat.st_size, stat.st_mtime_ns
@@ -0,0 +1,271 @@
+import csv
+import os
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import datetime as dt
+
+from backend.cache import make_payload
+
+CAPACITY_PATH = f'{os.path.dirname(__file__)}/datasets/' \
+                f'summary_stats_all_locs.csv'
+DATE_FORMAT = '%m/%d/%y'
+
+# payloads of distinct queries kept
+CACHE_SIZE = 1024
+
+# query parameters that are not range filters
+LOOKUPS = ('location', 'prefix')
+
+
+def parse_value(column, text):
+    """
+        Dates as ISO strings, which sort as dates do, capacities as numbers.
+
+        Raises ValueError for a value that cannot be parsed.
+
+        :param      column:     str
+        :param      text:       str
+        :return:                str, int, float or None if missing
+    """
+    if text == '':
+        return None
+
+    if is_date_column(column):
+        return dt.strptime(text, DATE_FORMAT).date().isoformat()
+
+    number = float(text)
+    return int(number) if number.is_integer() else number
+
+
+def parse_bound(column, text):
+    """
+        Bound of a range filter, dates as YYYY-MM-DD.
+
+        Raises ValueError for a value that cannot be parsed.
+
+        :param      column:     str
+        :param      text:       str
+        :return:                str or number
+    """
+    if is_date_column(column):
+        return dt.strptime(text, '%Y-%m-%d').date().isoformat()
+
+    return float(text)
+
+
+def is_date_column(column):
+    return column.endswith('_date') or '_day_' in column
+
+
+class CapacityIndex:
+    def __init__(self, records, source=None):
+        """
+            Hospital capacity projections and policy dates of locations,
+                indexed for exact, prefix and range queries.
+
+                names:      dict, lower case name -> record
+                keys:       list, sorted lower case names, for prefixes
+                columns:    dict, column -> (sorted values, positions
+                            of their records), for ranges
+
+            :param      records:    list of dict, sorted by location_name
+            :param      source:     tuple, version of the source file
+        """
+        self.records = records
+        self.source = source
+
+        self.names = {record['location_name'].lower(): record
+                      for record in records}
+        self.keys = [record['location_name'].lower() for record in records]
+
+        self.columns = {}
+        for column in (records[0] if records else {}):
+            if column == 'location_name':
+                continue
+
+            pairs = sorted((record[column], position)
+                           for position, record in enumerate(records)
+                           if record[column] is not None)
+            self.columns[column] = ([value for value, _ in pairs],
+                                    [position for _, position in pairs])
+
+    @classmethod
+    def from_csv(cls, path=CAPACITY_PATH):
+        stat = os.stat(path)
+
+        with open(path, newline='') as file:
+            records = [{column: text if column == 'location_name'
+                        else parse_value(column, text)
+                        for column, text in row.items()}
+                       for row in csv.DictReader(file)]
+
+        records.sort(key=lambda record: record['location_name'].lower())
+
+        return cls(records, source=(stat.st_size, stat.st_mtime_ns))
+
+    def lookup(self, location):
+        """
+            :param      location:   str, case insensitive
+            :return:                dict or None
+        """
+        return self.names.get(location.lower())
+
+    def prefix(self, prefix):
+        """
+            :param      prefix:     str, case insensitive
+            :return:                range of positions of the records
+        """
+        prefix = prefix.lower()
+        start = bisect_left(self.keys, prefix)
+        end = bisect_left(self.keys, prefix + '\uffff', start)
+
+        return range(start, end)
+
+    def between(self, column, low=None, high=None):
+        """
+            Records whose value of a column is within low..high, both
+                included, records missing the value are left out.
+
+            Raises KeyError for an unknown column.
+
+            :param      column:     str
+            :param      low:        str or number, None for no bound
+            :param      high:       str or number, None for no bound
+            :return:                set of positions of the records
+        """
+        values, positions = self.columns[column]
+        start = bisect_left(values, low) if low is not None else 0
+        end = bisect_right(values, high) if high is not None \
+            else len(values)
+
+        return set(positions[start:end])
+
+    def query(self, location=None, prefix=None, ranges=None):
+        """
+            Records matching every given condition, sorted by name.
+
+            :param      location:   str or None, exact name
+            :param      prefix:     str or None, start of the name
+            :param      ranges:     dict or None, column -> (low, high)
+            :return:                list of dict
+        """
+        if location is not None:
+            record = self.lookup(location)
+            if record is None:
+                return []
+            positions = {bisect_left(self.keys, location.lower())}
+        elif prefix is not None:
+            positions = set(self.prefix(prefix))
+        else:
+            positions = None
+
+        for column, (low, high) in (ranges or {}).items():
+            matched = self.between(column, low, high)
+            positions = matched if positions is None else positions & matched
+
+        if positions is None:
+            return self.records
+
+        return [self.records[position] for position in sorted(positions)]
+
+
+def parse_query(args, index):
+    """
+        Reads the query parameters of /capacity: location, prefix and
+            {column}_min and {column}_max for any column but the name.
+
+        Raises ValueError for an unknown parameter or an invalid bound.
+
+        :param      args:   dict, query parameters
+        :param      index:  CapacityIndex
+        :return:            tuple, location, prefix, and sorted tuple of
+                            (column, low, high), hashable
+    """
+    ranges = {}
+    for name, text in args.items():
+        if name in LOOKUPS:
+            continue
+
+        column, _, bound = name.rpartition('_')
+        if bound not in ('min', 'max') or column not in index.columns:
+            raise ValueError(f'unknown parameter {name}')
+
+        value = parse_bound(column, text)
+        low, high = ranges.get(column, (None, None))
+        ranges[column] = (value, high) if bound == 'min' else (low, value)
+
+    return (args.get('location'), args.get('prefix'),
+            tuple(sorted((column, low, high)
+                         for column, (low, high) in ranges.items())))
+
+
+class CapacityCache:
+    def __init__(self, path=CAPACITY_PATH, cache_size=CACHE_SIZE):
+        """
+            Index of the capacity file, rebuilt when the file changes,
+                and payloads of the latest distinct queries.
+
+            :param      path:       str
+            :param      cache_size: int
+        """
+        self.path = path
+        self.cache_size = cache_size
+
+        self._index = None
+        self._payloads = OrderedDict()
+        self._lock = threading.Lock()
+
+    def index(self):
+        """
+            Raises OSError if the file cannot be read.
+
+            :return:    CapacityIndex
+        """
+        stat = os.stat(self.path)
+        source = (stat.st_size, stat.st_mtime_ns)
+
+        index = self._index
+        if index is None or index.source != source:
+            with self._lock:
+                if self._index is None or self._index.source != source:
+                    self._index = CapacityIndex.from_csv(self.path)
+                    self._payloads.clear()
+                index = self._index
+
+        return index
+
+    def get(self, args):
+        """
+            Raises ValueError for invalid query parameters.
+
+            :param      args:   dict, query parameters
+            :return:            Payload
+        """
+        index = self.index()
+        # parameters as sent, queries are parsed only when not cached
+        key = (index.source, tuple(sorted(args.items())))
+
+        with self._lock:
+            payload = self._payloads.get(key)
+            if payload is not None:
+                self._payloads.move_to_end(key)
+                return payload
+
+        location, prefix, ranges = parse_query(args, index)
+        records = index.query(location, prefix, {
+            column: (low, high) for column, low, high in ranges})
+        payload = make_payload({
+            'results': records,
+            'count': len(records),
+        })
+
+        with self._lock:
+            self._payloads[key] = payload
+            if len(self._payloads) > self.cache_size:
+                self._payloads.popitem(last=False)
+
+        return payload
+
+
+CAPACITY = CapacityCache()
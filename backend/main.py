@@ -1,8 +1,5 @@
-# Pandas for data management
-import pandas as pd
-
-# os methods for manipulating paths
-from os.path import dirname, join
+import os
+import sys
 
 # Bokeh basics 
 from bokeh.io import curdoc
@@ -12,22 +9,29 @@ from bokeh.resources import CDN
 from bokeh.embed import file_html
 
 
+# the scripts are imported from the package of the Flask app, so that
+# both share one mobility store
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+	sys.path.insert(0, ROOT_DIR)
+
 #from scripts.histogram import histogram_tab
-from scripts.searches import searches_tab
-from scripts.table import table_tab
+from backend.scripts.searches import searches_tab
+from backend.scripts.table import table_tab
+from backend.scripts.mobility import get_mobility_store
+from backend.scripts.stats import get_summary_stats
 
 
 
 from bokeh.sampledata.us_states import data as states
 
-# Read data into dataframes
-countries = pd.read_csv(join(dirname(__file__), 'data', 'Global_Mobility_Report2.csv'),
-						index_col=0).dropna()
+# Mobility report, partitioned by country and shared by all sessions
+store = get_mobility_store()
 
 # Create each of the tabs
 
-tab1 = searches_tab(countries)
-tab2 = table_tab(countries)
+tab1 = searches_tab(store)
+tab2 = table_tab(get_summary_stats())
 
 
 # Put all the tabs into one application
@@ -0,0 +1,301 @@
+import contextlib
+import contextvars
+import math
+import os
+import threading
+import time
+
+# instrumentation is a single global check when disabled
+ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+
+# seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10)
+
+# stages timed within the current request, (name, seconds)
+_timings = contextvars.ContextVar('timings', default=None)
+
+_NULL = contextlib.nullcontext()
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"')
+               .replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"'
+                          for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        """
+            Monotonic count, by label values.
+
+            :param      name:           str
+            :param      documentation:  str
+            :param      labelnames:     tuple of str
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}'
+                             f'{format_labels(self.labelnames, labels)} '
+                             f'{format_value(value)}')
+
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        """
+            Distribution of observed values in cumulative buckets,
+                by label values.
+
+            :param      name:           str
+            :param      documentation:  str
+            :param      labelnames:     tuple of str
+            :param      buckets:        tuple of float, upper bounds
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets) + (math.inf,)
+
+        # labels -> [count of each bucket, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        # first bucket that holds the value, buckets are few
+        index = 0
+        while value > self.buckets[index]:
+            index += 1
+
+        with self._lock:
+            values = self._values.get(labels)
+            if values is None:
+                values = self._values[labels] = [0] * len(self.buckets) + [0]
+            values[index] += 1
+            values[-1] += value
+
+    def count(self, *labels):
+        values = self._values.get(labels)
+        return sum(values[:-1]) if values is not None else 0
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, values in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, values):
+                    cumulative += count
+                    bucket = format_labels(self.labelnames, labels,
+                                           [('le', format_value(bound))])
+                    lines.append(f'{self.name}_bucket{bucket} {cumulative}')
+                label_text = format_labels(self.labelnames, labels)
+                lines.append(f'{self.name}_sum{label_text} '
+                             f'{format_value(float(values[-1]))}')
+                lines.append(f'{self.name}_count{label_text} {cumulative}')
+
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        """
+            Metrics rendered in the Prometheus text format, and values
+                read from other objects when rendered.
+        """
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self, name, documentation, kind, read):
+        """
+            :param      name:           str
+            :param      documentation:  str
+            :param      kind:           str, 'counter' or 'gauge'
+            :param      read:           callable, returns a number
+        """
+        self.collectors.append((name, documentation, kind, read))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+
+        for name, documentation, kind, read in self.collectors:
+            lines += [f'# HELP {name} {documentation}',
+                      f'# TYPE {name} {kind}',
+                      f'{name} {format_value(read())}']
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'http_request_duration_seconds', 'Latency of HTTP requests.',
+    ('endpoint', 'method', 'status')))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'stage_duration_seconds', 'Time spent in each stage of a prediction.',
+    ('stage',)))
+ERRORS = REGISTRY.register(Counter(
+    'errors_total', 'Failed requests by endpoint and cause.',
+    ('endpoint', 'cause')))
+FORECAST_LOOKUPS = REGISTRY.register(Counter(
+    'forecast_lookups_total', 'Lookups of precomputed forecasts.',
+    ('result',)))
+
+
+class Stage:
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, time.perf_counter() - self.started)
+
+
+def stage(name):
+    """
+        Times a block as a stage of the current request:
+            with stage('rollout'): ...
+
+        :param      name:   str
+        :return:            context manager
+    """
+    if not ENABLED:
+        return _NULL
+
+    return Stage(name)
+
+
+def record(name, seconds):
+    """
+        Records the duration of a stage.
+
+        :param      name:       str
+        :param      seconds:    float
+    """
+    if not ENABLED:
+        return
+
+    STAGE_SECONDS.observe(seconds, name)
+    timings = _timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+def count_error(endpoint, error):
+    """
+        :param      endpoint:   str
+        :param      error:      Exception or str, the cause
+    """
+    if not ENABLED:
+        return
+
+    cause = error if isinstance(error, str) else type(error).__name__
+    ERRORS.inc(endpoint, cause)
+
+
+def server_timing(timings, total):
+    """
+        Server-Timing header of the stages of a request, durations of
+            stages with the same name are summed.
+
+        :param      timings:    list of (str, float)
+        :param      total:      float, seconds
+        :return:                str
+    """
+    durations = {}
+    for name, seconds in timings:
+        durations[name] = durations.get(name, 0) + seconds
+    durations['total'] = total
+
+    return ', '.join(f'{name};dur={seconds * 1000:.3f}'
+                     for name, seconds in durations.items())
+
+
+def init_app(app):
+    """
+        Times every request of a Flask app, adds Server-Timing headers
+            and serves /metrics. Does nothing when metrics are disabled.
+
+        :param      app:    flask.Flask
+    """
+    if not ENABLED:
+        return
+
+    from flask import Response, g, request
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+        g.metrics_token = _timings.set([])
+
+    @app.after_request
+    def stop_timer(response):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return response
+
+        total = time.perf_counter() - started
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.observe(total, endpoint, request.method,
+                                str(response.status_code))
+
+        response.headers['Server-Timing'] = server_timing(_timings.get() or [],
+                                                          total)
+        return response
+
+    @app.teardown_request
+    def reset_timings(exception=None):
+        token = g.pop('metrics_token', None)
+        if token is not None:
+            _timings.reset(token)
+
+    @app.route('/metrics')
+    def get_metrics():
+        """
+            Metrics in the Prometheus text format.
+
+            :return: text/plain
+        """
+        return Response(REGISTRY.render(),
+                        mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,89 @@
+# Bokeh data source updated with patches and streams only
+from bokeh.models import ColumnDataSource
+
+import numpy as np
+
+
+class CurveSource:
+	"""
+		ColumnDataSource of labelled curves for multi_line, with one row
+			(slot) per curve.
+
+		An update sends only what changed: rows of curves whose values
+			changed, or of new curves taking a free slot, are patched; new
+			curves stream new rows when there is no free slot; rows of
+			removed curves are patched to empty curves and freed. Other
+			rows are never resent.
+
+		Colors are assigned by slot, so a curve keeps its color.
+
+		:param      colors:     list of str
+	"""
+
+	def __init__(self, colors):
+		self.colors = colors
+		self.source = ColumnDataSource(data={'x': [], 'y': [],
+											 'color': [], 'label': []})
+		# label -> slot, and slot -> (x, y) currently sent
+		self.slots = {}
+		self._curves = {}
+
+	def update(self, curves):
+		"""
+			:param      curves:     dict, label -> (x, y) numpy.ndarray
+			:return:                dict, number of patched and streamed
+										rows
+		"""
+		patches = {'x': [], 'y': [], 'color': [], 'label': []}
+		streamed = {'x': [], 'y': [], 'color': [], 'label': []}
+
+		# Free the rows of removed curves
+		for label in [label for label in self.slots if label not in curves]:
+			slot = self.slots.pop(label)
+			self._curves.pop(slot)
+			patches['x'].append((slot, []))
+			patches['y'].append((slot, []))
+			patches['label'].append((slot, ''))
+
+		size = len(self.source.data['label'])
+		free = sorted(set(range(size)) - set(self.slots.values()))
+
+		for label, (x, y) in curves.items():
+			slot = self.slots.get(label)
+
+			if slot is not None:
+				sent_x, sent_y = self._curves[slot]
+				if np.array_equal(sent_x, x) and np.array_equal(sent_y, y):
+					continue
+				patches['x'].append((slot, x.tolist()))
+				patches['y'].append((slot, y.tolist()))
+
+			elif free:
+				slot = free.pop(0)
+				patches['x'].append((slot, x.tolist()))
+				patches['y'].append((slot, y.tolist()))
+				patches['color'].append(
+					(slot, self.colors[slot % len(self.colors)]))
+				patches['label'].append((slot, label))
+
+			else:
+				slot = size + len(streamed['label'])
+				streamed['x'].append(x.tolist())
+				streamed['y'].append(y.tolist())
+				streamed['color'].append(self.colors[slot % len(self.colors)])
+				streamed['label'].append(label)
+
+			self.slots[label] = slot
+			self._curves[slot] = (x, y)
+
+		# Only send the columns that changed, in one message each
+		patches = {column: changes for column, changes in patches.items()
+				   if changes}
+		if patches:
+			self.source.patch(patches)
+		if streamed['label']:
+			self.source.stream(streamed)
+
+		return {'patched': len({slot for changes in patches.values()
+								for slot, _ in changes}),
+				'streamed': len(streamed['label'])}
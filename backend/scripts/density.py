@@ -0,0 +1,181 @@
+# numpy for binning, scipy for the FFT convolution
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy.signal import fftconvolve
+
+# Fixed grid on which values are binned, it covers the range slider
+# of the density plot and is extended to cover the data
+GRID_START = -60
+GRID_END = 180
+GRID_STEP = 0.1
+
+# Number of points at which densities are evaluated
+POINTS = 100
+
+# Kernels are truncated beyond this many standard deviations
+KERNEL_TAIL = 5
+
+CACHE_SIZE = 4096
+
+
+class DensityEngine:
+	"""
+		Gaussian kernel densities of the values of each country, matching
+			scipy.stats.gaussian_kde.
+
+		Values are binned once per country on a fixed grid with linear
+			binning, so a density over a range of values is an FFT
+			convolution of the bins in that range with the kernel, instead
+			of a sum over every value at every point. Counts, means and
+			variances of a range, which set the bandwidth, are exact.
+
+		Densities are cached by (country, range_start, range_end, bandwidth).
+
+		:param      values:     dict, country -> numpy.ndarray of values
+		:param      cache_size: int
+	"""
+
+	def __init__(self, values, cache_size=CACHE_SIZE):
+		finite = [np.asarray(v, dtype=np.float64) for v in values.values()]
+		finite = np.concatenate([v[np.isfinite(v)] for v in finite] or [[]])
+
+		low, high = GRID_START, GRID_END
+		if len(finite):
+			low = min(low, np.floor(finite.min()))
+			high = max(high, np.ceil(finite.max()))
+
+		self.grid_start = low
+		self.grid = low + GRID_STEP * np.arange(
+			int(round((high - low) / GRID_STEP)) + 1)
+
+		self._countries = {country: self._prepare(v)
+						   for country, v in values.items()}
+
+		self._cache = OrderedDict()
+		self._cache_size = cache_size
+		self._lock = threading.Lock()
+
+	@classmethod
+	def from_store(cls, store, category='residential',
+				   cache_size=CACHE_SIZE):
+		return cls({country: store.column(country, category)
+					for country in store.countries()},
+				   cache_size=cache_size)
+
+	def _prepare(self, values):
+		values = np.sort(np.asarray(values, dtype=np.float64))
+		values = values[np.isfinite(values)]
+
+		# Linear binning, each value is split between its two grid points
+		position = (values - self.grid_start) / GRID_STEP
+		lower = np.clip(np.floor(position).astype(np.int64),
+						0, len(self.grid) - 2)
+		weight = position - lower
+		bins = np.bincount(lower, 1 - weight, minlength=len(self.grid)) + \
+			np.bincount(lower + 1, weight, minlength=len(self.grid))
+
+		# Prefix sums give the count, mean and variance of any range
+		sums = np.concatenate([[0], np.cumsum(values)])
+		squares = np.concatenate([[0], np.cumsum(values ** 2)])
+
+		return values, bins, sums, squares
+
+	def density(self, country, range_start, range_end, bandwidth=None):
+		"""
+			Density of the values of a country within [range_start,
+				range_end], evaluated at POINTS evenly spaced points.
+
+			Raises KeyError for an unknown country.
+
+			:param      bandwidth:  float, factor of the standard deviation
+									as bw_method of gaussian_kde, or None
+									for Scott's rule
+			:return:    x:          numpy.ndarray, (POINTS, )
+						y:          numpy.ndarray, (POINTS, )
+		"""
+		key = (country, range_start, range_end, bandwidth)
+
+		with self._lock:
+			if key in self._cache:
+				self._cache.move_to_end(key)
+				return self._cache[key]
+
+		result = self._compute(self._countries[country],
+							   range_start, range_end, bandwidth)
+
+		# Cached arrays are shared between callers
+		for array in result:
+			array.flags.writeable = False
+
+		with self._lock:
+			self._cache[key] = result
+			if len(self._cache) > self._cache_size:
+				self._cache.popitem(last=False)
+
+		return result
+
+	def _compute(self, prepared, range_start, range_end, bandwidth):
+		values, bins, sums, squares = prepared
+
+		x = np.linspace(range_start, range_end, POINTS)
+		y = np.zeros(POINTS)
+
+		first = np.searchsorted(values, range_start, side='left')
+		last = np.searchsorted(values, range_end, side='right')
+		n = last - first
+
+		if n < 2:
+			return x, y
+
+		mean = (sums[last] - sums[first]) / n
+		variance = (squares[last] - squares[first] - n * mean ** 2) / (n - 1)
+
+		# Constant values, up to rounding of the prefix sums
+		if variance <= 1e-12 * max(mean ** 2, 1):
+			return x, y
+
+		factor = n ** (-1 / 5) if bandwidth is None else bandwidth
+		sigma = factor * np.sqrt(variance)
+
+		# Bins of the range
+		start = max(int(np.ceil((range_start - self.grid_start) / GRID_STEP
+								- 1e-9)), 0)
+		end = min(int(np.floor((range_end - self.grid_start) / GRID_STEP
+							   + 1e-9)), len(self.grid) - 1)
+
+		if end < start:
+			return x, y
+
+		window = bins[start:end + 1]
+
+		half = min(int(np.ceil(KERNEL_TAIL * sigma / GRID_STEP)),
+				   len(window) - 1)
+		offsets = GRID_STEP * np.arange(-half, half + 1)
+		kernel = np.exp(-0.5 * (offsets / sigma) ** 2)
+
+		smoothed = fftconvolve(window, kernel, mode='same')
+		smoothed /= n * sigma * np.sqrt(2 * np.pi)
+
+		y = np.interp(x, self.grid[start:end + 1], np.maximum(smoothed, 0))
+
+		return x, y
+
+
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+
+
+def get_density_engine(store, category='residential'):
+	# Engine shared by all sessions, for each version of the store
+	key = (store.source, category)
+
+	with _ENGINES_LOCK:
+		engine = _ENGINES.get(key)
+		if engine is None:
+			engine = DensityEngine.from_store(store, category)
+			_ENGINES.clear()
+			_ENGINES[key] = engine
+
+	return engine
@@ -0,0 +1,188 @@
+# numpy for the arrays, pandas only to parse the CSV file
+import json
+import os
+import threading
+from os.path import dirname, join
+
+import numpy as np
+import pandas as pd
+
+DATA_DIR = join(dirname(dirname(__file__)), 'data')
+FILENAME = 'Global_Mobility_Report2.csv'
+CACHE_DIR = join(DATA_DIR, '.cache', os.path.splitext(FILENAME)[0])
+
+# Mobility categories, in the order of the columns of the report
+CATEGORIES = ('retail_and_recreation', 'grocery_and_pharmacy', 'parks',
+			  'transit_stations', 'workplaces', 'residential')
+
+ARRAYS = ('names', 'codes', 'offsets', 'dates', 'values')
+SOURCE_FILE = 'source.json'
+
+
+def fingerprint(path):
+	# Version of a file, by its size and modification time
+	stat = os.stat(path)
+
+	return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+
+class MobilityStore:
+	"""
+		Mobility report partitioned by country.
+
+		Rows of a country are contiguous and sorted by date, the partition
+			of names[i] is offsets[i]:offsets[i + 1].
+
+		Shapes: C is the number of countries, N the number of rows.
+			names       (C, )       str, country_region
+			codes       (C, )       str, country_region_code
+			offsets     (C + 1, )   int64
+			dates       (N, )       datetime64[D]
+			values      (6, N)      float64, one row per category
+
+		:param      source:     str, fingerprint of the source file
+	"""
+
+	def __init__(self, names, codes, offsets, dates, values, source=None):
+		self.names = names
+		self.codes = codes
+		self.offsets = offsets
+		self.dates = dates
+		self.values = values
+		self.source = source
+
+		self._index = {str(name): (int(offsets[i]), int(offsets[i + 1]))
+					   for i, name in enumerate(names)}
+
+	def __contains__(self, country):
+		return country in self._index
+
+	def __len__(self):
+		return len(self.dates)
+
+	def countries(self):
+		# Country names, sorted
+		return list(self._index)
+
+	def code(self, country):
+		return str(self.codes[self.names.searchsorted(country)])
+
+	def dates_of(self, country):
+		start, end = self._index[country]
+
+		return self.dates[start:end]
+
+	def column(self, country, category):
+		"""
+			Values of a category for a country, as a contiguous view.
+
+			Raises KeyError for an unknown country or category.
+
+			:param      country:    str, country_region
+			:param      category:   str, one of CATEGORIES
+			:return:                numpy.ndarray, (rows of the country, )
+		"""
+		if category not in CATEGORIES:
+			raise KeyError(category)
+
+		start, end = self._index[country]
+
+		return self.values[CATEGORIES.index(category), start:end]
+
+	def columns(self, country):
+		# Views of all categories for a country
+		return {category: self.column(country, category)
+				for category in CATEGORIES}
+
+	@classmethod
+	def from_csv(cls, path=join(DATA_DIR, FILENAME)):
+		# 'NA' is the code of Namibia, only empty fields are missing
+		report = pd.read_csv(path, keep_default_na=False, na_values={
+			category: [''] for category in CATEGORIES})
+
+		# Rows with a missing category are left out, as the tabs always did
+		report = report.dropna(subset=list(CATEGORIES))
+
+		names = report['country_region'].values.astype(str)
+		codes = report['country_region_code'].values.astype(str)
+		dates = pd.to_datetime(report['date'], format='%d-%b-%y') \
+			.values.astype('datetime64[D]')
+		values = report[list(CATEGORIES)].values.astype(np.float64).T
+
+		# Group countries together, keeping dates in order
+		order = np.lexsort((dates, names))
+		names, codes, dates = names[order], codes[order], dates[order]
+		values = np.ascontiguousarray(values[:, order])
+
+		unique_names, starts = np.unique(names, return_index=True)
+		offsets = np.append(starts, len(names)).astype(np.int64)
+
+		return cls(unique_names, codes[starts], offsets, dates, values,
+				   source=fingerprint(path))
+
+	def save(self, directory=CACHE_DIR):
+		# Arrays are written as .npy files, so they can be memory-mapped,
+		# the source file is written last and marks the cache as complete
+		os.makedirs(directory, exist_ok=True)
+
+		for name in ARRAYS:
+			tmp_path = join(directory, f'{name}.tmp.npy')
+			np.save(tmp_path, getattr(self, name))
+			os.replace(tmp_path, join(directory, f'{name}.npy'))
+
+		tmp_path = join(directory, f'{SOURCE_FILE}.tmp')
+		with open(tmp_path, 'w') as file:
+			json.dump({'source': self.source}, file)
+		os.replace(tmp_path, join(directory, SOURCE_FILE))
+
+	@classmethod
+	def load(cls, directory=CACHE_DIR, mmap_mode='r'):
+		# Raises OSError if the cache does not exist
+		with open(join(directory, SOURCE_FILE)) as file:
+			source = json.load(file)['source']
+
+		arrays = [np.load(join(directory, f'{name}.npy'), mmap_mode=mmap_mode)
+				  for name in ARRAYS]
+
+		return cls(*arrays, source=source)
+
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+
+def get_mobility_store(path=join(DATA_DIR, FILENAME), cache_dir=CACHE_DIR):
+	"""
+		Returns the mobility store shared by all sessions of the process.
+
+		The store is memory-mapped read-only from the binary cache, which
+			is rebuilt from the CSV file only when the CSV file changes,
+			so processes serving the same file share its pages too.
+
+		:param      path:       str
+		:param      cache_dir:  str
+		:return:                MobilityStore
+	"""
+	global _STORE
+
+	source = fingerprint(path)
+	store = _STORE
+	if store is not None and store.source == source:
+		return store
+
+	with _STORE_LOCK:
+		if _STORE is not None and _STORE.source == source:
+			return _STORE
+
+		try:
+			store = MobilityStore.load(cache_dir)
+		except (OSError, ValueError, KeyError):
+			store = None
+
+		if store is None or store.source != source:
+			MobilityStore.from_csv(path).save(cache_dir)
+			store = MobilityStore.load(cache_dir)
+
+		_STORE = store
+
+		return store
@@ -6,56 +6,38 @@ from bokeh.plotting import figure, output_file
 from bokeh.resources import CDN
 from bokeh.embed import file_html
 
-from scipy.stats import gaussian_kde
+from backend.scripts.density import get_density_engine
+from backend.scripts.curves import CurveSource
 
 from bokeh.plotting import figure
 from bokeh.models import (CategoricalColorMapper, HoverTool, 
 						  ColumnDataSource, Panel, 
-						  FuncTickFormatter, SingleIntervalTicker, LinearAxis)
+						  FuncTickFormatter, SingleIntervalTicker, LinearAxis,
+						  Legend, LegendItem)
 from bokeh.models.widgets import (CheckboxGroup, Slider, RangeSlider, 
 								  Tabs, CheckboxButtonGroup, 
 								  TableColumn, DataTable, Select)
 from bokeh.layouts import column, row, WidgetBox, gridplot, Spacer, Box
 from bokeh.palettes import Category20_16
 
-def searches_tab(countries):
+# Slider changes are applied once the slider rests for this long
+DEBOUNCE_MS = 150
+
+def searches_tab(store):
 	
 	# Dataset for density plot based on carriers, range of delays,
 	# and bandwidth for density estimation
 	def make_dataset(country_list, range_start, range_end, bandwidth):
 
-		xs = []
-		ys = []
-		colors = []
-		labels = []
-
-		for i, country in enumerate(country_list):
-			subset = countries[countries['country_region'] == country]
-			subset = subset[subset['residential'].between(range_start, 
-														range_end)]
-
-
-
-			kde = gaussian_kde(subset['residential'], bw_method=bandwidth)
-
-			
-			# Evenly space x values
-			x = np.linspace(range_start, range_end, 100)
-			# Evaluate pdf at every value of x
-			y = kde.pdf(x)
-
-			# Append the values to plot
-			xs.append(list(x))
-			ys.append(list(y))
-
-			# Append the colors and label
-			colors.append(country_colors[i])
-			labels.append(country)
+		curves = {}
 
-		new_src = ColumnDataSource(data={'x': xs, 'y': ys, 
-								   'color': colors, 'label': labels})
+		for country in country_list:
+			# Evaluate the pdf at 100 evenly spaced values of x,
+			# from the pre-binned values of the country
+			curves[country] = density.density(country, range_start,
+											  range_end, bandwidth)
 
-		return new_src
+		return curves
 
 	def make_plot(src):
 		p = figure(plot_width = 700, plot_height = 700,
@@ -63,9 +45,14 @@ def searches_tab(countries):
 				   x_axis_label = 'Number of Searches', y_axis_label = 'Scaled Value')
 
 
-		p.multi_line('x', 'y', color = 'color', legend = 'label',
-					 line_width = 3,
-					 source = src)
+		renderer = p.multi_line('x', 'y', color = 'color',
+								line_width = 3,
+								source = src.source)
+
+		# Legend items point at the rows of the countries shown,
+		# free rows of the source have none
+		legend = Legend(items = make_legend_items(src, renderer))
+		p.add_layout(legend)
 
 		# Hover tool with next line policy
 		hover = HoverTool(tooltips=[('Country', '@label'), 
@@ -78,8 +65,13 @@ def searches_tab(countries):
 
 		p = style(p)
 
-		return p
-	
+		return p, renderer, legend
+
+	def make_legend_items(src, renderer):
+		return [LegendItem(label = label, renderers = [renderer], index = slot)
+				for label, slot in sorted(src.slots.items(),
+										  key = lambda item: item[1])]
+
 	def update(attr, old, new):
 
 		country_to_plot = [country_selection.labels[i] for i in 
@@ -93,13 +85,30 @@ def searches_tab(countries):
 			bandwidth = bandwidth_select.value
 			
 		
-		new_src = make_dataset(country_to_plot,
-									range_start = range_select.value[0],
-									range_end = range_select.value[1],
-									bandwidth = bandwidth
-							   		)
-		
-		src.data.update(new_src.data)
+		curves = make_dataset(country_to_plot,
+							  range_start = range_select.value[0],
+							  range_end = range_select.value[1],
+							  bandwidth = bandwidth
+							  )
+
+		# Only send the curves that were added, removed or changed
+		src.update(curves)
+		legend.items = make_legend_items(src, renderer)
+
+	def debounced_update(attr, old, new):
+		# Restart the wait on every slider event, only the last one applies
+		doc = curdoc()
+		if pending[0] is not None:
+			try:
+				doc.remove_timeout_callback(pending[0])
+			except ValueError:
+				pass
+
+		def apply():
+			pending[0] = None
+			update(attr, old, new)
+
+		pending[0] = doc.add_timeout_callback(apply, DEBOUNCE_MS)
 		
 	def style(p):
 		# Title 
@@ -120,12 +129,17 @@ def searches_tab(countries):
 		return p
 	
 
-	available_countries = list(set(countries['country_region']))
-	available_countries.sort()
+	# Residential values of each country, binned once for all sessions
+	density = get_density_engine(store, 'residential')
+
+	available_countries = store.countries()
 
 	country_colors = Category20_16
 	sorted(country_colors)
 
+	# Timeout callback of the last slider event, not applied yet
+	pending = [None]
+
 
 
 	country_selection = CheckboxGroup(labels=available_countries, 
@@ -134,7 +148,7 @@ def searches_tab(countries):
 	
 	range_select = RangeSlider(start = -60, end = 180, value = (-60, 120),
 							   step = 5, title = 'Range of Delays (min)')
-	range_select.on_change('value', update)
+	range_select.on_change('value', debounced_update)
 	
 
 	initial_countries = [country_selection.labels[i] for 
@@ -144,7 +158,7 @@ def searches_tab(countries):
 	bandwidth_select = Slider(start = 0.1, end = 5, 
 							  step = 0.1, value = 0.5,
 							  title = 'Bandwidth for Density Plot')
-	bandwidth_select.on_change('value', update)
+	bandwidth_select.on_change('value', debounced_update)
 	
 	# Whether to set the bandwidth or have it done automatically
 	bandwidth_choose = CheckboxButtonGroup(
@@ -152,13 +166,14 @@ def searches_tab(countries):
 	bandwidth_choose.on_change('active', update)
 
 	# Make the density data source
-	src = make_dataset(initial_countries, 
-						range_start = range_select.value[0],
-						range_end = range_select.value[1],
-						bandwidth = bandwidth_select.value) 
+	src = CurveSource(country_colors)
+	src.update(make_dataset(initial_countries, 
+							range_start = range_select.value[0],
+							range_end = range_select.value[1],
+							bandwidth = bandwidth_select.value))
 	
 	# Make the density plot
-	p = make_plot(src)
+	p, renderer, legend = make_plot(src)
 	
 	# Add style to the plot
 	p = style(p)
@@ -0,0 +1,118 @@
+# Summary statistics of the mobility report, computed once per version
+import hashlib
+import json
+import os
+import threading
+from os.path import join
+
+import numpy as np
+
+from backend.scripts.mobility import CACHE_DIR, CATEGORIES, DATA_DIR, \
+	FILENAME, fingerprint, get_mobility_store
+
+# Statistics of each category, as computed by pandas' describe()
+STATISTICS = ('count', 'mean', 'std', 'min', '25%', 'median', '75%', 'max')
+
+STATS_FILE = 'summary_stats.json'
+
+
+def file_hash(path):
+	digest = hashlib.sha1()
+	with open(path, 'rb') as file:
+		for chunk in iter(lambda: file.read(1 << 20), b''):
+			digest.update(chunk)
+
+	return digest.hexdigest()
+
+
+def compute_summary_stats(store):
+	"""
+		Statistics of every category for every country.
+
+		:param      store:  MobilityStore
+		:return:            dict, category -> columns of the table,
+								'country' and each of STATISTICS
+	"""
+	countries = store.countries()
+	summary_stats = {}
+
+	for category in CATEGORIES:
+		columns = {'country': countries}
+		columns.update({statistic: [] for statistic in STATISTICS})
+
+		for country in countries:
+			values = store.column(country, category)
+			quartiles = np.percentile(values, [25, 50, 75])
+
+			columns['count'].append(len(values))
+			columns['mean'].append(float(values.mean()))
+			columns['std'].append(float(values.std(ddof=1))
+								  if len(values) > 1 else None)
+			columns['min'].append(float(values.min()))
+			columns['25%'].append(float(quartiles[0]))
+			columns['median'].append(float(quartiles[1]))
+			columns['75%'].append(float(quartiles[2]))
+			columns['max'].append(float(values.max()))
+
+		summary_stats[category] = columns
+
+	return summary_stats
+
+
+_STATS = {}
+# ((path, fingerprint), hash) of the last report hashed
+_HASH = None
+_STATS_LOCK = threading.Lock()
+
+
+def get_summary_stats(path=join(DATA_DIR, FILENAME), cache_dir=CACHE_DIR):
+	"""
+		Returns the summary statistics of the mobility report, shared by
+			all sessions of the process.
+
+		Statistics are kept in the process and on disk for the hash of
+			the report, the file is only hashed again when its size or
+			modification time change.
+
+		:param      path:       str
+		:param      cache_dir:  str
+		:return:                dict, see compute_summary_stats()
+	"""
+	global _HASH
+
+	source = fingerprint(path)
+
+	with _STATS_LOCK:
+		if _HASH is not None and _HASH[0] == (path, source):
+			content_hash = _HASH[1]
+		else:
+			content_hash = file_hash(path)
+			_HASH = ((path, source), content_hash)
+
+		summary_stats = _STATS.get(content_hash)
+		if summary_stats is not None:
+			return summary_stats
+
+		stats_path = join(cache_dir, STATS_FILE)
+		try:
+			with open(stats_path) as file:
+				cached = json.load(file)
+			if cached['hash'] == content_hash:
+				summary_stats = cached['stats']
+		except (OSError, ValueError, KeyError):
+			pass
+
+		if summary_stats is None:
+			summary_stats = compute_summary_stats(
+				get_mobility_store(path, cache_dir))
+
+			os.makedirs(cache_dir, exist_ok=True)
+			tmp_path = f'{stats_path}.tmp'
+			with open(tmp_path, 'w') as file:
+				json.dump({'hash': content_hash, 'stats': summary_stats}, file)
+			os.replace(tmp_path, stats_path)
+
+		_STATS.clear()
+		_STATS[content_hash] = summary_stats
+
+		return summary_stats
@@ -3,30 +3,53 @@ import pandas as pd
 import numpy as np
 
 from bokeh.models import ColumnDataSource, Panel
-from bokeh.models.widgets import TableColumn, DataTable
+from bokeh.models.widgets import TableColumn, DataTable, Select
+from bokeh.layouts import column
 
-def table_tab(countries):
+def table_tab(summary_stats):
 
-	# Calculate summary stats for table
-	country_stats = countries.groupby(['country_region'])['residential'].describe()
-	country_stats = country_stats.reset_index().rename(
-		columns={'country_region': 'country',  '50%':'median'})
+	# Summary stats for table, computed once for every category
+	# and shared by all sessions
+	categories = list(summary_stats)
 
-	# Round statistics for display
-	country_stats['mean'] = country_stats['mean'].round(2)
-	country_src = ColumnDataSource(country_stats)
+	def make_dataset(category):
+		country_stats = dict(summary_stats[category])
+
+		# Round statistics for display
+		country_stats['mean'] = np.round(country_stats['mean'], 2)
+
+		return country_stats
+
+	def make_columns(category):
+		name = category.replace('_', ' ').title()
+
+		return [TableColumn(field='country', title='Country'),
+				#TableColumn(field='date', title='Date'),
+				TableColumn(field='min', title=f'Min {name} Searches %'),
+				TableColumn(field='mean', title=f'Mean {name} Searches %'),
+				TableColumn(field='median', title=f'Median {name} Searches %'),
+				TableColumn(field='max', title=f'Max {name} Searches %')]
+
+	def update(attr, old, new):
+		country_src.data = make_dataset(new)
+		country_table.columns = make_columns(new)
+
+	country_src = ColumnDataSource(make_dataset('residential'))
 
 	# Columns of table
-	table_columns = [TableColumn(field='country', title='Country'),
-					 #TableColumn(field='date', title='Date'),
-					 TableColumn(field='min', title='Min Residential Searches %'),
-					 TableColumn(field='mean', title='Mean Residential Searches %'),
-					 TableColumn(field='median', title='Median Residential Searches %'),
-					 TableColumn(field='max', title='Max Residential Searches %')]
+	table_columns = make_columns('residential')
 
 	country_table = DataTable(source=country_src, 
 							  columns=table_columns, width=1000)
 
-	tab = Panel(child = country_table, title = 'Summary Table')
+	# Category of the statistics
+	category_select = Select(title='Category', value='residential',
+							 options=[(category,
+									   category.replace('_', ' ').title())
+									  for category in categories])
+	category_select.on_change('value', update)
+
+	tab = Panel(child = column(category_select, country_table),
+				title = 'Summary Table')
 
 	return tab
\ No newline at end of file
@@ -1,13 +1,50 @@
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
+import numpy as np
+from bokeh.application.handlers import ScriptHandler
+from bokeh.document import Document
 from flask import json
 
-from backend.app import create_app
+from backend import bench, metrics
+from backend.app import create_app, preload
+from backend.bokeh_server import MAIN_PATH, get_embed
+from backend.cache import VersionedCache, make_cached_response, make_payload
+from backend.capacity import CapacityCache, CapacityIndex
+from backend.ML.PolyReg import fit_trend
+from backend.ML.RNN import RNN
+from backend.ML.features import FEATURES, FeatureStore, get_feature_store
+from backend.ML.forecasts import ForecastTable
+from backend.ML.inference import export_weights, load_numpy_model
+from backend.ML.ingest import ingest, read_watermarks
+from backend.ML.map_data import MAP_DATA, RETRY_ATTEMPTS, build_map_data, \
+    data_version
+from backend.ML.registry import ModelRegistry, model_path, weights_path, \
+    load_keras_model, MODEL_SUFFIX
+from backend.ML.rollout import rollout
+from backend.ML.service import InferenceService, QueueFull
+from backend.ML.train import read_manifest, train_models
+from backend.ML.store import CaseStore, get_case_store, current_version
+from backend.ML.utils import load_data, preprocess, filter_by_country, \
+    separate, to_ordinals, apply_lookback, Series, DATASET_DIR, FILENAME
+from backend.scripts.curves import CurveSource
+from backend.scripts.density import DensityEngine
+from backend.scripts.mobility import MobilityStore, get_mobility_store
+from backend.scripts.stats import get_summary_stats
 
 
 class TestCase(unittest.TestCase):
     def setUp(self):
-        self.app = create_app()
+        self.app = create_app({'BOKEH_MODE': 'off'})
         self.client = self.app.test_client
 
     def tearDown(self):
@@ -20,21 +57,1068 @@ class TestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 400)
         self.assertEqual(data['name'], 'Bad Request')
 
-        # successful call
-        request_data = json.dumps({
+        # successful call, /survey reads form data
+        request_data = {
               "country_region_code": "US",
               "look_forward_days": 3,
-              "starting_day": "2020-05-01"
-        })
+              "requested_date": "2020-05-01"
+        }
 
         res = self.client().post('/survey', data=request_data)
         data = json.loads(res.data)
 
-        self.assertEqual(data['prediction'], str(26489))
+        self.assertEqual(data['prediction_new_cases'], str(27332))
+        self.assertEqual(data['starting_date'], '2020-05-01')
+        self.assertEqual(data['prediction_date'], '2020-05-04')
         # self.assertEqual(data['message'], '')
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['success'])
 
+        # predictions of the baseline implementation, which read the CSV
+        # file with pandas for every request
+        for requested_date, prediction_date, new_cases in (
+                ('2020-03-10', '2020-03-13', 1553),
+                ('2020-04-01', '2020-04-04', 25727),
+                ('2020-04-20', '2020-04-23', 29756),
+                ('2020-05-15', '2020-05-18', 26789),
+                ('2020-06-01', '2020-06-04', 26710)):
+            data = json.loads(self.client().post('/survey', data=dict(
+                request_data, requested_date=requested_date)).data)
+            self.assertEqual(data['prediction_date'], prediction_date)
+            self.assertEqual(data['prediction_new_cases'], str(new_cases))
+
+    def test_get_codes(self):
+        res = self.client().get('/codes')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn({'country_code': 'US', 'map_name': 'usa_en'},
+                      data['results'])
+        self.assertEqual(res.headers['Access-Control-Allow-Origin'], '*')
+
+        res = self.client().get('/codes', headers={
+            'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+        res = self.client().get('/codes', headers={
+            'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(res.data)), data)
+
+        # brotli is optional, without it payloads are only gzip compressed
+        with mock.patch('backend.cache.brotli', None):
+            self.assertEqual(list(make_payload(data).variants), ['gzip'])
+            with self.assertLogs('backend.app', 'WARNING') as logs:
+                create_app({'BOKEH_MODE': 'off'})
+        self.assertTrue(any('brotli is not installed' in line
+                            for line in logs.output))
+
+        brotli = mock.Mock()
+        brotli.compress.return_value = b'compressed'
+        with mock.patch('backend.cache.brotli', brotli):
+            payload = make_payload(data)
+        with self.app.test_request_context(headers={
+                'Accept-Encoding': 'br, gzip'}):
+            response = make_cached_response(payload)
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertEqual(response.get_data(), b'compressed')
+
+    def test_model_registry(self):
+        models_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, models_dir)
+        for country_code in ('US', 'FR', 'DE'):
+            open(model_path(country_code, models_dir), 'w').close()
+
+        registry = ModelRegistry(loader=lambda path: object(), capacity=2,
+                                 models_dir=models_dir)
+
+        model = registry.get('US')
+        self.assertIs(registry.get('US'), model)
+
+        # a changed file is loaded again
+        stat = os.stat(model_path('US', models_dir))
+        os.utime(model_path('US', models_dir),
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertIsNot(registry.get('US'), model)
+
+        # the least recently used model is dropped
+        registry.get('FR')
+        registry.get('DE')
+
+        stats = registry.stats()
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['reloads'], 1)
+        self.assertEqual(stats['evictions'], 1)
+
+        with self.assertRaises(OSError):
+            registry.get('XX')
+
+        # a slow load holds up neither other countries nor a second load
+        started, release = threading.Event(), threading.Event()
+
+        def slow_loader(path):
+            if path.endswith(f'US{MODEL_SUFFIX}'):
+                started.set()
+                release.wait(10)
+            return object()
+
+        registry = ModelRegistry(loader=slow_loader, models_dir=models_dir)
+        registry.get('FR')
+        with ThreadPoolExecutor(2) as executor:
+            first = executor.submit(registry.get, 'US')
+            started.wait(10)
+            second = executor.submit(registry.get, 'US')
+            registry.get('FR')
+            registry.get('DE')
+            self.assertFalse(first.done())
+            release.set()
+            self.assertIs(first.result(), second.result())
+        self.assertEqual(registry.stats()['misses'], 3)
+
+    def test_case_store(self):
+        df = filter_by_country(preprocess(load_data()), 'US')
+        expected_dates, expected_cases = separate(df)
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        get_case_store().save(cache_dir)
+        store = CaseStore.load(cache_dir)
+
+        dates, new_cases = store.series('US')
+        self.assertTrue((dates == to_ordinals(expected_dates[:, 0])).all())
+        self.assertTrue((new_cases == expected_cases[:, 0]).all())
+        self.assertEqual(new_cases.dtype, 'float32')
+
+        self.assertNotIn('XX', store)
+        with self.assertRaises(KeyError):
+            store.series('XX')
+
+    def test_apply_lookback(self):
+        dataset = np.arange(6, dtype=np.float32).reshape(-1, 1)
+
+        X, Y = apply_lookback(dataset, look_back=3)
+        self.assertEqual(X.tolist(), [[0, 1, 2], [1, 2, 3], [2, 3, 4]])
+        self.assertEqual(Y.tolist(), [3, 4, 5])
+
+        X, Y = apply_lookback(dataset[:3], look_back=3)
+        self.assertEqual(X.shape, (0, 3))
+        self.assertEqual(Y.shape, (0,))
+
+    def test_rollout(self):
+        class SumModel:
+            def predict(self, x):
+                return x.sum(axis=-1)
+
+        windows = np.array([[1, 2, 3], [0, 0, 1]], dtype=np.float32)
+        predicted = rollout(SumModel(), windows, steps=4)
+
+        self.assertEqual(predicted.dtype, np.float32)
+        self.assertEqual(predicted.tolist(), [[6, 11, 20, 37], [1, 2, 4, 7]])
+
+        # noise is fed back with the predictions
+        noise = np.array([[1, 0, 0, 0], [0, 0, 0, -1]], dtype=np.float32)
+        predicted = rollout(SumModel(), windows, steps=4, noise=noise)
+        self.assertEqual(predicted.tolist(), [[7, 12, 22, 41], [1, 2, 4, 6]])
+
+    def test_post_survey_concurrent(self):
+        # the US model stands in for models of other countries
+        models_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, models_dir)
+        for country_code in ('US', 'FR', 'DE', 'IT'):
+            shutil.copy(model_path('US'), model_path(country_code, models_dir))
+
+        requests = [{'country_region_code': country_code,
+                     'look_forward_days': 3,
+                     'requested_date': requested_date}
+                    for country_code in ('US', 'FR', 'DE', 'IT')
+                    for requested_date in ('2020-04-15', '2020-05-20')]
+
+        def post(form):
+            res = self.client().post('/survey', data=form)
+            self.assertEqual(res.status_code, 200)
+            return json.loads(res.data)
+
+        with mock.patch('backend.ML.RNN.MODELS',
+                        ModelRegistry(models_dir=models_dir)):
+            expected = [post(form) for form in requests]
+
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                for _ in range(3):
+                    results = list(executor.map(post, requests))
+                    self.assertEqual(results, expected)
+
+        # countries are scaled by their own numbers of cases
+        self.assertEqual(len({data['prediction_new_cases']
+                              for data in expected}), len(expected))
+
+    def test_post_survey_batch(self):
+        requests = [{'country_region_code': 'US',
+                     'look_forward_days': 3,
+                     'requested_date': requested_date}
+                    for requested_date in ('2020-04-01', '2020-05-01',
+                                           '2020-05-15', '2021-01-01')]
+
+        res = self.client().post('/survey/batch', json={
+            'requests': requests + [
+                {'country_region_code': 'XX', 'look_forward_days': 3,
+                 'requested_date': '2020-05-01'},
+                {'country_region_code': 'US'},
+            ]})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['results']), 6)
+
+        for form, result in zip(requests, data['results']):
+            res = self.client().post('/survey', data=form)
+            self.assertEqual(result, json.loads(res.data))
+
+        self.assertEqual(data['results'][4]['error']['code'], 422)
+        self.assertEqual(data['results'][5]['error']['code'], 400)
+        self.assertFalse(data['results'][5]['success'])
+
+        res = self.client().post('/survey/batch', json={'requests': []})
+        self.assertEqual(res.status_code, 400)
+
+    def test_numpy_engine(self):
+        models_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, models_dir)
+        export_weights(model_path('US'), weights_path('US', models_dir))
+
+        keras_model = load_keras_model(model_path('US'))
+        numpy_model = load_numpy_model(weights_path('US', models_dir))
+        self.assertEqual(numpy_model.input_shape, keras_model.input_shape)
+
+        x = np.random.RandomState(7).rand(32, 1, 3).astype(np.float32)
+        np.testing.assert_allclose(numpy_model.predict(x),
+                                   keras_model.predict(x, verbose=0),
+                                   rtol=1e-5, atol=1e-6)
+
+        registry = ModelRegistry(models_dir=models_dir)
+        self.assertEqual(registry.path('US'), weights_path('US', models_dir))
+        registry.engine = 'keras'
+        self.assertEqual(registry.path('US'), model_path('US', models_dir))
+
+        # weights follow the content of the model, not modification times
+        registry.engine = 'numpy'
+        shutil.copy(model_path('US'), model_path('US', models_dir))
+        exported = os.stat(weights_path('US', models_dir)).st_mtime_ns
+        os.utime(model_path('US', models_dir),
+                 ns=(exported + 10 ** 9, exported + 10 ** 9))
+        self.assertEqual(registry.path('US'), weights_path('US', models_dir))
+        self.assertEqual(registry.look_back('US'), 3)
+
+        # models retrained after their export are run by Keras
+        keras_model.set_weights([weights + 0.01
+                                 for weights in keras_model.get_weights()])
+        keras_model.save(model_path('US', models_dir))
+        self.assertEqual(registry.path('US'), model_path('US', models_dir))
+        self.assertIs(type(registry.get('US')), type(keras_model))
+        self.assertEqual(registry.look_back('US'), 3)
+
+        # until they are exported again
+        export_weights(model_path('US', models_dir),
+                       weights_path('US', models_dir))
+        self.assertEqual(registry.path('US'), weights_path('US', models_dir))
+        self.assertIs(type(registry.get('US')), type(numpy_model))
+
+    def test_forecast_table(self):
+        models_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, models_dir)
+        shutil.copy(model_path('US'), model_path('US', models_dir))
+
+        form = {'country_region_code': 'US',
+                'look_forward_days': 3,
+                'requested_date': '2021-01-01'}
+
+        table = ForecastTable(f'{models_dir}/forecasts.sqlite',
+                              ModelRegistry(models_dir=models_dir))
+        self.assertIsNone(table.lookup('US', 3, '2021-01-01'))
+
+        with mock.patch('backend.ML.forecasts.FORECASTS', table):
+            res = self.client().post('/survey', data=form)
+            expected = json.loads(res.data)
+
+        self.assertEqual(table.refresh(), ['US'])
+        self.assertEqual(table.refresh(), [])
+
+        # dates in the past are predicted live
+        self.assertIsNone(table.lookup('US', 3, '2020-05-01'))
+        self.assertIsNone(table.lookup('US', 2, '2021-01-01'))
+
+        with mock.patch('backend.ML.forecasts.FORECASTS', table):
+            res = self.client().post('/survey', data=form)
+            self.assertEqual(json.loads(res.data), expected)
+
+        # a changed model invalidates its forecasts
+        with open(model_path('US', models_dir), 'ab') as file:
+            file.write(b'\0')
+        self.assertIsNone(table.lookup('US', 3, '2021-01-01'))
+
+        # only the hash of the current version is kept
+        self.assertEqual(list(table._hashes), ['US'])
+
+    def test_fit_trend(self):
+        dates = to_ordinals('2020-04-01') + np.arange(60, dtype=np.int32)
+        days = np.arange(60, dtype=np.float32)
+
+        # values before April 2020 are ignored
+        early = to_ordinals('2020-03-01') + np.arange(31, dtype=np.int32)
+        history = Series(np.append(early, dates),
+                         np.append(np.full(31, 100, np.float32),
+                                   (days - 20) ** 2 / 1000))
+
+        trend = fit_trend(history, look_back=3)
+        self.assertEqual(trend.label, 'upward')
+
+        x = (dates.astype(float) - trend.center) / trend.scale
+        np.testing.assert_allclose(np.polyval(trend.coefficients, x),
+                                   (days - 20) ** 2 / 1000, atol=1e-5)
+
+        history = Series(dates, -days)
+        self.assertEqual(fit_trend(history, look_back=3).label, 'downward')
+
+        history = Series(dates[:3], days[:3])
+        self.assertEqual(fit_trend(history, look_back=3).label, 'not_changed')
+
+        # the US trend at the end of the dataset goes up
+        res = self.client().post('/survey', data={
+            'country_region_code': 'US',
+            'look_forward_days': 3,
+            'requested_date': '2020-06-01'})
+        self.assertEqual(json.loads(res.data)['trend'], 'upward')
+
+    def test_density_engine(self):
+        from scipy.stats import gaussian_kde
+
+        rng = np.random.default_rng(0)
+        values = {'A': rng.integers(-7, 56, 105).astype(float),
+                  'B': np.full(50, 3.0)}
+        engine = DensityEngine(values)
+
+        for range_start, range_end, bandwidth in ((-60, 120, None),
+                                                  (-5, 30, 0.5),
+                                                  (0, 180, 2)):
+            x, y = engine.density('A', range_start, range_end, bandwidth)
+
+            subset = values['A'][(values['A'] >= range_start)
+                                 & (values['A'] <= range_end)]
+            expected = gaussian_kde(subset, bw_method=bandwidth).pdf(x)
+            np.testing.assert_allclose(y, expected, atol=1e-3 * expected.max())
+
+        # cached by (country, range, bandwidth)
+        self.assertIs(engine.density('A', -5, 30, 0.5),
+                      engine.density('A', -5, 30, 0.5))
+
+        # no density for constant values or an empty range
+        self.assertFalse(engine.density('B', -60, 120)[1].any())
+        self.assertFalse(engine.density('A', 100, 180)[1].any())
+
+    def test_mobility_store(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        path = f'{directory}/report.csv'
+        with open(path, 'w') as file:
+            file.write('country_region_code,country_region,date,'
+                       'retail_and_recreation,grocery_and_pharmacy,parks,'
+                       'transit_stations,workplaces,residential\n'
+                       'NA,Namibia,16-Feb-20,1,2,3,4,5,6\n'
+                       'AE,United Arab Emirates,15-Feb-20,0,4,5,0,2,1\n'
+                       'NA,Namibia,15-Feb-20,-5,-8,2,-8,2,3\n'
+                       'AE,United Arab Emirates,16-Feb-20,1,4,4,1,,1\n')
+
+        store = get_mobility_store(path, f'{directory}/cache')
+        self.assertIs(get_mobility_store(path, f'{directory}/cache'), store)
+
+        self.assertEqual(store.countries(), ['Namibia', 'United Arab Emirates'])
+        self.assertEqual(store.code('Namibia'), 'NA')
+        np.testing.assert_array_equal(
+            store.dates_of('Namibia'),
+            np.array(['2020-02-15', '2020-02-16'], dtype='datetime64[D]'))
+        self.assertEqual(store.column('Namibia', 'residential').tolist(),
+                         [3, 6])
+
+        # rows with a missing category are left out
+        self.assertEqual(store.columns('United Arab Emirates')['parks']
+                         .tolist(), [5])
+
+        # the shared copy is memory-mapped read-only
+        self.assertFalse(store.column('Namibia', 'parks').flags.writeable)
+        self.assertIsInstance(store.values, np.memmap)
+
+        with self.assertRaises(KeyError):
+            store.column('Namibia', 'unknown')
+
+        rebuilt = MobilityStore.from_csv(path)
+        np.testing.assert_array_equal(rebuilt.values, store.values)
+
+        # the dashboard imports the scripts from the package, so that it
+        # shares the mobility store of the feature store
+        handler = ScriptHandler(filename=MAIN_PATH)
+        handler.modify_document(Document())
+        self.assertFalse(handler.failed, handler.error)
+        self.assertNotIn('scripts.mobility', sys.modules)
+
+    def test_curve_source(self):
+        x = np.linspace(0, 1, 5)
+        curves = {'A': (x, x), 'B': (x, x ** 2)}
+
+        src = CurveSource(['red', 'blue'])
+        self.assertEqual(src.update(curves), {'patched': 0, 'streamed': 2})
+        self.assertEqual(src.source.data['label'], ['A', 'B'])
+
+        # unchanged curves are not resent
+        self.assertEqual(src.update(curves), {'patched': 0, 'streamed': 0})
+
+        # a removed curve frees its row, which the next new curve takes
+        self.assertEqual(src.update({'B': (x, x ** 2)}),
+                         {'patched': 1, 'streamed': 0})
+        self.assertEqual(src.source.data['label'], ['', 'B'])
+        self.assertEqual(src.source.data['x'][0], [])
+
+        self.assertEqual(src.update({'B': (x, x ** 2), 'C': (x, x ** 3)}),
+                         {'patched': 1, 'streamed': 0})
+        self.assertEqual(src.source.data['label'], ['C', 'B'])
+        self.assertEqual(src.source.data['color'], ['red', 'blue'])
+        self.assertEqual(src.source.data['y'][0], (x ** 3).tolist())
+
+        # changed curves are patched in place
+        self.assertEqual(src.update({'B': (x, x), 'C': (x, x ** 3)}),
+                         {'patched': 1, 'streamed': 0})
+        self.assertEqual(src.slots, {'B': 1, 'C': 0})
+
+    def test_summary_stats(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        path = f'{directory}/report.csv'
+        with open(path, 'w') as file:
+            file.write('country_region_code,country_region,date,'
+                       'retail_and_recreation,grocery_and_pharmacy,parks,'
+                       'transit_stations,workplaces,residential\n'
+                       'NA,Namibia,15-Feb-20,-5,-8,2,-8,2,3\n'
+                       'NA,Namibia,16-Feb-20,1,2,3,4,5,6\n'
+                       'NA,Namibia,17-Feb-20,1,2,7,4,5,9\n')
+
+        summary_stats = get_summary_stats(path, f'{directory}/cache')
+        self.assertIs(get_summary_stats(path, f'{directory}/cache'),
+                      summary_stats)
+
+        self.assertEqual(len(summary_stats), 6)
+        self.assertEqual(summary_stats['residential']['country'], ['Namibia'])
+        self.assertEqual(summary_stats['residential']['mean'], [6.0])
+        self.assertEqual(summary_stats['parks']['median'], [3.0])
+        self.assertEqual(summary_stats['parks']['std'], [np.std([2, 3, 7],
+                                                                ddof=1)])
+
+        # kept on disk for the hash of the file
+        with mock.patch.dict('backend.scripts.stats._STATS', clear=True), \
+                mock.patch('backend.scripts.stats.compute_summary_stats') \
+                as compute:
+            self.assertEqual(get_summary_stats(path, f'{directory}/cache'),
+                             summary_stats)
+            compute.assert_not_called()
+
+        # recomputed when the content changes
+        with open(path, 'a') as file:
+            file.write('NA,Namibia,18-Feb-20,1,2,7,4,5,22\n')
+        self.assertEqual(get_summary_stats(
+            path, f'{directory}/cache')['residential']['max'], [22.0])
+
+    def test_landing_page(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        # stand-in for main.py
+        app_path = f'{directory}/standin.py'
+        with open(app_path, 'w') as file:
+            file.write('from bokeh.io import curdoc\n'
+                       'from bokeh.models import Div\n'
+                       'curdoc().add_root(Div(text="stand-in"))\n')
+
+        config = {'BOKEH_MODE': 'inprocess', 'BOKEH_APP_PATH': app_path,
+                  'BOKEH_PORT': 0, 'BOKEH_POOL_SIZE': 2}
+        app = create_app(config)
+        embed = get_embed(app.config)
+        self.addCleanup(embed.close)
+
+        self.assertIs(get_embed(create_app(config).config), embed)
+        self.assertRegex(embed.url, r'^http://localhost:\d+/standin$')
+
+        # no session is pulled before the first page
+        self.assertFalse(embed.pool.stats()['running'])
+        res = app.test_client().get('/')
+        self.assertIn(f'{embed.url}/autoload.js', res.data.decode())
+        self.assertTrue(embed.pool.stats()['running'])
+
+        for _ in range(100):
+            if embed.pool.stats()['ready'] == 2:
+                break
+            time.sleep(0.1)
+        self.assertEqual(embed.pool.stats()['ready'], 2)
+
+        # pre-warmed sessions are handed out once each
+        scripts = [app.test_client().get('/').data.decode()
+                   for _ in range(2)]
+        self.assertEqual(embed.pool.stats()['taken'], 2)
+        for script in scripts:
+            self.assertIn(embed.url, script)
+            self.assertIn('Bokeh-Session-Id', script)
+        self.assertNotEqual(scripts[0], scripts[1])
+
+        # without a ready session the browser creates its own
+        with mock.patch.object(embed.pool, 'take', return_value=None):
+            res = app.test_client().get('/')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(f'{embed.url}/autoload.js', res.data.decode())
+        self.assertNotIn('Bokeh-Session-Id', res.data.decode())
+
+    def test_inference_service(self):
+        release = threading.Event()
+        calls = []
+
+        def predict(value):
+            calls.append(value)
+            release.wait(10)
+            return value * 2
+
+        service = InferenceService(workers=1, queue_limit=1)
+        running = service.submit('a', predict, 1)
+        while service.stats()['running'] == 0:
+            time.sleep(0.01)
+
+        # duplicates share the computation in flight
+        self.assertIs(service.submit('a', predict, 1), running)
+
+        queued = service.submit('b', predict, 2)
+        with self.assertRaises(QueueFull) as context:
+            service.submit('c', predict, 3)
+        self.assertGreaterEqual(context.exception.retry_after, 1)
+
+        stats = service.stats()
+        self.assertEqual((stats['queue_depth'], stats['coalesced'],
+                          stats['rejected']), (1, 1, 1))
+
+        release.set()
+        self.assertEqual((running.result(), queued.result()), (2, 4))
+        self.assertEqual(calls, [1, 2])
+        self.assertGreater(service.stats()['max_wait_seconds'], 0)
+
+        # the survey answers 503 with Retry-After when the queue is full
+        service = InferenceService(workers=1, queue_limit=0)
+        with mock.patch('backend.ML.service.INFERENCE', service):
+            res = self.client().post('/survey', data={
+                'requested_date': '2020-05-01',
+                'look_forward_days': 3,
+                'country_region_code': 'US'
+            })
+        self.assertEqual(res.status_code, 503)
+        self.assertGreaterEqual(int(res.headers['Retry-After']), 1)
+        self.assertEqual(json.loads(res.data)['code'], 503)
+
+        res = self.client().get('/survey/stats')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('queue_depth', json.loads(res.data))
+
+    def test_train_models(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        path = f'{directory}/who.csv'
+        days = np.arange(40)
+        with open(path, 'w') as file:
+            file.write('ISO_2_CODE,ADM0_NAME,date_epicrv,NewCase,CumCase,'
+                       'NewDeath,CumDeath\n')
+            for country_code, values in (('AA', days * 3),
+                                         ('BB', 100 - days),
+                                         ('CC', days[:5])):
+                dates = np.datetime64('2020-04-01') + days[:len(values)]
+                for date, value in zip(dates, values):
+                    file.write(f'{country_code},{country_code},'
+                               f'{date}T00:00:00Z,{value},0,0,0\n')
+
+        hyperparameters = {'epochs': 1, 'batch_size': 16}
+        trained, failed = train_models(hyperparameters=hyperparameters,
+                                       models_dir=directory, path=path,
+                                       workers=1)
+        self.assertEqual(trained, ['AA', 'BB'])
+        self.assertEqual(list(failed), ['CC'])
+
+        manifest = read_manifest(directory)
+        self.assertEqual(sorted(manifest), ['AA', 'BB'])
+        self.assertEqual(manifest['AA']['validation_samples'], 12)
+        self.assertEqual(manifest['AA']['validation_train_samples'], 25)
+        # the saved model is fit on every sample, after validation
+        self.assertEqual(manifest['AA']['train_samples'], 37)
+        self.assertGreaterEqual(manifest['AA']['validation_rmse'], 0)
+        self.assertGreater(manifest['AA']['training_seconds'], 0)
+
+        # saved for both inference engines
+        registry = ModelRegistry(models_dir=directory)
+        self.assertEqual(registry.get('AA').input_shape, (None, 1, 3))
+        self.assertTrue(os.path.exists(weights_path('AA', directory)))
+
+        # unchanged countries are skipped
+        self.assertEqual(train_models(hyperparameters=hyperparameters,
+                                      models_dir=directory, path=path,
+                                      workers=1)[0], [])
+        self.assertEqual(train_models(['AA'], {'epochs': 2, 'batch_size': 16},
+                                      models_dir=directory, path=path,
+                                      workers=1)[0], ['AA'])
+
+        # any failure of a country is reported, the others are trained
+        def export_or_fail(h5_path, npz_path):
+            if '/AA-' in h5_path:
+                raise OSError('disk full')
+            return export_weights(h5_path, npz_path)
+
+        with mock.patch('backend.ML.train.export_weights',
+                        side_effect=export_or_fail):
+            trained, failed = train_models(
+                ['AA', 'BB'], hyperparameters, models_dir=directory,
+                path=path, workers=1, force=True)
+        self.assertEqual(trained, ['BB'])
+        self.assertEqual(failed, {'AA': 'OSError: disk full'})
+        self.assertFalse([name for name in os.listdir(directory)
+                          if '.tmp' in name])
+
+    def test_benchmarks(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        # synthetic countries scale the dataset
+        path = bench.make_dataset(f'{directory}/who.csv', 3)
+        original = load_data()
+        copy = load_data(path)
+        self.assertEqual(len(copy), 3 * len(original))
+        codes = set(copy['ISO_2_CODE'].dropna())
+        for country_code in original['ISO_2_CODE'].dropna().unique():
+            self.assertIn(country_code, codes)
+            self.assertIn(f'{country_code}1', codes)
+            self.assertIn(f'{country_code}2', codes)
+        # Namibia is copied, rows without a country stay without one
+        self.assertIn('NA1', codes)
+        self.assertEqual(copy['ISO_2_CODE'].isna().sum(),
+                         3 * original['ISO_2_CODE'].isna().sum())
+        # the original rows come first, unchanged
+        self.assertTrue(copy.iloc[:len(original)].equals(original))
+
+        result = bench.measure(lambda: None, repeat=3, min_run_time=0.001)
+        self.assertEqual(result['repeat'], 3)
+        self.assertLessEqual(result['min'], result['median'])
+
+        baseline = {'results': {'a': {'median': 1.0}, 'b': {'median': 1.0}}}
+        current = {'results': {'a': {'median': 1.1}, 'b': {'median': 1.5},
+                               'c': {'median': 9.0}}}
+        self.assertEqual(bench.compare(baseline, current, threshold=0.2),
+                         {'b': 1.5})
+
+    def test_metrics(self):
+        survey = {'country_region_code': 'US', 'look_forward_days': 3,
+                  'requested_date': '2020-05-01'}
+
+        res = self.client().post('/survey', data=survey)
+        timings = dict(item.split(';dur=') for item
+                       in res.headers['Server-Timing'].split(', '))
+        for name in ('forecast_lookup', 'queue_wait', 'model_load',
+                     'case_store', 'rollout', 'trend', 'total'):
+            self.assertGreaterEqual(float(timings[name]), 0)
+
+        survey['country_region_code'] = 'XX'
+        self.assertEqual(self.client().post('/survey', data=survey)
+                         .status_code, 422)
+
+        res = self.client().get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        text = res.data.decode()
+        self.assertIn('# TYPE http_request_duration_seconds histogram', text)
+        self.assertRegex(text, r'http_request_duration_seconds_bucket\{'
+                               r'endpoint="/survey",method="POST",'
+                               r'status="200",le="\+Inf"\} \d+')
+        self.assertRegex(text, r'stage_duration_seconds_count'
+                               r'\{stage="rollout"\} \d+')
+        self.assertRegex(text, r'errors_total\{endpoint="/survey",'
+                               r'cause="\w+"\} \d+')
+        self.assertIn('model_registry_hits_total', text)
+
+        # disabled, stages are not timed and nothing is served
+        with mock.patch.object(metrics, 'ENABLED', False):
+            self.assertIsNone(metrics.stage('rollout').__enter__())
+            app = create_app({'BOKEH_MODE': 'off'})
+            res = app.test_client().post('/survey', data={
+                'country_region_code': 'US', 'look_forward_days': 3,
+                'requested_date': '2020-05-01'})
+            self.assertEqual(res.status_code, 200)
+            self.assertNotIn('Server-Timing', res.headers)
+            self.assertEqual(app.test_client().get('/metrics').status_code,
+                             404)
+
+    def test_lazy_imports(self):
+        # a fresh interpreter, this one imported everything already
+        script = (
+            'import sys\n'
+            'heavy = ("tensorflow", "keras", "sklearn", "pandas", "bokeh",'
+            ' "numpy", "backend.ML")\n'
+            'import backend.app\n'
+            'print(",".join(name for name in heavy'
+            ' if name in sys.modules))\n'
+            'import backend.ML.utils\n'
+            'print(",".join(name for name in heavy[:4]'
+            ' if name in sys.modules))\n')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, BOKEH_MODE='off', PRELOAD='0')
+        output = subprocess.run([sys.executable, '-c', script], cwd=root,
+                                env=env, capture_output=True, text=True,
+                                check=True).stdout.split('\n')
+
+        self.assertEqual(output[0], '')
+        # pandas is only imported to read the CSV file
+        self.assertEqual(output[1], '')
+
+    def test_preload(self):
+        self.assertEqual(self.app.config['PRELOADED_MODELS'], [])
+
+        app = create_app({'BOKEH_MODE': 'off', 'PRELOAD': True,
+                          'PRELOAD_MODELS': ['US']})
+        self.assertEqual(app.config['PRELOADED_MODELS'], ['US'])
+
+        loaded = preload(self.app)
+        self.assertIn('US', loaded)
+        self.assertEqual(self.app.config['PRELOADED_MODELS'], loaded)
+
+    def test_ingest(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        path = f'{DATASET_DIR}/{FILENAME}'
+        report = ingest(path, directory)
+        self.assertEqual(report['version'], '000001')
+        self.assertEqual(report['appended'], report['rows'])
+
+        store = get_case_store(store_dir=directory)
+        self.assertEqual(store.source, '000001')
+        dates, new_cases = store.series('US')
+        expected_dates, expected_new_cases = CaseStore.from_csv().series('US')
+        np.testing.assert_array_equal(dates, expected_dates)
+        np.testing.assert_array_equal(new_cases, expected_new_cases)
+        self.assertEqual(read_watermarks('000001', directory)['US'],
+                         {'rows': len(dates), 'last_date': '2020-06-01'})
+
+        # Namibia's code 'NA' is kept, as it is when the CSV file is read
+        np.testing.assert_array_equal(store.codes, CaseStore.from_csv().codes)
+        self.assertIn('NA', store)
+
+        # nothing new, nothing published
+        self.assertEqual(ingest(path, directory)['appended'], 0)
+        self.assertEqual(current_version(directory), '000001')
+
+        # a delta file, with a stored row, a revision, a repeated new row
+        # and a new country
+        delta = f'{directory}/delta.csv'
+        with open(delta, 'w') as file:
+            file.write('ISO_2_CODE,date_epicrv,NewCase\n'
+                       'US,2020-06-01T00:00:00.000Z,' f'{new_cases[-1]:.0f}\n'
+                       'US,2020-05-31T00:00:00.000Z,1\n'
+                       'US,2020-06-02T00:00:00.000Z,100\n'
+                       'US,2020-06-02T00:00:00.000Z,100\n'
+                       'ZZ,2020-06-02T00:00:00.000Z,3\n'
+                       ',2020-06-02T00:00:00.000Z,3\n')
+        report = ingest(delta, directory)
+        self.assertEqual((report['appended'], report['seen'],
+                          report['revised']), (2, 2, 1))
+        self.assertEqual(report['new_countries'], ['ZZ'])
+
+        # picked up by readers without a restart
+        store = get_case_store(store_dir=directory)
+        self.assertEqual(store.source, '000002')
+        dates, new_cases = store.series('US')
+        self.assertEqual(dates[-1], to_ordinals('2020-06-02'))
+        self.assertEqual(new_cases[-1], 100)
+        self.assertEqual(new_cases[-3], expected_new_cases[-2])
+        self.assertIn('ZZ', store)
+
+        # rows that leave a gap after the last date of a country are
+        # rejected, predictions take the previous rows as previous days
+        with open(delta, 'w') as file:
+            file.write('ISO_2_CODE,date_epicrv,NewCase\n'
+                       'US,2020-06-04T00:00:00.000Z,100\n'
+                       'ZZ,2020-06-03T00:00:00.000Z,3\n')
+        with self.assertRaisesRegex(ValueError, "1 countries with missing "
+                                                "dates, from {'US': "
+                                                "'2020-06-03'}"):
+            ingest(delta, directory)
+        self.assertEqual(current_version(directory), '000002')
+
+        # invalid rows are reported, and nothing is published
+        with open(delta, 'w') as file:
+            file.write('ISO_2_CODE,date_epicrv,NewCase\n'
+                       'us,2020-06-03,1\n'
+                       'US,2020-13-01,1\n'
+                       'US,2020-06-04,many\n')
+        with self.assertRaisesRegex(ValueError, 'country codes, at lines '
+                                                r'\[2\].*dates.*new cases'):
+            ingest(delta, directory)
+        self.assertEqual(current_version(directory), '000002')
+
+        # an unchanged CURRENT is not read again
+        with mock.patch('builtins.open', side_effect=AssertionError):
+            self.assertEqual(current_version(directory), '000002')
+
+        # readers of the CSV file are unaffected
+        self.assertNotIn('ZZ', get_case_store())
+
+    def test_feature_store(self):
+        cases = get_case_store()
+        mobility = get_mobility_store()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        store = get_feature_store(cases, mobility, cache_dir=directory)
+        self.assertIs(get_feature_store(cases, mobility, cache_dir=directory),
+                      store)
+        self.assertEqual(FeatureStore.load(directory).source, store.source)
+
+        dates, values = store.matrix('US')
+        self.assertEqual(values.dtype, np.float32)
+        self.assertEqual(values.shape, (len(dates), len(FEATURES)))
+
+        # every date of the new cases, with the mobility of the same date
+        case_dates, new_cases = cases.series('US')
+        np.testing.assert_array_equal(dates, case_dates)
+        np.testing.assert_array_equal(values[:, 0], new_cases)
+
+        mobility_dates = to_ordinals(mobility.dates_of('United States'))
+        row = np.flatnonzero(dates == mobility_dates[-1])[0]
+        for i, category in enumerate(FEATURES[1:], 1):
+            self.assertEqual(values[row, i], mobility.column(
+                'United States', category)[-1])
+        # dates after the mobility report
+        self.assertTrue(np.isnan(values[row + 1:, 1:]).all())
+
+        # countries missing from the mobility report
+        self.assertIn('US', store)
+        self.assertNotIn('CN', store)
+
+    def test_prediction_intervals(self):
+        survey = {'country_region_code': 'US', 'look_forward_days': 3,
+                  'requested_date': '2020-05-01'}
+
+        res = self.client().post('/survey', data=survey)
+        self.assertNotIn('intervals', json.loads(res.data))
+
+        survey['intervals'] = 'true'
+        res = self.client().post('/survey', data=survey)
+        self.assertEqual(res.status_code, 200)
+        data = json.loads(res.data)
+        self.assertEqual(data['prediction_new_cases'], str(27332))
+
+        intervals = data['intervals']
+        self.assertEqual([day['date'] for day in intervals],
+                         ['2020-05-01', '2020-05-02', '2020-05-03',
+                          '2020-05-04'])
+        for day in intervals:
+            bounds = [day['quantiles'][str(quantile)]
+                      for quantile in (0.05, 0.25, 0.5, 0.75, 0.95)]
+            self.assertEqual(bounds, sorted(bounds))
+            self.assertLess(bounds[0], bounds[-1])
+        # the point forecast lies within the band of its day
+        self.assertLess(intervals[-1]['quantiles']['0.05'], 27332)
+        self.assertGreater(intervals[-1]['quantiles']['0.95'], 27332)
+
+        # the same request, the same intervals
+        res = self.client().post('/survey', data=survey)
+        self.assertEqual(json.loads(res.data)['intervals'], intervals)
+
+        # early dates with few cases have narrow, non-negative bands
+        rnn = RNN('US', 3)
+        prediction_info, _ = rnn.predict('2020-03-05')
+        intervals = rnn.predict_intervals('2020-03-05')
+        for day in intervals:
+            self.assertGreaterEqual(day['quantiles']['0.05'], 0)
+        self.assertLessEqual(intervals[-1]['quantiles']['0.05'],
+                             prediction_info['prediction_new_cases'])
+        self.assertGreaterEqual(intervals[-1]['quantiles']['0.95'],
+                                prediction_info['prediction_new_cases'])
+
+        # residuals never see values after the starting date
+        _, _, Y, _ = rnn.load_series()
+        changed = Y.copy()
+        changed[60:] = 1
+        np.testing.assert_array_equal(rnn.residuals(Y, 60),
+                                      rnn.residuals(changed, 60))
+
+        # any number of paths and quantiles
+        intervals = rnn.predict_intervals('2020-05-01', samples=5,
+                                          quantiles=(0.5,))
+        self.assertEqual(list(intervals[0]['quantiles']), ['0.5'])
+
+    def test_capacity(self):
+        res = self.client().get('/capacity?location=alabama')
+        self.assertEqual(res.status_code, 200)
+        data = json.loads(res.data)
+        self.assertEqual(data['count'], 1)
+        record = data['results'][0]
+        self.assertEqual(record['location_name'], 'Alabama')
+        self.assertEqual(record['peak_bed_day_mean'], '2020-05-12')
+        self.assertEqual(record['icu_bed_capacity'], 1525)
+        self.assertIsNone(record['travel_limit_start_date'])
+
+        res = self.client().get('/capacity', query_string={
+            'location': 'Atlantis'})
+        self.assertEqual(json.loads(res.data)['results'], [])
+
+        res = self.client().get('/capacity?prefix=AL')
+        self.assertEqual([record['location_name'] for record
+                          in json.loads(res.data)['results']],
+                         ['Alabama', 'Alaska', 'Alberta'])
+
+        # ranges of capacities and dates, both bounds included
+        res = self.client().get('/capacity', query_string={
+            'icu_bed_capacity_min': 6812,
+            'peak_icu_bed_day_mean_max': '2020-04-04'})
+        data = json.loads(res.data)
+        self.assertEqual([record['location_name']
+                          for record in data['results']],
+                         ['France', 'Italy', 'Republic of Korea'])
+
+        # the same query, the same response
+        res = self.client().get('/capacity', query_string={
+            'peak_icu_bed_day_mean_max': '2020-04-04',
+            'icu_bed_capacity_min': 6812}, headers={
+            'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+        for query in ({'beds_min': 1}, {'icu_bed_capacity_min': 'many'},
+                      {'stay_home_start_date_min': '3/11/20'},
+                      {'location_name_min': 'A'}):
+            res = self.client().get('/capacity', query_string=query)
+            self.assertEqual(res.status_code, 400)
+
+        # every location without filters
+        index = CapacityIndex.from_csv()
+        res = self.client().get('/capacity')
+        self.assertEqual(json.loads(res.data)['count'], len(index.records))
+
+        # the app starts without the file, and answers 404
+        with mock.patch('backend.app.CAPACITY',
+                        CapacityCache('/nonexistent.csv')):
+            app = create_app({'BOKEH_MODE': 'off'})
+            res = app.test_client().get('/capacity?prefix=Al')
+        self.assertEqual(res.status_code, 404)
+
+        # sorted positions of a range, against a scan
+        matched = index.between('all_bed_capacity', 1000, 20000)
+        self.assertEqual(matched, {
+            position for position, record in enumerate(index.records)
+            if record['all_bed_capacity'] is not None
+            and 1000 <= record['all_bed_capacity'] <= 20000})
+
+    def test_map_data(self):
+        res = self.client().get('/map-data')
+        self.assertEqual(res.status_code, 200)
+        countries = json.loads(res.data)['countries']
+
+        store = get_case_store()
+        self.assertEqual(sorted(countries), sorted(store.countries()))
+
+        self.assertEqual(countries['US']['date'], '2020-06-01')
+        self.assertEqual(countries['US']['forecast_date'], '2020-06-04')
+        self.assertEqual(countries['US']['trend'], 'upward')
+        self.assertIsInstance(countries['US']['forecast_new_cases'], int)
+
+        # countries without a model have their latest cases only
+        self.assertEqual(sorted(countries['FR']), ['date', 'new_cases'])
+
+        res = self.client().get('/map-data', headers={
+            'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+        # forecasts missing from the table run in the inference service,
+        # without loading models for their look_back, a country whose
+        # forecast fails is left without one
+        service = InferenceService()
+        registry = ModelRegistry()
+        with mock.patch('backend.ML.map_data.INFERENCE', service), \
+                mock.patch.object(ForecastTable, 'lookup',
+                                  return_value=None):
+            with mock.patch.object(registry, 'get',
+                                   side_effect=AssertionError):
+                data = build_map_data(registry)
+            self.assertEqual(service.stats()['submitted'], 1)
+            self.assertEqual(data['countries']['US'],
+                             countries['US'])
+
+            with mock.patch('backend.ML.map_data.predict_survey',
+                            side_effect=RuntimeError('corrupt')):
+                data = build_map_data(registry)
+        self.assertEqual(sorted(data['countries']['US']),
+                         ['date', 'new_cases'])
+        self.assertEqual(data['countries']['FR'], countries['FR'])
+
+        # the map gives up on a full queue after a few turns
+        service = mock.Mock()
+        service.submit.side_effect = QueueFull(0)
+        with mock.patch('backend.ML.map_data.INFERENCE', service), \
+                mock.patch.object(ForecastTable, 'lookup',
+                                  return_value=None):
+            data = build_map_data(registry)
+        self.assertEqual(service.submit.call_count, RETRY_ATTEMPTS)
+        self.assertEqual(sorted(data['countries']['US']),
+                         ['date', 'new_cases'])
+
+        # the version is a stat of the models directory, which changes
+        # when a model is renamed into it
+        models_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, models_dir)
+        registry = ModelRegistry(models_dir=models_dir)
+        with mock.patch('os.listdir', side_effect=AssertionError):
+            version = data_version(registry)
+        with open(f'{models_dir}/US-RNN.npz.tmp', 'w'):
+            pass
+        os.utime(models_dir, ns=(0, 0))
+        os.replace(f'{models_dir}/US-RNN.npz.tmp', weights_path('US',
+                                                                models_dir))
+        self.assertNotEqual(data_version(registry), version)
+
+        # the last payload is served while a new version fails to build
+        etag = res.headers['ETag']
+        with mock.patch.object(MAP_DATA, 'version', return_value='new'), \
+                mock.patch.object(MAP_DATA, 'build',
+                                  side_effect=RuntimeError('corrupt')):
+            res = self.client().get('/map-data')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['ETag'], etag)
+
+        # rebuilt only when the version changes
+        version, builds = [1], []
+        cache = VersionedCache(lambda: version[0],
+                               lambda: builds.append(1) or len(builds))
+        first = cache.get()
+        self.assertIs(cache.get(), first)
+        version[0] = 2
+        self.assertEqual(json.loads(cache.get().body), 2)
+        self.assertEqual(len(builds), 2)
+
+        # the previous payload is served while a new one is built
+        building, release = threading.Event(), threading.Event()
+
+        def build():
+            building.set()
+            release.wait(10)
+            return 3
+
+        cache.build = build
+        version[0] = 3
+        with ThreadPoolExecutor(1) as executor:
+            rebuilt = executor.submit(cache.get)
+            building.wait(10)
+            self.assertEqual(json.loads(cache.get().body), 2)
+            release.set()
+            self.assertEqual(json.loads(rebuilt.result().body), 3)
+
 
 if __name__ == '__main__':
     unittest.main()